@@ -4,9 +4,12 @@ import os
 import subprocess
 
 svnDir = '/opt/svn'
-paths = os.listdir(svnDir)
-for path in paths:
+paths = []
+for path in os.listdir(svnDir):
     path = os.path.join(svnDir, path)
     if os.path.isdir(path):
-        subprocess.call(['/opt/svnbak/svn_backup.py', '-z', '-i', path, '/opt/bak', '-t',
-                         'ftp:10.9.10.136:tsm:tsm:/home/tsm'])
+        paths.append(path)
+# dump all repositories in one run so the ftp connection is reused
+if paths:
+    subprocess.call(['/opt/svnbak/svn_backup.py', '-z', '-i'] + paths + ['/opt/bak', '-t',
+                     'ftp:10.9.10.136:tsm:tsm:/home/tsm'])
@@ -3,19 +3,43 @@
 from __future__ import print_function
 import argparse
 import json
+import sqlite3
 from collections import defaultdict
 from contextlib import contextmanager
 
-import pymysql
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
 
 
 def to_json(in_dict):
     return json.dumps(in_dict, sort_keys=True, indent=2)
 
 
+class SQLiteConnection(object):
+    """ 与pymysql的连接用法相同，with语句得到游标，用于读取
+    chapter8/section2/discover.py生成的数据库 """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+
+    def __enter__(self):
+        return self.conn.cursor()
+
+    def __exit__(self, *exc_info):
+        self.conn.commit()
+
+    def columns(self, table):
+        return [row[1] for row in self.conn.execute('pragma table_info({0})'.format(table))]
+
+    def close(self):
+        self.conn.close()
+
+
 @contextmanager
-def get_conn(**kwargs):
-    conn = pymysql.connect(**kwargs)
+def get_conn(sqlite=None, **kwargs):
+    conn = SQLiteConnection(sqlite) if sqlite else pymysql.connect(**kwargs)
     try:
         yield conn
     finally:
@@ -27,15 +51,19 @@ def parse_args():
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--list', action='store_true', help='List active servers')
     group.add_argument('--host', help='List details about the specific host')
+    parser.add_argument('--sqlite', help='read hosts from a SQLite database instead of MySQL')
 
     return parser.parse_args()
 
 
-def list_all_hosts(conn):
+def list_all_hosts(conn, alive_only=False):
     hosts = defaultdict(list)
 
     with conn as cur:
-        cur.execute('select * from hosts')
+        sql = 'select id, host, groupname, username, port from hosts'
+        if alive_only:
+            sql += ' where alive = 1'
+        cur.execute(sql)
         rows = cur.fetchall()
         for row in rows:
             no, host, group, user, port = row
@@ -47,7 +75,8 @@ def list_all_hosts(conn):
 def get_host_detail(conn, host):
     details = {}
     with conn as cur:
-        cur.execute("select * from hosts where host='{0}'".format(host))
+        cur.execute("select id, host, groupname, username, port from hosts "
+                    "where host='{0}'".format(host))
         rows = cur.fetchall()
         if rows:
             no, host, group, user, port = rows[0]
@@ -57,9 +86,12 @@ def get_host_detail(conn, host):
 
 def main():
     parser = parse_args()
-    with get_conn(host='127.0.0.1', user='laimingxing', passwd='laimingxing', db='test') as conn:
+    with get_conn(sqlite=parser.sqlite, host='127.0.0.1', user='laimingxing',
+                  passwd='laimingxing', db='test') as conn:
         if parser.list:
-            hosts = list_all_hosts(conn)
+            # discover.py记录的主机中只列出存活的
+            alive_only = parser.sqlite and 'alive' in conn.columns('hosts')
+            hosts = list_all_hosts(conn, alive_only)
             print(to_json(hosts))
         else:
             details = get_host_detail(conn, parser.host)
@@ -2,26 +2,18 @@
 #-*- coding: UTF-8 -*-
 from __future__ import print_function
 
-import os
 try:
     import configparser
 except ImportError:
     import ConfigParser as configparser
 
-import jinja2
+from renderer import render
 
 
 NAMES = ["issa_server_a_host", "issa_server_a_port", "issa_server_b_host",
 "issa_server_b_port", "issa_server_c_host", "issa_server_c_port"]
 
 
-def render(tpl_path, **kwargs):
-    path, filename = os.path.split(tpl_path)
-    return jinja2.Environment(
-        loader=jinja2.FileSystemLoader(path or './')
-    ).get_template(filename).render(**kwargs)
-
-
 def parser_vars_into_globals(filename):
     parser = configparser.ConfigParser()
     parser.read(filename)
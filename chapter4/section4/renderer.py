@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+render()的缓存版本
+
+原来的render每次调用都新建Environment和FileSystemLoader，模板每次都要重新
+编译。这里每个模板目录只创建一个Environment，编译好的模板由Environment缓存，
+模板文件修改后（mtime变化）自动重新编译。还可以把编译结果保存到磁盘，进程
+重启后不用重新编译：
+
+    from renderer import render, render_many, set_bytecode_cache
+
+    set_bytecode_cache('/tmp/jinja_cache')
+    content = render('simple.html', title='Title')
+    for host, content in zip(hosts, render_many('host.cfg', contexts)):
+        ...
+
+    $ python renderer.py simple.html 10000      # 比较每次渲染的耗时
+"""
+from __future__ import print_function
+import os
+import sys
+import threading
+import timeit
+
+import jinja2
+
+_environments = {}
+_lock = threading.Lock()
+_bytecode_cache = None
+
+
+def set_bytecode_cache(directory):
+    """ 把编译好的模板保存到directory，None表示不使用磁盘缓存 """
+    global _bytecode_cache
+    with _lock:
+        if directory is None:
+            _bytecode_cache = None
+        else:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            _bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+        # 已经创建的Environment使用新的设置
+        _environments.clear()
+
+
+def get_environment(path):
+    path = os.path.abspath(path or './')
+    env = _environments.get(path)
+    if env is None:
+        with _lock:
+            env = _environments.get(path)
+            if env is None:
+                env = jinja2.Environment(loader=jinja2.FileSystemLoader(path),
+                                         auto_reload=True,
+                                         bytecode_cache=_bytecode_cache)
+                _environments[path] = env
+    return env
+
+
+def get_template(tpl_path):
+    path, filename = os.path.split(tpl_path)
+    return get_environment(path).get_template(filename)
+
+
+def render(tpl_path, **kwargs):
+    return get_template(tpl_path).render(**kwargs)
+
+
+def render_many(tpl_path, contexts):
+    """ 用同一个模板依次渲染多组变量，逐个返回结果 """
+    template = get_template(tpl_path)
+    for context in contexts:
+        yield template.render(**context)
+
+
+def render_uncached(tpl_path, **kwargs):
+    path, filename = os.path.split(tpl_path)
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(path or './')
+    ).get_template(filename).render(**kwargs)
+
+
+def benchmark(tpl_path, count):
+    contexts = [{'hostname': 'host{0}'.format(i), 'title': 'Title',
+                 'items': [], 'content': 'content'} for i in range(count)]
+
+    def run(name, func):
+        start = timeit.default_timer()
+        func()
+        elapsed = timeit.default_timer() - start
+        print("{0:<12} {1:.1f}us per render".format(name, elapsed / count * 1e6))
+
+    run('uncached', lambda: [render_uncached(tpl_path, **c) for c in contexts])
+    run('render', lambda: [render(tpl_path, **c) for c in contexts])
+    run('render_many', lambda: list(render_many(tpl_path, contexts)))
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("usage: {0} template count".format(sys.argv[0]))
+        sys.exit(1)
+    benchmark(sys.argv[1], int(sys.argv[2]))
+
+
+if __name__ == '__main__':
+    main()
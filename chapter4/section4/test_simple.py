@@ -1,11 +1,4 @@
-import os
-import jinja2
-
-def render(tpl_path, **kwargs):
-    path, filename = os.path.split(tpl_path)
-    return jinja2.Environment(
-        loader=jinja2.FileSystemLoader(path or './')
-    ).get_template(filename).render(**kwargs)
+from renderer import render
 
 def test_simple():
     title = "Title  H   "
@@ -0,0 +1,242 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+持续读取/proc/diskstats，计算每块磁盘的IOPS、吞吐量、await和利用率
+
+与monitor.py中的get_disk_info不同，这里文件只打开一次，每次从头读入
+预先分配的缓冲区，直接在缓冲区上用正则表达式解析（不复制整个文件的内容），
+所有设备的计数器保存到整数数组中，两次采样之间的差值就是这段时间内的IO情况。
+
+    $ python diskstats.py --interval 0.1 --count 50
+    $ python diskstats.py --benchmark 1000
+"""
+from __future__ import division
+from __future__ import print_function
+import argparse
+import array
+import os
+import re
+import time
+import timeit
+from collections import namedtuple
+
+SECTOR_SIZE = 512
+
+# 设备名之后前11个字段的含义，更新的内核在后面追加了discard/flush的计数
+FIELDS = ('read_count', 'read_merged_count', 'read_sections',
+          'time_spent_reading', 'write_count', 'write_merged_count',
+          'write_sections', 'time_spent_write', 'io_requests',
+          'time_spent_doing_io', 'weighted_time_spent_doing_io')
+NFIELDS = len(FIELDS)
+# 主设备号 次设备号 设备名 计数器...
+LINE_RE = re.compile(br'^ *\d+ +\d+ +(\S+) +([^\n]*)', re.M)
+
+DiskRates = namedtuple('DiskRates', 'device read_iops write_iops read_bytes'
+                                    ' write_bytes await_ms util_percent')
+
+try:
+    array.array('Q')
+    COUNTER_TYPECODE = 'Q'
+except ValueError:
+    COUNTER_TYPECODE = 'L'
+
+
+class ProcFile(object):
+    """ 保持打开的/proc文件，每次从头读到同一个缓冲区中 """
+
+    def __init__(self, path, bufsize=65536):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.buf = bytearray(bufsize)
+
+    def fill(self):
+        """ 把文件内容读入self.buf，返回长度；缓冲区不够大时自动扩大，
+        因此必须在调用之后再取self.buf """
+        while True:
+            n = self._read_into(self.buf)
+            if n < len(self.buf):
+                return n
+            self.buf = bytearray(len(self.buf) * 2)
+
+    def read(self):
+        """ 返回指向缓冲区的memoryview，下一次读取后内容会改变 """
+        n = self.fill()
+        return memoryview(self.buf)[:n]
+
+    if hasattr(os, 'preadv'):
+        def _read_into(self, buf):
+            return os.preadv(self.fd, [buf], 0)
+    elif hasattr(os, 'readv'):
+        def _read_into(self, buf):
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            return os.readv(self.fd, [buf])
+    else:
+        def _read_into(self, buf):
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            data = os.read(self.fd, len(buf))
+            buf[:len(data)] = data
+            return len(data)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def counter_delta(new, old):
+    # 32位内核上计数器会回绕
+    delta = new - old
+    if delta < 0:
+        delta += 1 << 32
+    return delta
+
+
+class DiskStats(object):
+
+    def __init__(self, path='/proc/diskstats'):
+        self.proc = ProcFile(path)
+        # 文件中的原始设备名，用来发现设备列表的变化
+        self.names = []
+        self.devices = []
+        self.index = {}
+        # 两组计数器交替使用：本次采样和上一次采样
+        self.counters = array.array(COUNTER_TYPECODE)
+        self.prev_counters = array.array(COUNTER_TYPECODE)
+        self.time = None
+        self.prev_time = None
+
+    def sample(self):
+        """ 读一次/proc/diskstats，返回与上一次采样的间隔秒数 """
+        n = self.proc.fill()
+        now = timeit.default_timer()
+        # [(设备名, 计数器)]，用pos/endpos限定范围，不复制缓冲区
+        lines = LINE_RE.findall(self.proc.buf, 0, n)
+
+        self.prev_counters, self.counters = self.counters, self.prev_counters
+        self.prev_time, self.time = self.time, now
+        if len(self.counters) != len(lines) * NFIELDS:
+            self.counters = array.array(COUNTER_TYPECODE, [0]) * (len(lines) * NFIELDS)
+
+        counters = self.counters
+        names = self.names
+        changed = len(names) != len(lines)
+        if changed:
+            names = [None] * len(lines)
+        base = 0
+        for i, (name, rest) in enumerate(lines):
+            fields = rest.split()
+            if names[i] != name:
+                # 设备列表变化（热插拔），重新建立索引
+                if not changed:
+                    changed = True
+                    names = list(names)
+                names[i] = name
+            for j in range(NFIELDS):
+                counters[base + j] = int(fields[j])
+            base += NFIELDS
+
+        if changed:
+            self.names = names
+            self.devices = [d.decode('ascii') for d in names]
+            self.index = dict((name, i) for i, name in enumerate(self.devices))
+            # 设备变化后上一次的计数器无法对应，下一次采样才有速率
+            self.prev_time = None
+            self.prev_counters = array.array(COUNTER_TYPECODE, counters)
+        if self.prev_time is None:
+            return 0
+        return self.time - self.prev_time
+
+    def get(self, device):
+        """ 最近一次采样中某个设备的计数器，与get_disk_info的字段相同 """
+        base = self.index[device] * NFIELDS
+        return dict(zip(FIELDS, self.counters[base:base + NFIELDS]))
+
+    def rates(self, device):
+        """ 最近两次采样之间设备的IO速率 """
+        if self.prev_time is None:
+            return None
+        i = self.index[device]
+        return self._rates(i, self.time - self.prev_time)
+
+    def all_rates(self):
+        if self.prev_time is None:
+            return []
+        interval = self.time - self.prev_time
+        return [self._rates(i, interval) for i in range(len(self.devices))]
+
+    def _rates(self, i, interval):
+        base = i * NFIELDS
+        new = self.counters
+        old = self.prev_counters
+        reads = counter_delta(new[base], old[base])
+        writes = counter_delta(new[base + 4], old[base + 4])
+        read_sectors = counter_delta(new[base + 2], old[base + 2])
+        write_sectors = counter_delta(new[base + 6], old[base + 6])
+        io_time = counter_delta(new[base + 3], old[base + 3]) + \
+            counter_delta(new[base + 7], old[base + 7])
+        busy = counter_delta(new[base + 9], old[base + 9])
+        ios = reads + writes
+        return DiskRates(self.devices[i],
+                         reads / interval,
+                         writes / interval,
+                         read_sectors * SECTOR_SIZE / interval,
+                         write_sectors * SECTOR_SIZE / interval,
+                         io_time / ios if ios else 0.0,
+                         min(100.0, busy / (interval * 10)))
+
+    def close(self):
+        self.proc.close()
+
+
+def benchmark(count):
+    stats = DiskStats()
+    stats.sample()
+    start = timeit.default_timer()
+    for _ in range(count):
+        stats.sample()
+        stats.all_rates()
+    elapsed = timeit.default_timer() - start
+    print("{0} devices, {1:.1f}us per sample".format(
+        len(stats.devices), elapsed / count * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='disk io statistics')
+    parser.add_argument('--interval', type=float, default=1.0)
+    parser.add_argument('--count', type=int, default=0,
+                        help='number of reports, 0 for ever')
+    parser.add_argument('--device', action='append',
+                        help='only report these devices')
+    parser.add_argument('--benchmark', type=int, default=0,
+                        help='measure the cost of N samples and exit')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+        return
+
+    stats = DiskStats()
+    stats.sample()
+    reports = 0
+    while args.count == 0 or reports < args.count:
+        time.sleep(args.interval)
+        stats.sample()
+        print("{0:<10} {1:>9} {2:>9} {3:>11} {4:>11} {5:>8} {6:>7}".format(
+            'device', 'r/s', 'w/s', 'rkB/s', 'wkB/s', 'await', '%util'))
+        for r in stats.all_rates():
+            if args.device and r.device not in args.device:
+                continue
+            print("{0:<10} {1:>9.1f} {2:>9.1f} {3:>11.1f} {4:>11.1f} {5:>8.2f} {6:>7.1f}".format(
+                r.device, r.read_iops, r.write_iops, r.read_bytes / 1024,
+                r.write_bytes / 1024, r.await_ms, r.util_percent))
+        reports += 1
+
+
+if __name__ == '__main__':
+    main()
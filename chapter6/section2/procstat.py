@@ -0,0 +1,422 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+一次采样读取一组/proc文件：/proc/stat、/proc/net/dev、/proc/meminfo
+以及指定进程的/proc/<pid>/stat
+
+每个文件只打开一次，使用diskstats.py中的ProcFile读入复用的缓冲区，
+直接在缓冲区上解析（不复制整个文件的内容），计数器保存在两组交替使用的整数数组中，
+CPU利用率、网卡速率和进程CPU利用率由两次采样的差值得到。
+
+    $ python procstat.py --interval 1 --count 10 --pid 1
+    $ python procstat.py --benchmark 1000 --pid 1
+"""
+from __future__ import division
+from __future__ import print_function
+import argparse
+import array
+import os
+import re
+import time
+import timeit
+from collections import namedtuple
+
+from diskstats import ProcFile, COUNTER_TYPECODE, counter_delta
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# /proc/stat中cpu行的字段
+CPU_FIELDS = ('user', 'nice', 'system', 'idle', 'iowait',
+              'irq', 'softirq', 'steal')
+# /proc/net/dev中每块网卡接收和发送各8个字段，这里保留常用的8个
+NET_FIELDS = ('bytes_recv', 'packets_recv', 'errin', 'dropin',
+              'bytes_sent', 'packets_sent', 'errout', 'dropout')
+NET_COLUMNS = (0, 1, 2, 3, 8, 9, 10, 11)
+MEM_FIELDS = ('MemTotal', 'MemFree', 'MemAvailable', 'Buffers', 'Cached',
+              'SReclaimable', 'SwapTotal', 'SwapFree')
+
+# 匹配一行：名字和其余部分，用match(buf, pos, n)直接在ProcFile的缓冲区上匹配
+CPU_RE = re.compile(br'(cpu\d*) +([^\n]*)')
+# 老内核中网卡名和第一个字段之间可能没有空格
+NET_RE = re.compile(br' *([^:\s]+): *([^\n]*)')
+
+NetRates = namedtuple('NetRates', 'name bytes_recv bytes_sent'
+                                  ' packets_recv packets_sent errin errout')
+Memory = namedtuple('Memory', 'total available used free percent'
+                              ' swap_total swap_used')
+ProcessStat = namedtuple('ProcessStat', 'pid name state cpu_percent'
+                                        ' rss vms num_threads')
+
+
+def new_counters(n):
+    return array.array(COUNTER_TYPECODE, [0]) * n
+
+
+class TableStat(object):
+    """ 每行一个名字和一组计数器的/proc文件，如/proc/stat中的cpu行和/proc/net/dev
+
+    子类设置pattern和columns：pattern匹配一行，两个分组分别是名字和其余
+    部分，columns是从其余部分中保留的字段位置。跳过header_lines行表头后
+    逐行匹配，遇到第一个不匹配的行结束 """
+
+    pattern = None
+    columns = ()
+    header_lines = 0
+
+    def __init__(self, path):
+        self.proc = ProcFile(path)
+        self.names = []
+        self.index = {}
+        self.counters = array.array(COUNTER_TYPECODE)
+        self.prev_counters = array.array(COUNTER_TYPECODE)
+
+    def rows(self):
+        """ 读一次文件，返回[(名字, 字段列表)] """
+        n = self.proc.fill()
+        buf = self.proc.buf
+        match = self.pattern.match
+        columns = self.columns
+        width = max(columns) + 1
+        pos = 0
+        for _ in range(self.header_lines):
+            pos = buf.find(b'\n', pos, n) + 1
+        rows = []
+        while pos < n:
+            m = match(buf, pos, n)
+            if m is None:
+                break
+            name, rest = m.groups()
+            values = rest.split()
+            if len(values) < width:
+                # 老内核的字段较少，例如/proc/stat中没有steal
+                values += [b'0'] * (width - len(values))
+            rows.append((name.decode('ascii'), [values[j] for j in columns]))
+            pos = m.end() + 1
+        return rows
+
+    def sample(self):
+        rows = self.rows()
+        nfields = len(self.columns)
+
+        self.prev_counters, self.counters = self.counters, self.prev_counters
+        if len(self.counters) != len(rows) * nfields:
+            self.counters = new_counters(len(rows) * nfields)
+
+        counters = self.counters
+        names = self.names
+        changed = len(names) != len(rows)
+        if changed:
+            names = [None] * len(rows)
+        base = 0
+        for i, (name, values) in enumerate(rows):
+            if names[i] != name:
+                if not changed:
+                    changed = True
+                    names = list(names)
+                names[i] = name
+            for j in range(nfields):
+                counters[base + j] = int(values[j])
+            base += nfields
+
+        if changed:
+            # 行发生变化（CPU或网卡热插拔），上一次的计数器不能再用
+            self.names = names
+            self.index = dict((name, i) for i, name in enumerate(names))
+            self.prev_counters = array.array(COUNTER_TYPECODE, counters)
+        return not changed
+
+    def deltas(self, i):
+        nfields = len(self.columns)
+        base = i * nfields
+        return [counter_delta(self.counters[base + j], self.prev_counters[base + j])
+                for j in range(nfields)]
+
+    def close(self):
+        self.proc.close()
+
+
+class CpuStat(TableStat):
+
+    fields = CPU_FIELDS
+    pattern = CPU_RE
+    columns = tuple(range(len(CPU_FIELDS)))
+
+    def __init__(self, path='/proc/stat'):
+        super(CpuStat, self).__init__(path)
+
+    def percent(self, name='cpu'):
+        """ 两次采样之间的CPU利用率，name为cpu表示所有CPU，cpu0、cpu1为单个CPU """
+        deltas = self.deltas(self.index[name])
+        total = sum(deltas)
+        if total == 0:
+            return 0.0
+        idle = deltas[3] + deltas[4]
+        return round((total - idle) / total * 100, 1)
+
+
+class NetDev(TableStat):
+
+    fields = NET_FIELDS
+    pattern = NET_RE
+    columns = NET_COLUMNS
+    header_lines = 2
+
+    def __init__(self, path='/proc/net/dev'):
+        super(NetDev, self).__init__(path)
+
+    def rates(self, interval):
+        result = []
+        for i, name in enumerate(self.names):
+            d = self.deltas(i)
+            result.append(NetRates(name,
+                                   d[0] / interval, d[4] / interval,
+                                   d[1] / interval, d[5] / interval,
+                                   d[2] / interval, d[6] / interval))
+        return result
+
+
+class MemInfo(object):
+
+    def __init__(self, path='/proc/meminfo', fields=MEM_FIELDS):
+        self.proc = ProcFile(path)
+        self.fields = fields
+        # 只查找需要的字段，字段名必须在行首，Cached:不能匹配SwapCached:
+        self.keys = [name.encode('ascii') + b':' for name in fields]
+        self.values = new_counters(len(fields))
+        self.found = set()
+
+    def sample(self):
+        values = self.values
+        found = self.found
+        found.clear()
+        n = self.proc.fill()
+        buf = self.proc.buf
+        for i, key in enumerate(self.keys):
+            if buf.startswith(key):
+                pos = 0
+            else:
+                pos = buf.find(b'\n' + key, 0, n) + 1
+                if pos == 0:
+                    continue
+            pos += len(key)
+            end = buf.find(b'\n', pos, n)
+            # 单位是kB
+            values[i] = int(buf[pos:end if end >= 0 else n].split()[0]) * 1024
+            found.add(i)
+        return True
+
+    def get(self, name):
+        i = self.fields.index(name)
+        return self.values[i] if i in self.found else None
+
+    def memory(self):
+        total = self.get('MemTotal')
+        free = self.get('MemFree')
+        available = self.get('MemAvailable')
+        if available is None:
+            # 3.14之前的内核没有MemAvailable
+            available = free + self.get('Buffers') + self.get('Cached')
+        used = total - available
+        swap_total = self.get('SwapTotal') or 0
+        swap_free = self.get('SwapFree') or 0
+        return Memory(total, available, used, free,
+                      round(used / total * 100, 1) if total else 0.0,
+                      swap_total, swap_total - swap_free)
+
+    def close(self):
+        self.proc.close()
+
+
+class PidStat(object):
+    """ 单个进程的/proc/<pid>/stat，进程退出后alive为False """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.proc = ProcFile('/proc/{0}/stat'.format(pid), 4096)
+        self.alive = True
+        self.name = None
+        self.state = None
+        self.start_time = None
+        # utime, stime, num_threads, vsize, rss(页)
+        self.counters = new_counters(5)
+        self.prev_counters = new_counters(5)
+
+    def sample(self):
+        if not self.alive:
+            return False
+        try:
+            n = self.proc.fill()
+        except (IOError, OSError):
+            # 进程已经退出并被回收
+            self.alive = False
+            self.proc.close()
+            return False
+        buf = self.proc.buf
+        # 进程名中可能有空格和括号，以最后一个')'为界
+        end = buf.rfind(b')', 0, n)
+        fields = buf[end + 1:n].split()
+        start_time = int(fields[19])
+        changed = self.start_time != start_time
+        if changed:
+            self.name = buf[buf.find(b'(', 0, end) + 1:end].decode('utf-8', 'replace')
+            self.start_time = start_time
+        self.state = fields[0].decode('ascii')
+        self.prev_counters, self.counters = self.counters, self.prev_counters
+        counters = self.counters
+        counters[0] = int(fields[11])
+        counters[1] = int(fields[12])
+        counters[2] = int(fields[17])
+        counters[3] = int(fields[20])
+        counters[4] = int(fields[21])
+        if changed:
+            self.prev_counters[:] = counters
+        return not changed
+
+    def stat(self, interval):
+        new = self.counters
+        old = self.prev_counters
+        cpu_time = (new[0] + new[1] - old[0] - old[1]) / CLOCK_TICKS
+        return ProcessStat(self.pid, self.name, self.state,
+                           round(cpu_time / interval * 100, 1) if interval else 0.0,
+                           new[4] * PAGE_SIZE, new[3], new[2])
+
+    def close(self):
+        self.proc.close()
+
+
+class ProcSampler(object):
+    """ 按配置读取一组/proc文件，每次sample()读一遍，之后查询计算好的结果 """
+
+    SOURCES = ('cpu', 'net', 'mem')
+
+    def __init__(self, sources=SOURCES, pids=()):
+        self.cpu = CpuStat() if 'cpu' in sources else None
+        self.net = NetDev() if 'net' in sources else None
+        self.mem = MemInfo() if 'mem' in sources else None
+        self.pids = dict((pid, PidStat(pid)) for pid in pids)
+        self.sources = [s for s in (self.cpu, self.net, self.mem) if s is not None]
+        self.time = None
+        self.prev_time = None
+
+    def add_pid(self, pid):
+        if pid not in self.pids:
+            self.pids[pid] = PidStat(pid)
+
+    def sample(self):
+        """ 读一次所有文件，返回与上一次采样的间隔秒数，第一次返回0 """
+        self.prev_time, self.time = self.time, timeit.default_timer()
+        for source in self.sources:
+            source.sample()
+        for pid in list(self.pids):
+            pidstat = self.pids[pid]
+            pidstat.sample()
+            if not pidstat.alive:
+                pidstat.close()
+                del self.pids[pid]
+        return self.interval()
+
+    def interval(self):
+        if self.prev_time is None:
+            return 0
+        return self.time - self.prev_time
+
+    def cpu_percent(self, name='cpu'):
+        if self.cpu is None or self.prev_time is None:
+            return None
+        return self.cpu.percent(name)
+
+    def net_rates(self):
+        if self.net is None or self.prev_time is None:
+            return []
+        return self.net.rates(self.interval())
+
+    def memory(self):
+        if self.mem is None:
+            return None
+        return self.mem.memory()
+
+    def processes(self):
+        if self.prev_time is None:
+            return []
+        interval = self.interval()
+        return [p.stat(interval) for p in self.pids.values()]
+
+    def close(self):
+        for source in self.sources:
+            source.close()
+        for pidstat in self.pids.values():
+            pidstat.close()
+        self.pids.clear()
+
+
+def benchmark(count, pids):
+    """ 与monitor.py中使用的psutil调用比较每次采样的耗时 """
+    sampler = ProcSampler(pids=pids)
+    sampler.sample()
+    start = timeit.default_timer()
+    for _ in range(count):
+        sampler.sample()
+        sampler.cpu_percent()
+        sampler.memory()
+        sampler.net_rates()
+        sampler.processes()
+    elapsed = timeit.default_timer() - start
+    sampler.close()
+    print("procstat: {0:.1f}us per sample".format(elapsed / count * 1e6))
+
+    try:
+        import psutil
+    except ImportError:
+        print("psutil is not installed, skip")
+        return
+    processes = [psutil.Process(pid) for pid in pids]
+    psutil.cpu_percent(interval=None)
+    start = timeit.default_timer()
+    for _ in range(count):
+        psutil.cpu_percent(interval=None)
+        psutil.virtual_memory()
+        psutil.net_io_counters(pernic=True)
+        for p in processes:
+            p.cpu_times()
+            p.memory_info()
+            p.num_threads()
+    elapsed = timeit.default_timer() - start
+    print("psutil:   {0:.1f}us per sample".format(elapsed / count * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='batched /proc sampler')
+    parser.add_argument('--interval', type=float, default=1.0)
+    parser.add_argument('--count', type=int, default=0,
+                        help='number of reports, 0 for ever')
+    parser.add_argument('--pid', type=int, action='append', default=[],
+                        help='also report this process')
+    parser.add_argument('--benchmark', type=int, default=0,
+                        help='measure the cost of N samples and exit')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.pid)
+        return
+
+    sampler = ProcSampler(pids=args.pid)
+    sampler.sample()
+    reports = 0
+    while args.count == 0 or reports < args.count:
+        time.sleep(args.interval)
+        sampler.sample()
+        mem = sampler.memory()
+        print("cpu {0}%  mem {1}% ({2} used)".format(
+            sampler.cpu_percent(), mem.percent, mem.used))
+        for r in sampler.net_rates():
+            print("  {0:<10} recv {1:>12.1f}B/s  sent {2:>12.1f}B/s".format(
+                r.name, r.bytes_recv, r.bytes_sent))
+        for p in sampler.processes():
+            print("  {0:<6} {1:<16} {2} cpu {3}% rss {4}".format(
+                p.pid, p.name, p.state, p.cpu_percent, p.rss))
+        reports += 1
+
+
+if __name__ == '__main__':
+    main()
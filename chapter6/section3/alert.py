@@ -0,0 +1,368 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+根据阈值规则检查监控样本，只在告警状态变化时发送邮件
+
+规则每行一条，格式为"指标 比较符 阈值 [for 持续时间]"，例如：
+
+    disk_percent > 90 for 5m
+    mem_percent >= 95 for 30s
+    cpu_percent > 80 for 10m
+
+- 条件满足后先进入pending，持续满足for指定的时间后才触发（firing），
+  条件不再满足时恢复（resolved）
+- 同一条告警只在状态变化时通知一次，持续触发时每隔repeat_interval提醒一次
+- 一段时间内状态反复变化（抖动）的告警只通知一次，稳定下来后再发送最新状态
+- 通知先缓存起来，每隔batch_interval合并成一封邮件，通过同一个SMTP连接发送
+- AsyncNotifier在单独的线程中发送邮件，SMTP服务器不可用时按指数退避重试，
+  不会阻塞采样线程
+
+    $ python alert.py alert.rules        # 检查规则文件
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+import argparse
+import collections
+import operator
+import re
+import smtplib
+import socket
+import sys
+import threading
+import time
+from datetime import datetime
+from email.header import Header
+from email.mime.text import MIMEText
+
+OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+RULE_RE = re.compile(r'^(\w+)\s*(>=|<=|==|!=|>|<)\s*(-?\d+(?:\.\d+)?)'
+                     r'(?:\s+for\s+(\d+)([smhd]?))?$')
+
+Event = collections.namedtuple('Event', 'time kind rule value')
+
+
+def format_duration(seconds):
+    for unit in ('d', 'h', 'm'):
+        if seconds % UNITS[unit] == 0:
+            return '{0}{1}'.format(seconds // UNITS[unit], unit)
+    return '{0}s'.format(seconds)
+
+
+class Rule(object):
+
+    def __init__(self, metric, op, threshold, duration=0):
+        self.metric = metric
+        self.op = op
+        self.threshold = threshold
+        self.duration = duration
+        self.name = '{0} {1} {2:g}'.format(metric, op, threshold)
+        if duration:
+            self.name += ' for ' + format_duration(duration)
+
+    @classmethod
+    def parse(cls, text):
+        match = RULE_RE.match(text.strip())
+        if match is None:
+            raise ValueError("invalid rule: {0}".format(text))
+        metric, op, threshold, duration, unit = match.groups()
+        duration = int(duration) * UNITS[unit] if duration else 0
+        return cls(metric, op, float(threshold), duration)
+
+    def match(self, value):
+        return OPERATORS[self.op](value, self.threshold)
+
+    def __repr__(self):
+        return 'Rule({0!r})'.format(self.name)
+
+
+def load_rules(path):
+    rules = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                rules.append(Rule.parse(line))
+    return rules
+
+
+class AlertState(object):
+
+    def __init__(self, rule):
+        self.rule = rule
+        # inactive, pending 或 firing
+        self.state = 'inactive'
+        self.since = None
+        self.value = None
+        # 最近一次通知的状态（firing或resolved）和时间
+        self.notified = None
+        self.notified_at = None
+        self.transitions = collections.deque()
+        self.flapping = False
+
+    def to_dict(self):
+        return dict(rule=self.rule.name, state=self.state, since=self.since,
+                    value=self.value, flapping=self.flapping)
+
+
+class AlertManager(object):
+
+    def __init__(self, rules, notifier, batch_interval=60,
+                 repeat_interval=3600, flap_window=600, flap_threshold=4,
+                 hostname=None):
+        self.alerts = [AlertState(rule) for rule in rules]
+        self.notifier = notifier
+        self.batch_interval = batch_interval
+        self.repeat_interval = repeat_interval
+        self.flap_window = flap_window
+        self.flap_threshold = flap_threshold
+        self.hostname = hostname or socket.gethostname()
+        self.pending = []
+
+    def evaluate(self, sample):
+        now = sample['time']
+        for alert in self.alerts:
+            value = sample.get(alert.rule.metric)
+            if value is None:
+                continue
+            alert.value = value
+            if alert.rule.match(value):
+                if alert.state == 'inactive':
+                    alert.state = 'pending'
+                    alert.since = now
+                if alert.state == 'pending' and now - alert.since >= alert.rule.duration:
+                    alert.state = 'firing'
+                    self.transition(alert, 'firing', now)
+            elif alert.state == 'firing':
+                alert.state = 'inactive'
+                alert.since = now
+                self.transition(alert, 'resolved', now)
+            elif alert.state == 'pending':
+                # 持续时间不够，不通知
+                alert.state = 'inactive'
+                alert.since = None
+
+            if alert.flapping:
+                self.check_flapping(alert, now)
+            elif (alert.state == 'firing' and alert.notified == 'firing' and
+                    now - alert.notified_at >= self.repeat_interval):
+                self.notify(alert, 'firing', now, repeat=True)
+
+    def transition(self, alert, kind, now):
+        alert.transitions.append(now)
+        while alert.transitions and alert.transitions[0] < now - self.flap_window:
+            alert.transitions.popleft()
+        if not alert.flapping and len(alert.transitions) >= self.flap_threshold:
+            alert.flapping = True
+            self.pending.append(Event(now, 'flapping', alert.rule, alert.value))
+        if not alert.flapping:
+            self.notify(alert, kind, now)
+
+    def check_flapping(self, alert, now):
+        # 一个窗口内没有再发生状态变化，认为已经稳定，补发当前状态
+        if alert.transitions and alert.transitions[-1] >= now - self.flap_window:
+            return
+        alert.flapping = False
+        alert.transitions.clear()
+        self.notify(alert, 'firing' if alert.state == 'firing' else 'resolved', now)
+
+    def notify(self, alert, kind, now, repeat=False):
+        if not repeat and alert.notified == kind:
+            return
+        # 没有通知过触发的告警，恢复时也不需要通知
+        if kind == 'resolved' and alert.notified != 'firing':
+            return
+        alert.notified = kind
+        alert.notified_at = now
+        self.pending.append(Event(now, kind, alert.rule, alert.value))
+
+    def flush(self, now=None, force=False):
+        """ 合并发送缓存的通知，返回发送的条数 """
+        if not self.pending:
+            return 0
+        now = time.time() if now is None else now
+        if not force and now - self.pending[0].time < self.batch_interval:
+            return 0
+        events = self.pending
+        try:
+            self.notifier.send(self.subject(events), self.digest(events))
+        except (smtplib.SMTPException, socket.error) as e:
+            # 发送失败时保留通知，下次再试
+            print("send alerts failed: {0}".format(e), file=sys.stderr)
+            return 0
+        self.pending = []
+        return len(events)
+
+    def subject(self, events):
+        counts = collections.Counter(e.kind for e in events)
+        parts = ['{0} {1}'.format(counts[k], k)
+                 for k in ('firing', 'resolved', 'flapping') if counts[k]]
+        return '[{0}] {1}'.format(self.hostname, ', '.join(parts))
+
+    def digest(self, events):
+        lines = []
+        for e in events:
+            lines.append('{0} [{1}] {2} (value {3})'.format(
+                datetime.fromtimestamp(e.time).strftime("%Y-%m-%d %H:%M:%S"),
+                e.kind.upper(), e.rule.name, e.value))
+        return '\n'.join(lines) + '\n'
+
+    def states(self):
+        return [alert.to_dict() for alert in self.alerts]
+
+    def close(self):
+        self.flush(force=True)
+        self.notifier.close()
+
+
+class MailNotifier(object):
+    """ 复用同一个SMTP连接，每批通知一封邮件发给所有收件人 """
+
+    def __init__(self, host, port, sender, recipients, user=None,
+                 password=None, ssl=False, timeout=30):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = recipients
+        self.user = user
+        self.password = password
+        self.ssl = ssl
+        self.timeout = timeout
+        self.smtp = None
+
+    def connect(self):
+        cls = smtplib.SMTP_SSL if self.ssl else smtplib.SMTP
+        smtp = cls(self.host, self.port, timeout=self.timeout)
+        if self.user:
+            smtp.login(self.user, self.password)
+        self.smtp = smtp
+
+    def send(self, subject, body):
+        msg = MIMEText(body, 'plain', 'utf-8')
+        msg['Subject'] = Header(subject, 'utf-8')
+        msg['From'] = self.sender
+        msg['To'] = ', '.join(self.recipients)
+        for retry in range(2):
+            if self.smtp is None:
+                self.connect()
+            try:
+                self.smtp.sendmail(self.sender, self.recipients, msg.as_string())
+                return
+            except smtplib.SMTPServerDisconnected:
+                # 服务器关闭了空闲连接，重新连接一次
+                self.smtp = None
+                if retry:
+                    raise
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.smtp = None
+
+
+class AsyncNotifier(object):
+    """ 在后台线程中调用notifier.send，send只把邮件放入队列，立即返回
+
+    发送失败后等待retry_interval秒重试同一封邮件，每次失败等待时间加倍，
+    最长max_retry_interval秒；队列中最多保留max_queue封邮件，超出时丢弃
+    最旧的 """
+
+    def __init__(self, notifier, retry_interval=10, max_retry_interval=600,
+                 max_queue=100):
+        self.notifier = notifier
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.queue = collections.deque(maxlen=max_queue)
+        self.cond = threading.Condition()
+        self.closing = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, subject, body):
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                print("alert queue full, drop: {0}".format(self.queue[0][0]),
+                      file=sys.stderr)
+            self.queue.append((subject, body))
+            self.cond.notify()
+
+    def run(self):
+        delay = 0
+        retry_at = 0
+        while True:
+            with self.cond:
+                while not self.queue and not self.closing:
+                    self.cond.wait()
+                # 退避期间新的邮件不会提前触发重试，close可以结束等待
+                while delay and not self.closing:
+                    remaining = retry_at - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if not self.queue or (delay and self.closing):
+                    # 关闭时服务器仍不可用，放弃剩下的邮件
+                    break
+                subject, body = self.queue[0]
+            try:
+                self.notifier.send(subject, body)
+            except Exception as e:
+                # 任何异常都不能让发送线程退出
+                delay = min(max(delay * 2, self.retry_interval),
+                            self.max_retry_interval)
+                retry_at = time.time() + delay
+                print("send alerts failed: {0}, retry in {1}s".format(e, delay),
+                      file=sys.stderr)
+                continue
+            delay = 0
+            with self.cond:
+                # 发送期间队列满时可能已经丢弃了这封邮件
+                if self.queue and self.queue[0] == (subject, body):
+                    self.queue.popleft()
+        if self.queue:
+            print("{0} alert mails not sent".format(len(self.queue)),
+                  file=sys.stderr)
+        self.notifier.close()
+
+    def close(self, timeout=10):
+        """ 发送剩余的邮件后关闭，最多等待timeout秒 """
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join(timeout)
+
+
+class PrintNotifier(object):
+    """ 没有配置SMTP服务器时打印通知 """
+
+    def send(self, subject, body):
+        print(subject)
+        print(body)
+
+    def close(self):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='check alert rules')
+    parser.add_argument('rules', help='rule file, one rule per line')
+    args = parser.parse_args()
+
+    for rule in load_rules(args.rules):
+        print(rule.name)
+
+
+if __name__ == '__main__':
+    main()
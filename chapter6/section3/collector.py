@@ -0,0 +1,483 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+汇总多台服务器监控数据的收集服务
+
+monitor_agent.py使用--collector参数把样本以紧凑的二进制格式通过UDP发送到
+这里（也可以使用TCP，每个包前面加2字节长度），收集服务在内存中保存每台
+服务器最新的样本，并提供汇总页面：
+
+    $ python collector.py --port 8200 --http-port 8100
+    $ python monitor_agent.py --collector 127.0.0.1:8200
+    $ curl http://127.0.0.1:8100/                 # 汇总页面
+    $ curl http://127.0.0.1:8100/host?name=web1   # 单台服务器的monitor.html
+    $ curl http://127.0.0.1:8100/hosts            # 所有服务器的最新样本
+    $ curl http://127.0.0.1:8100/stats
+
+压力测试，模拟10000台服务器各上报3次：
+
+    $ python collector.py --benchmark --hosts 10000 --rounds 3
+
+数据包格式（网络字节序）：
+
+    magic(2s) version(B) 主机名长度(B) 主机名 样本1 样本2 ...
+
+每个样本的字段见FIELDS，长度固定为SAMPLE.size字节。
+"""
+from __future__ import division
+from __future__ import print_function
+import argparse
+import collections
+import errno
+import heapq
+import json
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+    from urllib.request import urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib2 import urlopen
+
+# renderer.py在chapter4/section4中
+sys.path.append(os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+    'chapter4', 'section4')))
+from renderer import render, render_many
+
+MAGIC = b'MC'
+VERSION = 1
+HEADER = struct.Struct('!2sBB')
+FIELDS = ('time', 'cpu_count', 'cpu_percent', 'mem_total', 'mem_percent',
+          'mem_used', 'mem_free', 'disk_total', 'disk_percent', 'disk_used',
+          'disk_free', 'boot_time')
+SAMPLE = struct.Struct('!dHfQfQQQfQQd')
+# TCP连接上每个包前面的长度
+FRAME = struct.Struct('!H')
+MAX_PACKET = 65507
+MAX_SAMPLES = (MAX_PACKET - HEADER.size - 255) // SAMPLE.size
+
+TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def bytes2human(n):
+    symbols = ('K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y')
+    prefix = {}
+    for i, s in enumerate(symbols):
+        prefix[s] = 1 << (i + 1) * 10
+    for s in reversed(symbols):
+        if n >= prefix[s]:
+            value = float(n) / prefix[s]
+            return '%.1f%s' % (value, s)
+    return "%sB" % n
+
+
+def encode(hostname, samples):
+    """ 把一台服务器的若干个样本（monitor_agent.py的字典）编码成一个包 """
+    name = hostname.encode('utf-8')[:255]
+    parts = [HEADER.pack(MAGIC, VERSION, len(name)), name]
+    for sample in samples[:MAX_SAMPLES]:
+        parts.append(SAMPLE.pack(*[sample.get(f) or 0 for f in FIELDS]))
+    return b''.join(parts)
+
+
+def decode(data):
+    """ 返回(主机名, 样本元组列表)，格式不对时抛出ValueError """
+    if len(data) < HEADER.size:
+        raise ValueError('packet too short')
+    magic, version, length = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('unknown packet format')
+    offset = HEADER.size + length
+    if len(data) < offset or (len(data) - offset) % SAMPLE.size:
+        raise ValueError('bad packet length')
+    hostname = data[HEADER.size:offset].decode('utf-8', 'replace')
+    return hostname, [SAMPLE.unpack_from(data, pos)
+                      for pos in range(offset, len(data), SAMPLE.size)]
+
+
+class CollectorClient(object):
+    """ monitor_agent.py用来上报样本，攒够batch个样本发送一个UDP包 """
+
+    def __init__(self, host, port, hostname, batch=1):
+        self.address = (host, port)
+        self.hostname = hostname
+        self.batch = min(batch, MAX_SAMPLES)
+        self.samples = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, sample):
+        self.samples.append(sample)
+        if len(self.samples) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.samples:
+            return
+        try:
+            self.sock.sendto(encode(self.hostname, self.samples), self.address)
+        except socket.error as e:
+            # UDP上报失败不影响本地监控
+            print("send to collector failed: {0}".format(e), file=sys.stderr)
+        self.samples = []
+
+    def close(self):
+        self.flush()
+        self.sock.close()
+
+
+class Collector(object):
+    """ 在内存中保存每台服务器最新的样本 """
+
+    def __init__(self, stale_after=60):
+        self.stale_after = stale_after
+        # 主机名 -> (收到的时间, 样本元组)
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def receive(self, data):
+        try:
+            hostname, samples = decode(data)
+        except (ValueError, struct.error):
+            self.stats['invalid'] += 1
+            return
+        self.stats['packets'] += 1
+        self.stats['samples'] += len(samples)
+        if not samples:
+            return
+        latest = max(samples)
+        now = time.time()
+        with self.lock:
+            current = self.hosts.get(hostname)
+            # UDP包可能乱序，只保留时间最新的样本
+            if current is None or current[1][0] <= latest[0]:
+                self.hosts[hostname] = (now, latest)
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.hosts.items())
+
+    def summary(self):
+        hosts = self.snapshot()
+        now = time.time()
+        count = len(hosts)
+
+        def average(field):
+            i = FIELDS.index(field)
+            return round(sum(s[i] for _, (_, s) in hosts) / count, 1) if count else 0
+
+        return dict(host_count=count,
+                    stale_count=sum(1 for _, (seen, _) in hosts
+                                    if now - seen > self.stale_after),
+                    cpu_percent=average('cpu_percent'),
+                    mem_percent=average('mem_percent'),
+                    disk_percent=average('disk_percent'))
+
+    def top(self, limit, field='cpu_percent'):
+        i = FIELDS.index(field)
+        return heapq.nlargest(limit, self.snapshot(), key=lambda h: h[1][1][i])
+
+    def get(self, hostname):
+        with self.lock:
+            return self.hosts.get(hostname)
+
+    def to_dict(self, hostname, sample):
+        data = dict(zip(FIELDS, sample))
+        data['hostname'] = hostname
+        return data
+
+    def report_context(self, hostname, sample):
+        """ monitor.html中使用的变量，与monitor_agent.py的report相同 """
+        data = self.to_dict(hostname, sample)
+        data['cpu_percent'] = round(data['cpu_percent'], 1)
+        data['mem_percent'] = round(data['mem_percent'], 1)
+        data['disk_percent'] = round(data['disk_percent'], 1)
+        data['boot_time'] = datetime.fromtimestamp(data['boot_time']).strftime("%Y-%m-%d %H:%M:%S")
+        for key in ('mem_total', 'mem_free', 'mem_used',
+                    'disk_total', 'disk_free', 'disk_used'):
+            data[key] = bytes2human(data[key])
+        return data
+
+
+class CollectorServer(object):
+    """ 单线程的事件循环，同时接收UDP包和TCP连接 """
+
+    def __init__(self, collector, host='0.0.0.0', port=8200):
+        self.collector = collector
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # 突发的上报先在内核缓冲区中排队
+        self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        self.udp.bind((host, port))
+        self.udp.setblocking(False)
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind((host, port))
+        self.tcp.listen(128)
+        self.tcp.setblocking(False)
+        self.epoll = select.epoll()
+        self.epoll.register(self.udp.fileno(), select.EPOLLIN)
+        self.epoll.register(self.tcp.fileno(), select.EPOLLIN)
+        # fd -> (socket, 未处理完的数据)
+        self.connections = {}
+        self.stopped = threading.Event()
+
+    def serve_forever(self):
+        udp_fd = self.udp.fileno()
+        tcp_fd = self.tcp.fileno()
+        while not self.stopped.is_set():
+            for fd, events in self.epoll.poll(0.5):
+                if fd == udp_fd:
+                    self.read_udp()
+                elif fd == tcp_fd:
+                    self.accept()
+                else:
+                    self.read_tcp(fd)
+
+    def read_udp(self):
+        # 一次唤醒把缓冲区中的包全部读完
+        receive = self.collector.receive
+        recv = self.udp.recv
+        while True:
+            try:
+                data = recv(MAX_PACKET)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            receive(data)
+
+    def accept(self):
+        try:
+            conn, _ = self.tcp.accept()
+        except socket.error:
+            return
+        conn.setblocking(False)
+        self.connections[conn.fileno()] = [conn, b'']
+        self.epoll.register(conn.fileno(), select.EPOLLIN)
+
+    def read_tcp(self, fd):
+        item = self.connections[fd]
+        conn = item[0]
+        try:
+            data = conn.recv(MAX_PACKET)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b''
+        if not data:
+            self.epoll.unregister(fd)
+            conn.close()
+            del self.connections[fd]
+            return
+        buf = item[1] + data
+        pos = 0
+        while len(buf) - pos >= FRAME.size:
+            length, = FRAME.unpack_from(buf, pos)
+            if len(buf) - pos - FRAME.size < length:
+                break
+            start = pos + FRAME.size
+            self.collector.receive(buf[start:start + length])
+            pos = start + length
+        item[1] = buf[pos:]
+
+    def stop(self):
+        self.stopped.set()
+
+    def close(self):
+        for conn, _ in self.connections.values():
+            conn.close()
+        self.epoll.close()
+        self.udp.close()
+        self.tcp.close()
+
+
+class CollectorHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        collector = self.server.collector
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == '/':
+            try:
+                limit = int(params.get('limit', ['20'])[0])
+            except ValueError:
+                self.send_error(400, 'limit must be an integer')
+                return
+            if limit <= 0:
+                self.send_error(400, 'limit must be positive')
+                return
+            sort = params.get('sort', ['cpu_percent'])[0]
+            if sort not in FIELDS:
+                self.send_error(400, 'unknown field')
+                return
+            self.send_content(self.dashboard(collector, limit, sort).encode('utf-8'),
+                              'text/html; charset=utf-8')
+        elif url.path == '/host':
+            name = params.get('name', [''])[0]
+            item = collector.get(name)
+            if item is None:
+                self.send_error(404, 'unknown host')
+                return
+            content = render(os.path.join(TEMPLATE_DIR, 'monitor.html'),
+                             **collector.report_context(name, item[1]))
+            self.send_content(content.encode('utf-8'), 'text/html; charset=utf-8')
+        elif url.path == '/hosts':
+            self.send_json(dict((name, dict(collector.to_dict(name, sample), seen=seen))
+                                for name, (seen, sample) in collector.snapshot()))
+        elif url.path == '/stats':
+            times = os.times()
+            stats = dict(collector.stats)
+            stats.update(hosts=len(collector.hosts), cpu_time=times[0] + times[1])
+            self.send_json(stats)
+        else:
+            self.send_error(404)
+
+    def dashboard(self, collector, limit, sort):
+        data = collector.summary()
+        contexts = [collector.report_context(name, sample)
+                    for name, (_, sample) in collector.top(limit, sort)]
+        data.update(sort=sort, tables=list(render_many(
+            os.path.join(TEMPLATE_DIR, 'monitor_table.html'), contexts)))
+        return render(os.path.join(TEMPLATE_DIR, 'dashboard.html'), **data)
+
+    def send_json(self, obj):
+        self.send_content(json.dumps(obj).encode('utf-8'), 'application/json')
+
+    def send_content(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def fake_sample(i, now):
+    return dict(time=now, cpu_count=8, cpu_percent=i % 100,
+                mem_total=16 << 30, mem_percent=(i * 7) % 100,
+                mem_used=8 << 30, mem_free=8 << 30,
+                disk_total=500 << 30, disk_percent=(i * 13) % 100,
+                disk_used=250 << 30, disk_free=250 << 30,
+                boot_time=now - 86400)
+
+
+def load_generator(host, port, hosts, rounds, rate=0):
+    """ 模拟hosts台服务器各上报rounds次，rate为每秒发送的包数，0表示不限速 """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    packets = [encode('host{0:05d}'.format(i), [fake_sample(i, time.time())])
+               for i in range(hosts)]
+    address = (host, port)
+    sent = 0
+    start = time.time()
+    for _ in range(rounds):
+        for packet in packets:
+            sock.sendto(packet, address)
+            sent += 1
+            if rate and sent % 100 == 0:
+                delay = start + sent / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+    elapsed = time.time() - start
+    sock.close()
+    return sent, elapsed
+
+
+def get_stats(http_port):
+    return json.loads(urlopen('http://127.0.0.1:{0}/stats'.format(http_port)).read().decode('utf-8'))
+
+
+def benchmark(args):
+    """ 在子进程中启动收集服务，用UDP发送模拟数据，统计收集服务消耗的CPU时间 """
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                               '--host', '127.0.0.1', '--port', str(args.port),
+                               '--http-port', str(args.http_port)])
+    try:
+        for _ in range(50):
+            try:
+                before = get_stats(args.http_port)
+                break
+            except IOError:
+                time.sleep(0.1)
+        else:
+            raise SystemExit("collector did not start")
+
+        sent, elapsed = load_generator('127.0.0.1', args.port, args.hosts,
+                                       args.rounds, args.rate)
+        time.sleep(1)
+        after = get_stats(args.http_port)
+        received = after.get('packets', 0) - before.get('packets', 0)
+        cpu_time = after['cpu_time'] - before['cpu_time']
+        print("sent {0} packets in {1:.2f}s ({2:.0f}/s), received {3} ({4:.1%})".format(
+            sent, elapsed, sent / elapsed, received, received / sent))
+        print("collector cpu {0:.2f}s, {1:.1f}us per packet, {2} hosts".format(
+            cpu_time, cpu_time / max(received, 1) * 1e6, after['hosts']))
+        per_round = cpu_time / max(received, 1) * args.hosts
+        print("{0} hosts every 10s needs {1:.1%} of one core".format(
+            args.hosts, per_round / 10))
+
+        start = time.time()
+        urlopen('http://127.0.0.1:{0}/'.format(args.http_port)).read()
+        print("dashboard rendered in {0:.1f}ms".format((time.time() - start) * 1000))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='monitor collector')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8200,
+                        help='UDP and TCP port for agents')
+    parser.add_argument('--http-port', type=int, default=8100)
+    parser.add_argument('--stale-after', type=int, default=60,
+                        help='seconds before a silent host is counted as stale')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='start a collector and measure it with fake hosts')
+    parser.add_argument('--hosts', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--rate', type=int, default=0,
+                        help='packets per second sent by the benchmark, 0 for unlimited')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args)
+        return
+
+    collector = Collector(args.stale_after)
+    server = CollectorServer(collector, args.host, args.port)
+    httpd = ThreadingHTTPServer((args.host, args.http_port), CollectorHandler)
+    httpd.collector = collector
+    thr = threading.Thread(target=httpd.serve_forever)
+    thr.daemon = True
+    thr.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.shutdown()
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,25 +3,24 @@
 from __future__ import unicode_literals
 import os
 import socket
+import sys
 from datetime import datetime
 
-import jinja2
 import yagmail
 import psutil
 
+# renderer.py在chapter4/section4中
+sys.path.append(os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+    'chapter4', 'section4')))
+from renderer import render
+
 
 EMAIL_USER = 'joy_lmx@163.com'
 EMAIL_PASSWORD = '123456'
 RECIPIENTS = ['me@mingxinglai.com']
 
 
-def render(tpl_path, **kwargs):
-    path, filename = os.path.split(tpl_path)
-    return jinja2.Environment(
-        loader=jinja2.FileSystemLoader(path or './')
-    ).get_template(filename).render(**kwargs)
-
-
 def bytes2human(n):
     symbols = ('K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y')
     prefix = {}
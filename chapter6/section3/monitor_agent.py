@@ -0,0 +1,394 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+monitor.py的常驻版本：按固定间隔采样，最近的样本保存在内存中，
+通过HTTP（TCP或Unix socket）查询
+
+    $ python monitor_agent.py --interval 1 --port 8000
+    $ curl http://127.0.0.1:8000/latest
+    $ curl http://127.0.0.1:8000/samples?n=60
+    $ curl http://127.0.0.1:8000/stats
+    $ curl http://127.0.0.1:8000/          # monitor.html
+
+使用--store时，所有样本还会保存到本地的时序存储（见tsdb.py）：
+
+    $ python monitor_agent.py --store monitor.tsdb
+    $ curl 'http://127.0.0.1:8000/query?metric=cpu_percent&start=1500000000'
+    $ curl 'http://127.0.0.1:8000/query?metric=cpu_percent&agg=max'
+
+使用--rules时，每个样本都会按规则检查，告警合并后通过邮件发送（见alert.py）：
+
+    $ python monitor_agent.py --rules alert.rules --smtp-host smtp.163.com \
+          --smtp-user joy_lmx@163.com --smtp-password 123456 \
+          --mail-to me@mingxinglai.com
+    $ curl http://127.0.0.1:8000/alerts
+
+使用--collector时，样本还会通过UDP发送到汇总多台服务器的collector.py：
+
+    $ python monitor_agent.py --collector 10.0.0.1:8200
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+import argparse
+import collections
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import timeit
+from datetime import datetime
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, TCPServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, TCPServer
+    from urlparse import urlparse, parse_qs
+
+import psutil
+
+from alert import (AlertManager, AsyncNotifier, MailNotifier, PrintNotifier,
+                   load_rules)
+from collector import CollectorClient
+from tsdb import DEFAULT_LEVELS, TimeSeriesStore
+
+# renderer.py在chapter4/section4中
+sys.path.append(os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+    'chapter4', 'section4')))
+from renderer import render
+
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'monitor.html')
+
+
+def bytes2human(n):
+    symbols = ('K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y')
+    prefix = {}
+    for i, s in enumerate(symbols):
+        prefix[s] = 1 << (i + 1) * 10
+    for s in reversed(symbols):
+        if n >= prefix[s]:
+            value = float(n) / prefix[s]
+            return '%.1f%s' % (value, s)
+    return "%sB" % n
+
+
+class MonitorAgent(object):
+
+    def __init__(self, interval=1.0, size=3600, disk_path='/',
+                 store=None, store_path=None, save_interval=60, alerts=None,
+                 push=None):
+        self.interval = interval
+        self.disk_path = disk_path
+        self.store = store
+        self.store_path = store_path
+        self.save_interval = save_interval
+        self.alerts = alerts
+        self.push = push
+        self.samples = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.collect_count = 0
+        self.collect_total_ms = 0.0
+        self.collect_max_ms = 0.0
+
+        # 不会变化的信息只读一次
+        self.hostname = socket.gethostname()
+        self.cpu_count = psutil.cpu_count()
+        self.boot_time = psutil.boot_time()
+        # 第一次调用只记录CPU时间，之后每次返回与上一次调用之间的利用率，
+        # 不需要像cpu_percent(interval=1)那样阻塞1秒
+        psutil.cpu_percent(interval=None)
+
+    def collect(self):
+        start = timeit.default_timer()
+        cpu_percent = psutil.cpu_percent(interval=None)
+        virtual_mem = psutil.virtual_memory()
+        disk_usage = psutil.disk_usage(self.disk_path)
+        sample = dict(time=time.time(),
+                      cpu_count=self.cpu_count,
+                      cpu_percent=cpu_percent,
+                      mem_total=virtual_mem.total,
+                      mem_percent=virtual_mem.percent,
+                      mem_free=virtual_mem.available,
+                      mem_used=virtual_mem.total - virtual_mem.available,
+                      disk_total=disk_usage.total,
+                      disk_percent=disk_usage.percent,
+                      disk_free=disk_usage.free,
+                      disk_used=disk_usage.used,
+                      boot_time=self.boot_time)
+        elapsed_ms = (timeit.default_timer() - start) * 1000
+        sample['collect_ms'] = elapsed_ms
+
+        with self.lock:
+            self.samples.append(sample)
+            if self.store is not None:
+                self.store.append_sample(sample['time'], dict(
+                    (k, v) for k, v in sample.items() if k != 'time'))
+            self.collect_count += 1
+            self.collect_total_ms += elapsed_ms
+            self.collect_max_ms = max(self.collect_max_ms, elapsed_ms)
+            if self.alerts is not None:
+                self.alerts.evaluate(sample)
+        if self.push is not None:
+            self.push.send(sample)
+        return sample
+
+    def run(self):
+        # 按绝对时间调度，采样本身的耗时不会累积成误差
+        next_time = time.time()
+        next_save = next_time + self.save_interval
+        while not self.stopped.is_set():
+            self.collect()
+            if self.store is not None and time.time() >= next_save:
+                self.save()
+                next_save = time.time() + self.save_interval
+            if self.alerts is not None:
+                # 只把合并后的通知交给发送线程，不会阻塞采样
+                self.alerts.flush()
+            next_time += self.interval
+            delay = next_time - time.time()
+            if delay < 0:
+                next_time = time.time()
+                delay = 0
+            self.stopped.wait(delay)
+
+    def start(self):
+        thr = threading.Thread(target=self.run)
+        thr.daemon = True
+        thr.start()
+        return thr
+
+    def stop(self):
+        self.stopped.set()
+        self.save()
+        if self.alerts is not None:
+            self.alerts.close()
+        if self.push is not None:
+            self.push.close()
+
+    def save(self):
+        if self.store is None:
+            return
+        with self.lock:
+            self.store.expire()
+            if self.store_path:
+                self.store.save(self.store_path)
+
+    def query(self, metric, start, end, agg=None):
+        if self.store is None:
+            return None
+        with self.lock:
+            if agg:
+                return self.store.aggregate(metric, start, end, agg)
+            return self.store.query(metric, start, end)
+
+    def alert_states(self):
+        if self.alerts is None:
+            return None
+        with self.lock:
+            return self.alerts.states()
+
+    def latest(self):
+        with self.lock:
+            return self.samples[-1] if self.samples else None
+
+    def recent(self, n):
+        with self.lock:
+            samples = list(self.samples)
+        return samples[-n:] if n > 0 else samples
+
+    def stats(self):
+        with self.lock:
+            count = self.collect_count
+            return dict(hostname=self.hostname,
+                        interval=self.interval,
+                        samples=len(self.samples),
+                        collect_count=count,
+                        collect_avg_ms=self.collect_total_ms / count if count else 0,
+                        collect_max_ms=self.collect_max_ms)
+
+    def report(self):
+        sample = self.latest()
+        if sample is None:
+            return None
+        data = dict(sample)
+        data.update(hostname=self.hostname,
+                    boot_time=datetime.fromtimestamp(sample['boot_time']).strftime("%Y-%m-%d %H:%M:%S"))
+        for key in ('mem_total', 'mem_free', 'mem_used',
+                    'disk_total', 'disk_free', 'disk_used'):
+            data[key] = bytes2human(sample[key])
+        return render(TEMPLATE, **data)
+
+
+class MonitorHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        agent = self.server.agent
+        url = urlparse(self.path)
+        if url.path == '/latest':
+            self.send_json(agent.latest())
+        elif url.path == '/samples':
+            try:
+                n = int(parse_qs(url.query).get('n', ['0'])[0])
+            except ValueError:
+                self.send_error(400, 'n must be an integer')
+                return
+            if n < 0:
+                self.send_error(400, 'n must not be negative')
+                return
+            self.send_json(agent.recent(n))
+        elif url.path == '/stats':
+            self.send_json(agent.stats())
+        elif url.path == '/alerts':
+            self.send_json(agent.alert_states())
+        elif url.path == '/query':
+            params = parse_qs(url.query)
+            if 'metric' not in params:
+                self.send_error(400, 'metric is required')
+                return
+            now = time.time()
+            try:
+                start = float(params.get('start', [now - 3600])[0])
+                end = float(params.get('end', [now])[0])
+            except ValueError:
+                self.send_error(400, 'start and end must be numbers')
+                return
+            agg = params.get('agg', [None])[0]
+            try:
+                self.send_json(agent.query(params['metric'][0], start, end, agg))
+            except ValueError as e:
+                self.send_error(400, str(e))
+        elif url.path == '/':
+            content = agent.report()
+            if content is None:
+                self.send_error(503, 'no sample yet')
+            else:
+                self.send_content(content.encode('utf-8'), 'text/html; charset=utf-8')
+        else:
+            self.send_error(404)
+
+    def send_json(self, obj):
+        self.send_content(json.dumps(obj).encode('utf-8'), 'application/json')
+
+    def send_content(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket的客户端没有地址
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='monitor agent')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between two samples')
+    parser.add_argument('--size', type=int, default=3600,
+                        help='number of samples kept in memory')
+    parser.add_argument('--disk-path', default='/',
+                        help='file system reported as disk usage')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix-socket',
+                        help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--store',
+                        help='keep all samples in this time series file')
+    parser.add_argument('--save-interval', type=int, default=60,
+                        help='seconds between two saves of the store')
+    parser.add_argument('--raw-retention', type=int, default=DEFAULT_LEVELS[0][1],
+                        help='seconds raw samples are kept in a new store, '
+                             'older data is kept as 1m and 1h rollups')
+    parser.add_argument('--rules',
+                        help='alert rule file, see alert.rules')
+    parser.add_argument('--smtp-host',
+                        help='send alerts by mail, print them if not given')
+    parser.add_argument('--smtp-port', type=int, default=25)
+    parser.add_argument('--smtp-ssl', action='store_true')
+    parser.add_argument('--smtp-user')
+    parser.add_argument('--smtp-password')
+    parser.add_argument('--mail-from')
+    parser.add_argument('--mail-to', action='append', default=[])
+    parser.add_argument('--batch-interval', type=int, default=60,
+                        help='seconds alerts are collected into one mail')
+    parser.add_argument('--repeat-interval', type=int, default=3600,
+                        help='seconds before a firing alert is sent again')
+    parser.add_argument('--collector',
+                        help='also send samples to collector.py at HOST:PORT')
+    parser.add_argument('--collector-batch', type=int, default=1,
+                        help='number of samples sent in one packet')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    store = None
+    if args.store:
+        if os.path.exists(args.store):
+            store = TimeSeriesStore.load(args.store)
+        else:
+            store = TimeSeriesStore(((1, args.raw_retention),) + DEFAULT_LEVELS[1:])
+    alerts = None
+    if args.rules:
+        if args.smtp_host:
+            notifier = AsyncNotifier(MailNotifier(
+                args.smtp_host, args.smtp_port, args.mail_from or args.smtp_user,
+                args.mail_to, args.smtp_user, args.smtp_password, args.smtp_ssl))
+        else:
+            notifier = PrintNotifier()
+        alerts = AlertManager(load_rules(args.rules), notifier,
+                              args.batch_interval, args.repeat_interval)
+    push = None
+    if args.collector:
+        host, port = args.collector.rsplit(':', 1)
+        push = CollectorClient(host, int(port), socket.gethostname(),
+                               args.collector_batch)
+    agent = MonitorAgent(args.interval, args.size, args.disk_path,
+                         store, args.store, args.save_interval, alerts, push)
+    agent.start()
+
+    if args.unix_socket:
+        server = ThreadingUnixHTTPServer(args.unix_socket, MonitorHandler)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), MonitorHandler)
+    server.agent = agent
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.stop()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,538 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+保存监控数据的本地时序存储
+
+每个指标的原始数据按毫秒精度的时间戳保存，写满一块后按Gorilla的方式压缩：
+时间戳保存二阶差分，数值保存与前一个值的异或结果，采样间隔固定、数值
+变化不大时每个点只需要几个比特。原始数据自动汇总为每分钟、每小时的
+min/max/sum/count，各个精度的数据分别有自己的保留时间，默认原始数据
+保留1小时、分钟数据1天、小时数据30天。所有数据都在内存中：缓慢变化的
+数值压缩后每个点约6字节，原始数据保留一周时每个每秒采样的指标约需要
+3.5MB；不变的数值每个点不到1字节。用python tsdb.py --raw-retention估算。
+
+    store = TimeSeriesStore()
+    store.append('cpu_percent', time.time(), 12.5)
+    store.query('cpu_percent', start, end)
+    store.aggregate('cpu_percent', start, end, 'max')
+    store.save('monitor.tsdb')
+"""
+from __future__ import division
+from __future__ import print_function
+import argparse
+import array
+import json
+import math
+import numbers
+import os
+import random
+import struct
+import time
+
+MAGIC = b'TSDB'
+# 文件格式改变时加1，旧版本的文件不能读取
+FORMAT_VERSION = 2
+
+# (精度秒数, 保留秒数)，第一项是原始数据
+DEFAULT_LEVELS = ((1, 3600), (60, 86400), (3600, 30 * 86400))
+
+AGGREGATES = ('min', 'max', 'sum', 'count')
+
+try:
+    array.array('q')
+    TIMESTAMP_TYPECODE = 'q'
+except ValueError:
+    TIMESTAMP_TYPECODE = 'l'
+
+
+def float_to_bits(value):
+    return struct.unpack('>Q', struct.pack('>d', value))[0]
+
+
+def bits_to_float(bits):
+    return struct.unpack('>d', struct.pack('>Q', bits))[0]
+
+
+class BitWriter(object):
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.acc = 0
+        self.nbits = 0
+
+    def write(self, value, nbits):
+        self.acc = (self.acc << nbits) | value
+        self.nbits += nbits
+        while self.nbits >= 8:
+            self.nbits -= 8
+            self.buf.append((self.acc >> self.nbits) & 0xff)
+        self.acc &= (1 << self.nbits) - 1
+
+    def getvalue(self):
+        if self.nbits:
+            return bytes(self.buf + bytearray([(self.acc << (8 - self.nbits)) & 0xff]))
+        return bytes(self.buf)
+
+
+class BitReader(object):
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.pos = 0
+        self.acc = 0
+        self.nbits = 0
+
+    def read(self, nbits):
+        while self.nbits < nbits:
+            self.acc = (self.acc << 8) | self.data[self.pos]
+            self.pos += 1
+            self.nbits += 8
+        self.nbits -= nbits
+        value = self.acc >> self.nbits
+        self.acc &= (1 << self.nbits) - 1
+        return value
+
+
+# 时间戳二阶差分的编码：(前缀, 前缀位数, 数值位数)
+DOD_ENCODINGS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b1111, 4, 64))
+
+
+def encode_chunk(timestamps, values):
+    w = BitWriter()
+    prev_ts = timestamps[0]
+    prev_bits = float_to_bits(values[0])
+    w.write(prev_ts & 0xffffffffffffffff, 64)
+    w.write(prev_bits, 64)
+    prev_delta = 0
+    prev_leading = -1
+    prev_trailing = 0
+    for i in range(1, len(timestamps)):
+        ts = timestamps[i]
+        delta = ts - prev_ts
+        dod = delta - prev_delta
+        prev_ts, prev_delta = ts, delta
+        if dod == 0:
+            w.write(0, 1)
+        else:
+            for prefix, prefix_bits, value_bits in DOD_ENCODINGS:
+                limit = 1 << (value_bits - 1)
+                if -limit <= dod < limit:
+                    w.write(prefix, prefix_bits)
+                    w.write(dod & ((1 << value_bits) - 1), value_bits)
+                    break
+
+        bits = float_to_bits(values[i])
+        xor = bits ^ prev_bits
+        prev_bits = bits
+        if xor == 0:
+            w.write(0, 1)
+            continue
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if prev_leading >= 0 and leading >= prev_leading and trailing >= prev_trailing:
+            # 有效位落在上一个值的有效位范围之内，沿用上一次的位置
+            w.write(0b10, 2)
+            w.write(xor >> prev_trailing, 64 - prev_leading - prev_trailing)
+        else:
+            significant = 64 - leading - trailing
+            w.write(0b11, 2)
+            w.write(leading, 5)
+            w.write(significant & 63, 6)
+            w.write(xor >> trailing, significant)
+            prev_leading, prev_trailing = leading, trailing
+    return w.getvalue()
+
+
+def decode_chunk(data, count):
+    r = BitReader(data)
+    ts = r.read(64)
+    if ts >= 1 << 63:
+        ts -= 1 << 64
+    bits = r.read(64)
+    timestamps = [ts]
+    values = [bits_to_float(bits)]
+    delta = 0
+    leading = 0
+    trailing = 0
+    for _ in range(1, count):
+        if r.read(1):
+            for prefix, prefix_bits, value_bits in DOD_ENCODINGS[:-1]:
+                if not r.read(1):
+                    break
+            else:
+                value_bits = DOD_ENCODINGS[-1][2]
+            dod = r.read(value_bits)
+            if dod >= 1 << (value_bits - 1):
+                dod -= 1 << value_bits
+            delta += dod
+        ts += delta
+        timestamps.append(ts)
+
+        if r.read(1):
+            if r.read(1):
+                leading = r.read(5)
+                significant = r.read(6) or 64
+                trailing = 64 - leading - significant
+            bits ^= r.read(64 - leading - trailing) << trailing
+        values.append(bits_to_float(bits))
+    return timestamps, values
+
+
+class Series(object):
+    """ 一列数据，最新的点保存在数组中，写满chunk_size个点后压缩 """
+
+    def __init__(self, retention, chunk_size):
+        self.retention = retention
+        self.chunk_size = chunk_size
+        # (起始时间, 结束时间, 点数, 压缩后的数据)
+        self.chunks = []
+        self.timestamps = array.array(TIMESTAMP_TYPECODE)
+        self.values = array.array('d')
+        # 删除过过期数据后，这一列就不再包含全部的历史数据
+        self.expired = False
+
+    def append(self, ts, value):
+        self.timestamps.append(ts)
+        self.values.append(value)
+        if len(self.timestamps) >= self.chunk_size:
+            self.seal()
+
+    def seal(self):
+        if not self.timestamps:
+            return
+        self.chunks.append((self.timestamps[0], self.timestamps[-1],
+                            len(self.timestamps),
+                            encode_chunk(self.timestamps, self.values)))
+        self.timestamps = array.array(TIMESTAMP_TYPECODE)
+        self.values = array.array('d')
+
+    def expire(self, now):
+        oldest = now - self.retention
+        while self.chunks and self.chunks[0][1] < oldest:
+            self.chunks.pop(0)
+            self.expired = True
+
+    def first_time(self):
+        if self.chunks:
+            return self.chunks[0][0]
+        if self.timestamps:
+            return self.timestamps[0]
+        return None
+
+    def last_time(self):
+        if self.timestamps:
+            return self.timestamps[-1]
+        if self.chunks:
+            return self.chunks[-1][1]
+        return None
+
+    def points(self, start, end):
+        for first, last, count, data in self.chunks:
+            if last < start or first > end:
+                continue
+            timestamps, values = decode_chunk(data, count)
+            for ts, value in zip(timestamps, values):
+                if start <= ts <= end:
+                    yield ts, value
+        for ts, value in zip(self.timestamps, self.values):
+            if start <= ts <= end:
+                yield ts, value
+
+    def nbytes(self):
+        size = sum(len(chunk[3]) + 24 for chunk in self.chunks)
+        return size + (len(self.timestamps) + len(self.values)) * 8
+
+    def dump(self, blob):
+        # 还没写满的数据也压缩后保存，不修改内存中的数据
+        chunks = list(self.chunks)
+        if self.timestamps:
+            chunks.append((self.timestamps[0], self.timestamps[-1],
+                           len(self.timestamps),
+                           encode_chunk(self.timestamps, self.values)))
+        meta = []
+        for first, last, count, data in chunks:
+            meta.append([first, last, count, len(blob), len(data)])
+            blob.extend(data)
+        return dict(chunks=meta, expired=self.expired)
+
+    def load(self, meta, blob):
+        self.chunks = [(first, last, count, bytes(blob[offset:offset + length]))
+                       for first, last, count, offset, length in meta['chunks']]
+        self.expired = meta['expired']
+
+
+class Rollup(object):
+    """ 按step秒汇总的min/max/sum/count """
+
+    def __init__(self, step, retention, chunk_size):
+        self.step = step
+        self.columns = dict((name, Series(retention, chunk_size))
+                            for name in AGGREGATES)
+        # 正在汇总的时间段：[起始时间, min, max, sum, count]
+        self.current = None
+
+    def add(self, ts, minimum, maximum, total, count):
+        """ 返回刚结束的时间段，交给下一级汇总 """
+        bucket = ts - ts % self.step
+        if self.current is not None and self.current[0] == bucket:
+            cur = self.current
+            cur[1] = min(cur[1], minimum)
+            cur[2] = max(cur[2], maximum)
+            cur[3] += total
+            cur[4] += count
+            return None
+        finished = self.current
+        self.current = [bucket, minimum, maximum, total, count]
+        if finished is not None:
+            for name, value in zip(AGGREGATES, finished[1:]):
+                self.columns[name].append(finished[0], value)
+        return finished
+
+    def points(self, start, end):
+        columns = [self.columns[name].points(start, end) for name in AGGREGATES]
+        for rows in zip(*columns):
+            yield [rows[0][0]] + [value for ts, value in rows]
+        cur = self.current
+        if cur is not None and start <= cur[0] <= end:
+            yield list(cur)
+
+    def first_time(self):
+        first = self.columns['count'].first_time()
+        if first is None and self.current is not None:
+            return self.current[0]
+        return first
+
+    def is_complete(self):
+        return not self.columns['count'].expired
+
+    def expire(self, now):
+        for series in self.columns.values():
+            series.expire(now)
+
+    def nbytes(self):
+        return sum(series.nbytes() for series in self.columns.values())
+
+
+class Metric(object):
+    """ 时间戳都是整数毫秒 """
+
+    def __init__(self, levels):
+        step, retention = levels[0]
+        self.raw = Series(retention * 1000, chunk_size_for(step, retention))
+        self.rollups = [Rollup(step * 1000, retention * 1000, chunk_size_for(step, retention))
+                        for step, retention in levels[1:]]
+
+    def append(self, ts, value):
+        last = self.raw.last_time()
+        if last is not None and ts <= last:
+            return False
+        self.raw.append(ts, value)
+        point = (ts, value, value, value, 1)
+        for rollup in self.rollups:
+            point = rollup.add(*point)
+            if point is None:
+                break
+        return True
+
+    def expire(self, now):
+        self.raw.expire(now)
+        for rollup in self.rollups:
+            rollup.expire(now)
+
+    def nbytes(self):
+        return self.raw.nbytes() + sum(r.nbytes() for r in self.rollups)
+
+    def levels(self):
+        """ [(最早的时间, 是否包含全部历史数据)]，0是原始数据 """
+        return [(self.raw.first_time(), not self.raw.expired)] + \
+            [(r.first_time(), r.is_complete()) for r in self.rollups]
+
+
+def to_ms(ts):
+    return int(round(ts * 1000))
+
+
+def chunk_size_for(step, retention):
+    # 每块约为保留时间的1/24，过期数据按块删除
+    return max(16, retention // step // 24)
+
+
+class TimeSeriesStore(object):
+    """ 接口中的时间都是秒（可以有小数），levels为[(精度秒数, 保留秒数)] """
+
+    def __init__(self, levels=DEFAULT_LEVELS):
+        self.levels = [tuple(level) for level in levels]
+        self.metrics = {}
+
+    def append(self, name, ts, value):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = Metric(self.levels)
+        return metric.append(to_ms(ts), float(value))
+
+    def append_sample(self, ts, sample):
+        """ 保存一次采样中所有数值类型的字段 """
+        for name, value in sample.items():
+            if isinstance(value, numbers.Real) and not isinstance(value, bool):
+                self.append(name, ts, value)
+
+    def names(self):
+        return sorted(self.metrics)
+
+    def choose_level(self, metric, start):
+        """ 覆盖起始时间的最高精度，0是原始数据；都不覆盖时选数据最早的 """
+        levels = metric.levels()
+        best = 0
+        for level, (first, complete) in enumerate(levels):
+            if first is None:
+                continue
+            if first <= start or complete:
+                return level
+            if levels[best][0] is None or first < levels[best][0]:
+                best = level
+        return best
+
+    def query(self, name, start, end, level=None):
+        """ [(时间, 值)]，汇总数据的值为平均值 """
+        metric = self.metrics.get(name)
+        if metric is None:
+            return []
+        start, end = to_ms(start), to_ms(end)
+        if level is None:
+            level = self.choose_level(metric, start)
+        if level == 0:
+            return [(ts / 1000, value) for ts, value in metric.raw.points(start, end)]
+        return [(row[0] / 1000, row[3] / row[4])
+                for row in metric.rollups[level - 1].points(start, end)]
+
+    def aggregate(self, name, start, end, func='avg'):
+        metric = self.metrics.get(name)
+        if metric is None:
+            return None
+        start, end = to_ms(start), to_ms(end)
+        level = self.choose_level(metric, start)
+        if level == 0:
+            rows = [(ts, value, value, value, 1)
+                    for ts, value in metric.raw.points(start, end)]
+        else:
+            rows = list(metric.rollups[level - 1].points(start, end))
+        if not rows:
+            return None
+        if func == 'min':
+            return min(row[1] for row in rows)
+        elif func == 'max':
+            return max(row[2] for row in rows)
+        elif func == 'sum':
+            return sum(row[3] for row in rows)
+        elif func == 'count':
+            return sum(row[4] for row in rows)
+        elif func == 'avg':
+            return sum(row[3] for row in rows) / sum(row[4] for row in rows)
+        elif func == 'last':
+            row = rows[-1]
+            return row[3] / row[4]
+        raise ValueError('unknown aggregate function {0}'.format(func))
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        for metric in self.metrics.values():
+            metric.expire(to_ms(now))
+
+    def nbytes(self):
+        return sum(metric.nbytes() for metric in self.metrics.values())
+
+    def save(self, filename):
+        blob = bytearray()
+        metrics = {}
+        for name, metric in self.metrics.items():
+            metrics[name] = dict(
+                raw=metric.raw.dump(blob),
+                rollups=[dict(current=rollup.current,
+                              columns=dict((col, rollup.columns[col].dump(blob))
+                                           for col in AGGREGATES))
+                         for rollup in metric.rollups])
+        header = json.dumps(dict(levels=self.levels, metrics=metrics)).encode('utf-8')
+        tmpfilename = filename + '.tmp'
+        with open(tmpfilename, 'wb') as f:
+            f.write(MAGIC + str(FORMAT_VERSION).encode('ascii') + b'\n')
+            f.write(struct.pack('>I', len(header)))
+            f.write(header)
+            f.write(blob)
+        os.rename(tmpfilename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            line = f.readline(16)
+            if not line.startswith(MAGIC) or not line.endswith(b'\n'):
+                raise ValueError('{0} is not a tsdb file'.format(filename))
+            try:
+                version = int(line[len(MAGIC):])
+            except ValueError:
+                raise ValueError('{0} is not a tsdb file'.format(filename))
+            if version != FORMAT_VERSION:
+                raise ValueError('{0}: tsdb format version {1} is not supported, '
+                                 'expected {2}'.format(filename, version, FORMAT_VERSION))
+            size = struct.unpack('>I', f.read(4))[0]
+            header = json.loads(f.read(size).decode('utf-8'))
+            blob = f.read()
+        try:
+            store = cls(header['levels'])
+            for name, meta in header['metrics'].items():
+                metric = store.metrics[name] = Metric(store.levels)
+                metric.raw.load(meta['raw'], blob)
+                for rollup, rollup_meta in zip(metric.rollups, meta['rollups']):
+                    rollup.current = rollup_meta['current']
+                    for col in AGGREGATES:
+                        rollup.columns[col].load(rollup_meta['columns'][col], blob)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError('{0}: corrupt tsdb header: {1!r}'.format(filename, e))
+        return store
+
+
+def simulate(hours, metrics, raw_retention):
+    """ 模拟每秒采样一次（带几毫秒的调度抖动），返回保存这些数据的存储 """
+    levels = ((1, raw_retention),) + DEFAULT_LEVELS[1:]
+    store = TimeSeriesStore(levels)
+    now = int(time.time()) - hours * 3600
+    values = [random.uniform(0, 100) for _ in range(metrics)]
+    names = ['metric_{0}'.format(i) for i in range(metrics)]
+    for second in range(hours * 3600):
+        ts = now + second + random.uniform(0, 0.005)
+        for i, name in enumerate(names):
+            # 百分比类指标保留一位小数，缓慢变化
+            values[i] = min(100, max(0, values[i] + random.gauss(0, 0.3)))
+            store.append(name, ts, round(values[i], 1) if i % 2 else math.floor(values[i] * 1e6))
+        if second % 600 == 0:
+            store.expire(ts)
+    store.expire(now + hours * 3600)
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description='time series store demo')
+    parser.add_argument('--hours', type=int, default=24)
+    parser.add_argument('--metrics', type=int, default=50)
+    parser.add_argument('--raw-retention', type=int, default=DEFAULT_LEVELS[0][1],
+                        help='seconds raw points are kept')
+    args = parser.parse_args()
+
+    start = time.time()
+    store = simulate(args.hours, args.metrics, args.raw_retention)
+    elapsed = time.time() - start
+    points = args.hours * 3600 * args.metrics
+    print("{0} points in {1:.1f}s, {2:.1f}us per point".format(
+        points, elapsed, elapsed / points * 1e6))
+    # 还没压缩的点每个占16字节，只用已经压缩的块计算每个点的大小
+    chunks = [chunk for metric in store.metrics.values() for chunk in metric.raw.chunks]
+    if chunks:
+        print("compressed raw points: {0:.2f} bytes per point, {1:.1f} MB per metric "
+              "for a week of per-second samples".format(
+                  sum(len(c[3]) for c in chunks) / sum(c[2] for c in chunks),
+                  sum(len(c[3]) for c in chunks) / sum(c[2] for c in chunks) * 604800 / 1048576.0))
+    print("store size: {0:.2f} MB".format(store.nbytes() / 1048576.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+保存在SQLite中的文件索引（路径、大小、修改时间、md5）
+
+先用find_specific_files遍历一次目录树建立索引，之后由watcher.py的inotify
+事件增量更新，"某个时间之后变化了哪些文件"和"哪些文件匹配*.jpg"这类问题
+直接查询索引，不用再遍历整个目录树：
+
+    $ python file_index.py --db files.db build /data --pattern '*.jpg'
+    $ python file_index.py --db files.db watch /data --pattern '*.jpg'
+    $ python file_index.py --db files.db changed --since 1h
+    $ python file_index.py --db files.db match '*.jpg'
+    $ python file_index.py --db files.db duplicates
+
+删除的文件保留在索引中（deleted=1），changed可以查到它们。
+"""
+from __future__ import print_function
+import argparse
+import fnmatch
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+CHUNK_SIZE = 8192
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    ext TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    hash TEXT,
+    changed_at REAL NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    scan INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS files_changed_at ON files (changed_at);
+CREATE INDEX IF NOT EXISTS files_ext ON files (ext);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def is_file_match(filename, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatch(filename, pattern):
+            return True
+    return False
+
+
+def find_specific_files(root, patterns=['*'], exclude_dirs=[]):
+    for root, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if is_file_match(filename, patterns):
+                yield os.path.join(root, filename)
+
+        for d in exclude_dirs:
+            if d in dirnames:
+                dirnames.remove(d)
+
+
+def get_chunk(filename):
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            else:
+                yield chunk
+
+
+def get_file_checksum(filename):
+    h = hashlib.md5()
+    for chunk in get_chunk(filename):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def get_ext(name):
+    return os.path.splitext(name)[1].lower()
+
+
+def subtree_range(directory):
+    """ 目录下所有路径的范围，'/'的下一个字符是'0'，可以使用主键索引 """
+    directory = directory.rstrip('/')
+    return directory + '/', directory + '0'
+
+
+def parse_since(text):
+    """ 时间戳或者相对时间，如30s、10m、1h、2d """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if text and text[-1] in units:
+        return time.time() - float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+class FileIndex(object):
+
+    def __init__(self, db, patterns=['*'], exclude_dirs=[], use_hash=True,
+                 commit_interval=1.0):
+        self.conn = sqlite3.connect(db, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.patterns = patterns
+        self.exclude_dirs = exclude_dirs
+        self.use_hash = use_hash
+        self.commit_interval = commit_interval
+        self.lock = threading.Lock()
+        self.dirty = 0
+        self.committer = None
+        self.stopped = threading.Event()
+
+    def is_indexed(self, path):
+        parts = path.split(os.sep)
+        if any(d in parts[:-1] for d in self.exclude_dirs):
+            return False
+        return is_file_match(parts[-1], self.patterns)
+
+    def update(self, path, scan=0):
+        """ 文件新建或修改，大小和修改时间都没变时不重新计算md5 """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return self.delete(path)
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, mtime, deleted FROM files WHERE path = ?',
+                (path,)).fetchone()
+        if row is not None and row == (st.st_size, st.st_mtime, 0):
+            if scan:
+                with self.lock:
+                    self.conn.execute('UPDATE files SET scan = ? WHERE path = ?',
+                                      (scan, path))
+            return False
+        # 计算md5时不持有锁，多个工作线程可以同时计算
+        checksum = None
+        if self.use_hash:
+            try:
+                checksum = get_file_checksum(path)
+            except (IOError, OSError):
+                return self.delete(path)
+        name = os.path.basename(path)
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)',
+                (path, name, get_ext(name), st.st_size, st.st_mtime,
+                 checksum, time.time(), scan))
+            self.dirty += 1
+        return True
+
+    def delete(self, path):
+        with self.lock:
+            cur = self.conn.execute(
+                'UPDATE files SET deleted = 1, changed_at = ? '
+                'WHERE path = ? AND deleted = 0', (time.time(), path))
+            self.dirty += cur.rowcount
+        return cur.rowcount > 0
+
+    def delete_tree(self, directory):
+        low, high = subtree_range(directory)
+        with self.lock:
+            cur = self.conn.execute(
+                'UPDATE files SET deleted = 1, changed_at = ? '
+                'WHERE path >= ? AND path < ? AND deleted = 0',
+                (time.time(), low, high))
+            self.dirty += cur.rowcount
+        return cur.rowcount
+
+    def build(self, root):
+        """ 遍历目录树，索引中有而目录树中已经没有的文件标记为删除 """
+        root = os.path.abspath(root)
+        scan = int(time.time() * 1000)
+        changed = 0
+        for path in find_specific_files(root, self.patterns, self.exclude_dirs):
+            if self.update(path, scan):
+                changed += 1
+        low, high = subtree_range(root)
+        with self.lock:
+            cur = self.conn.execute(
+                'UPDATE files SET deleted = 1, changed_at = ? '
+                'WHERE path >= ? AND path < ? AND deleted = 0 AND scan != ?',
+                (time.time(), low, high, scan))
+            self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                              ('built:' + root, str(time.time())))
+        self.commit()
+        return changed + cur.rowcount
+
+    def rescan_dir(self, directory):
+        """ 只检查一个目录下的文件，不递归，用于inotify队列溢出之后 """
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return self.delete_tree(directory)
+        present = set()
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and self.is_indexed(path):
+                present.add(path)
+                self.update(path)
+        low, high = subtree_range(directory)
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT path FROM files WHERE path >= ? AND path < ? AND deleted = 0',
+                (low, high)).fetchall()
+        for path, in rows:
+            if os.path.dirname(path) == directory and path not in present:
+                self.delete(path)
+
+    def handle(self, event):
+        """ watcher.Watcher的处理函数 """
+        # 在函数中导入，只使用索引查询时不需要pyinotify
+        import pyinotify
+        path = event.path
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            self.rescan_dir(path)
+        elif event.mask & pyinotify.IN_ISDIR:
+            if os.path.isdir(path):
+                # 移动进来的目录中已经有文件
+                self.build(path)
+            else:
+                self.delete_tree(path)
+        elif self.is_indexed(path):
+            self.update(path)
+        self.maybe_commit()
+
+    def maybe_commit(self):
+        if self.dirty >= 1000:
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.dirty = 0
+
+    def start_committer(self):
+        """ 事件停止后，最后一批修改也能在commit_interval内写入磁盘 """
+        def run():
+            while not self.stopped.wait(self.commit_interval):
+                if self.dirty:
+                    self.commit()
+        self.committer = threading.Thread(target=run)
+        self.committer.daemon = True
+        self.committer.start()
+
+    def changed_since(self, since):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT path, deleted, changed_at FROM files '
+                'WHERE changed_at > ? ORDER BY changed_at', (since,)).fetchall()
+
+    def match(self, pattern):
+        with self.lock:
+            # *.jpg这样的模式使用扩展名索引
+            ext = pattern[1:]
+            if (pattern.startswith('*.') and
+                    not any(c in ext for c in '*?[') and ext == ext.lower()):
+                return [r[0] for r in self.conn.execute(
+                    'SELECT path FROM files WHERE ext = ? AND deleted = 0 '
+                    'AND name GLOB ?', (ext, pattern))]
+            return [r[0] for r in self.conn.execute(
+                'SELECT path FROM files WHERE name GLOB ? AND deleted = 0',
+                (pattern,))]
+
+    def duplicates(self):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT hash, path FROM files WHERE deleted = 0 AND hash IN '
+                '(SELECT hash FROM files WHERE deleted = 0 AND hash IS NOT NULL '
+                'GROUP BY hash HAVING count(*) > 1) ORDER BY hash').fetchall()
+        groups = {}
+        for checksum, path in rows:
+            groups.setdefault(checksum, []).append(path)
+        return list(groups.values())
+
+    def close(self):
+        self.stopped.set()
+        if self.committer is not None:
+            self.committer.join()
+        self.commit()
+        self.conn.close()
+
+
+def watch(index, root, args):
+    from watcher import Watcher
+    watcher = Watcher(index.handle, args.window, args.workers)
+    # 先开始监控再遍历，遍历期间的修改不会丢失
+    watcher.watch(root)
+    print("indexed {0} changes".format(index.build(root)))
+    index.start_committer()
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='incremental file index')
+    parser.add_argument('--db', default='files.db')
+    sub = parser.add_subparsers(dest='command')
+
+    for name in ('build', 'watch'):
+        p = sub.add_parser(name)
+        p.add_argument('root')
+        p.add_argument('--pattern', action='append')
+        p.add_argument('--exclude-dir', action='append', default=[])
+        p.add_argument('--no-hash', action='store_true')
+        p.add_argument('--window', type=float, default=0.5)
+        p.add_argument('--workers', type=int, default=4)
+    p = sub.add_parser('changed')
+    p.add_argument('--since', required=True,
+                   help='timestamp or relative time such as 10m, 1h')
+    p = sub.add_parser('match')
+    p.add_argument('pattern')
+    sub.add_parser('duplicates')
+    args = parser.parse_args()
+
+    if args.command in ('build', 'watch'):
+        index = FileIndex(args.db, args.pattern or ['*'], args.exclude_dir,
+                          not args.no_hash)
+        root = os.path.abspath(args.root)
+        if args.command == 'build':
+            print("indexed {0} changes".format(index.build(root)))
+        else:
+            watch(index, root, args)
+    else:
+        index = FileIndex(args.db)
+        if args.command == 'changed':
+            for path, deleted, changed_at in index.changed_since(parse_since(args.since)):
+                print("{0} {1}".format('D' if deleted else 'M', path))
+        elif args.command == 'match':
+            for path in index.match(args.pattern):
+                print(path)
+        elif args.command == 'duplicates':
+            for paths in index.duplicates():
+                print('find duplicate file: {0}'.format(' vs '.join(paths)))
+        else:
+            parser.print_help()
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
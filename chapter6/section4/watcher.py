@@ -0,0 +1,197 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+test_pynotify.py的服务版本：批量读取inotify事件，合并同一个文件在一个时间
+窗口内的多次事件，再交给线程池中的处理函数
+
+- 每次醒来等待read_delay后一次读出内核队列中的所有事件，减少系统调用
+- 同一路径在window秒内的事件合并为一个，掩码按位或，记录最后一次事件
+- 同一路径总是交给同一个工作线程，处理顺序与事件顺序一致
+- 内核队列溢出（IN_Q_OVERFLOW）时会丢失事件，此时对最近有活动的目录
+  发出一个rescan事件（mask为IN_Q_OVERFLOW|IN_ISDIR），由处理函数重新扫描
+
+    $ python watcher.py /tmp --window 0.5 --workers 4
+"""
+from __future__ import print_function
+import argparse
+import collections
+import os
+import threading
+import time
+import warnings
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+with warnings.catch_warnings():
+    # pyinotify在Python 3.6以后导入asyncore会有DeprecationWarning
+    warnings.simplefilter('ignore')
+    import pyinotify
+
+DEFAULT_MASK = (pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_FROM |
+                pyinotify.IN_MOVED_TO)
+
+WatchEvent = collections.namedtuple('WatchEvent', 'path mask last count first_time')
+
+
+def mask_names(mask):
+    """ 与EventsCodes.maskname不同，支持多个事件按位或的掩码 """
+    return '|'.join(name for value, name in
+                    sorted(pyinotify.EventsCodes.ALL_VALUES.items())
+                    if mask & value and value & (value - 1) == 0)
+
+
+class Coalescer(pyinotify.ProcessEvent):
+    """ 由pyinotify调用，只把事件记录下来，不做任何耗时的处理 """
+
+    def my_init(self, watcher):
+        self.watcher = watcher
+
+    def process_IN_Q_OVERFLOW(self, event):
+        self.watcher.overflow()
+
+    def process_default(self, event):
+        self.watcher.add(event.pathname, event.mask, event.path)
+
+
+class Watcher(object):
+
+    def __init__(self, handler, window=0.5, workers=4, read_delay=0.01,
+                 max_pending=100000, active_dirs=1024, rescan_age=60):
+        self.handler = handler
+        self.window = window
+        self.read_delay = read_delay
+        self.max_pending = max_pending
+        self.active_size = active_dirs
+        self.rescan_age = rescan_age
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.wm, Coalescer(watcher=self))
+        # 路径 -> [掩码, 最后一次事件, 次数, 第一次事件的时间]，按第一次出现的顺序
+        self.pending = collections.OrderedDict()
+        # 最近有事件的目录，溢出时只重新扫描这些目录
+        self.active = collections.OrderedDict()
+        self.queues = [queue.Queue() for _ in range(workers)]
+        self.threads = []
+        self.stopped = threading.Event()
+        self.stats = collections.Counter()
+
+    def watch(self, path, mask=DEFAULT_MASK):
+        self.wm.add_watch(path, mask | pyinotify.IN_Q_OVERFLOW,
+                          rec=True, auto_add=True)
+
+    def add(self, path, mask, directory):
+        self.stats['events'] += 1
+        item = self.pending.get(path)
+        if item is None:
+            self.pending[path] = [mask, mask, 1, time.time()]
+        else:
+            item[0] |= mask
+            item[1] = mask
+            item[2] += 1
+            self.stats['coalesced'] += 1
+        self.active.pop(directory, None)
+        self.active[directory] = time.time()
+        if len(self.active) > self.active_size:
+            self.active.popitem(last=False)
+
+    def overflow(self):
+        self.stats['overflows'] += 1
+        now = time.time()
+        mask = pyinotify.IN_Q_OVERFLOW | pyinotify.IN_ISDIR
+        for directory, last_seen in list(self.active.items()):
+            if now - last_seen <= self.rescan_age and os.path.isdir(directory):
+                # 溢出期间新建的子目录可能还没有被监控
+                self.wm.add_watch(directory, DEFAULT_MASK | pyinotify.IN_Q_OVERFLOW,
+                                  rec=True, auto_add=True)
+                self.pending.pop(directory, None)
+                self.pending[directory] = [mask, mask, 1, now]
+
+    def flush(self, force=False):
+        """ 把超过时间窗口的事件交给工作线程 """
+        deadline = time.time() - self.window
+        pending = self.pending
+        while pending:
+            path, item = next(iter(pending.items()))
+            if not force and item[3] > deadline and len(pending) <= self.max_pending:
+                break
+            del pending[path]
+            event = WatchEvent(path, item[0], item[1], item[2], item[3])
+            # 同一路径总是由同一个线程处理
+            self.queues[hash(path) % len(self.queues)].put(event)
+            self.stats['dispatched'] += 1
+
+    def worker(self, q):
+        while True:
+            event = q.get()
+            if event is None:
+                break
+            try:
+                self.handler(event)
+            except Exception as e:
+                self.stats['errors'] += 1
+                print("handler failed on {0}: {1}".format(event.path, e))
+
+    def run(self):
+        for q in self.queues:
+            thr = threading.Thread(target=self.worker, args=(q,))
+            thr.daemon = True
+            thr.start()
+            self.threads.append(thr)
+
+        timeout = int(self.window * 1000)
+        try:
+            while not self.stopped.is_set():
+                if self.notifier.check_events(timeout):
+                    if self.read_delay:
+                        # 稍等片刻，让更多的事件在内核中排队，一次读出
+                        time.sleep(self.read_delay)
+                    self.notifier.read_events()
+                    self.notifier.process_events()
+                    self.stats['reads'] += 1
+                self.flush()
+        finally:
+            # 处理完已经收到的事件再退出
+            self.flush(force=True)
+            for q in self.queues:
+                q.put(None)
+            for thr in self.threads:
+                thr.join()
+            self.notifier.stop()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def print_event(event):
+    if event.mask & pyinotify.IN_Q_OVERFLOW:
+        print("Rescan:", event.path)
+    else:
+        print("{0}: {1} ({2} events)".format(mask_names(event.mask),
+                                             event.path, event.count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='coalescing inotify watcher')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--window', type=float, default=0.5,
+                        help='seconds events of one path are merged')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--read-delay', type=float, default=0.01,
+                        help='seconds to wait before reading a batch')
+    args = parser.parse_args()
+
+    watcher = Watcher(print_event, args.window, args.workers, args.read_delay)
+    for path in args.paths:
+        watcher.watch(path)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    print(dict(watcher.stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+monitor_mongodb.py的常驻版本：同时监控多个MongoDB集群
+
+- 每个集群只创建一个MongoClient，一直复用其中的连接池
+- 每轮用线程池并发执行isMaster、serverStatus和replSetGetStatus
+- 根据上一轮的结果计算每秒操作数（opcounters）和复制延迟
+- 结果可以保存到chapter6/section3/tsdb.py的时序存储中
+
+集群在配置文件中，每个集群一节：
+
+    [rs0]
+    uri = mongodb://127.0.0.1:27017/?replicaSet=rs0
+
+    $ python mongodb_monitor.py --config clusters.cfg --interval 60
+    $ python mongodb_monitor.py --config clusters.cfg --once
+"""
+from __future__ import division
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+import pymongo
+from pymongo.errors import OperationFailure, PyMongoError
+
+OPCOUNTERS = ('insert', 'query', 'update', 'delete', 'getmore', 'command')
+# replSetGetStatus返回这些错误码时说明不是副本集：mongos上没有这个命令，
+# 单机模式没有开启复制
+NO_REPLSET_CODES = (59, 76)
+
+
+def load_clusters(filename):
+    parser = configparser.ConfigParser()
+    parser.read(filename)
+    return dict((name, parser.get(name, 'uri')) for name in parser.sections())
+
+
+def load_store_class():
+    """ 时序存储在chapter6/section3中，没有时只打印结果 """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, 'section3')
+    sys.path.append(os.path.normpath(path))
+    try:
+        from tsdb import TimeSeriesStore
+    except ImportError:
+        return None
+    return TimeSeriesStore
+
+
+def replication_lag(status):
+    """ 主节点与最慢的从节点之间optime的差距（秒） """
+    members = status.get('members', [])
+    primary = [m['optimeDate'] for m in members if m.get('stateStr') == 'PRIMARY']
+    secondaries = [m['optimeDate'] for m in members if m.get('stateStr') == 'SECONDARY']
+    if not primary or not secondaries:
+        return None
+    return max((primary[0] - s).total_seconds() for s in secondaries)
+
+
+class ClusterMonitor(object):
+
+    def __init__(self, name, uri, client_factory=pymongo.MongoClient, timeout_ms=5000):
+        self.name = name
+        self.uri = uri
+        # MongoClient创建后在后台维护连接池，整个进程只创建一次
+        self.client = client_factory(uri,
+                                     serverSelectionTimeoutMS=timeout_ms,
+                                     connectTimeoutMS=timeout_ms,
+                                     socketTimeoutMS=timeout_ms,
+                                     maxPoolSize=2,
+                                     appname='mongodb_monitor')
+        self.prev_opcounters = None
+        self.prev_time = None
+        self.prev_uptime = None
+
+    def poll(self):
+        now = time.time()
+        admin = self.client.admin
+        try:
+            is_master = admin.command('isMaster')
+            server_status = admin.command('serverStatus')
+        except PyMongoError as e:
+            return dict(cluster=self.name, time=now, up=0, error=str(e))
+        metrics = dict(cluster=self.name, time=now, up=1,
+                       ismaster=int(bool(is_master.get('ismaster'))),
+                       uptime=server_status.get('uptime', 0),
+                       connections=server_status.get('connections', {}).get('current', 0))
+        try:
+            repl_status = admin.command('replSetGetStatus')
+        except OperationFailure as e:
+            repl_status = {}
+            if e.code not in NO_REPLSET_CODES:
+                metrics['error'] = 'replSetGetStatus: {0}'.format(e)
+        except PyMongoError as e:
+            # 前两个命令之后节点不可用（超时、主从切换等），只返回已经拿到的指标
+            repl_status = {}
+            metrics['error'] = 'replSetGetStatus: {0}'.format(e)
+
+        members = repl_status.get('members', [])
+        if members:
+            metrics['members'] = len(members)
+            metrics['members_healthy'] = sum(1 for m in members if m.get('health') == 1)
+            lag = replication_lag(repl_status)
+            if lag is not None:
+                metrics['repl_lag'] = lag
+        metrics.update(self.op_rates(server_status, now))
+        return metrics
+
+    def op_rates(self, server_status, now):
+        counters = server_status.get('opcounters', {})
+        uptime = server_status.get('uptime', 0)
+        prev, prev_time, prev_uptime = self.prev_opcounters, self.prev_time, self.prev_uptime
+        self.prev_opcounters, self.prev_time, self.prev_uptime = counters, now, uptime
+        # 第一次采样或者mongod重启后，没有可以比较的计数器
+        if prev is None or uptime < prev_uptime or now <= prev_time:
+            return {}
+        interval = now - prev_time
+        rates = {}
+        for op in OPCOUNTERS:
+            delta = counters.get(op, 0) - prev.get(op, 0)
+            if delta >= 0:
+                rates['ops_' + op] = delta / interval
+        return rates
+
+    def close(self):
+        self.client.close()
+
+
+class MongoMonitor(object):
+
+    def __init__(self, clusters, threads=16, store=None,
+                 client_factory=pymongo.MongoClient):
+        self.monitors = [ClusterMonitor(name, uri, client_factory)
+                         for name, uri in sorted(clusters.items())]
+        self.pool = ThreadPool(min(threads, len(self.monitors)) or 1)
+        self.store = store
+
+    def poll(self):
+        results = self.pool.map(lambda m: m.poll(), self.monitors)
+        if self.store is not None:
+            for metrics in results:
+                self.store.append_sample(metrics['time'], dict(
+                    ('{0}.{1}'.format(metrics['cluster'], k), v)
+                    for k, v in metrics.items()
+                    if k not in ('cluster', 'time', 'error')))
+        return results
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for monitor in self.monitors:
+            monitor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='monitor MongoDB clusters')
+    parser.add_argument('--config', default='clusters.cfg')
+    parser.add_argument('--interval', type=float, default=60)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--store',
+                        help='save metrics into this time series file')
+    parser.add_argument('--once', action='store_true',
+                        help='poll once and exit')
+    args = parser.parse_args()
+
+    store = None
+    if args.store:
+        store_class = load_store_class()
+        if store_class is None:
+            print("tsdb.py not found, metrics are only printed")
+        elif os.path.exists(args.store):
+            store = store_class.load(args.store)
+        else:
+            store = store_class()
+
+    monitor = MongoMonitor(load_clusters(args.config), args.threads, store)
+    next_time = time.time()
+    try:
+        while True:
+            for metrics in monitor.poll():
+                print(json.dumps(metrics, sort_keys=True))
+            if store is not None:
+                store.expire()
+                store.save(args.store)
+            if args.once:
+                break
+            next_time += args.interval
+            time.sleep(max(0, next_time - time.time()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+不启动ping进程，在一个线程中直接收发ICMP报文判断主机是否存活
+
+- root用户使用原始套接字；普通用户在net.ipv4.ping_group_range允许时使用
+  SOCK_DGRAM类型的ICMP套接字；两者都不可用时退回到ping.py的ping命令
+- 按--rate限制每秒发送的报文数，根据标识符和序号匹配应答
+- 输出每台主机的丢包率和最小/平均/最大往返时间
+
+    $ python icmp_ping.py                       # 读取ips.txt
+    $ python icmp_ping.py 192.168.0.0/24 10.0.0.1 --count 3 --rate 500
+    $ python icmp_ping.py 127.0.0.0/24 --method subprocess
+"""
+from __future__ import division
+from __future__ import print_function
+import argparse
+import errno
+import os
+import re
+import select
+import socket
+import struct
+import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import ipaddress
+except ImportError:
+    ipaddress = None
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMP_HEADER = struct.Struct('!BBHHH')
+
+
+class PingResult(object):
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.sent = 0
+        self.rtts = []
+        # ping本身出错（如找不到ping命令）时的错误信息，与没有应答区分
+        self.error = None
+
+    @property
+    def received(self):
+        return len(self.rtts)
+
+    @property
+    def alive(self):
+        return bool(self.rtts)
+
+    @property
+    def loss(self):
+        return 1 - self.received / self.sent if self.sent else 1.0
+
+    def summary(self):
+        if self.error:
+            return "{0} ping failed: {1}".format(self.ip, self.error)
+        if not self.rtts:
+            return "{0} is unreacheable ({1} sent, 100% loss)".format(self.ip, self.sent)
+        return "{0} is alive ({1}/{2} received, {3:.0%} loss, rtt min/avg/max {4:.3f}/{5:.3f}/{6:.3f} ms)".format(
+            self.ip, self.received, self.sent, self.loss, min(self.rtts) * 1000,
+            sum(self.rtts) / len(self.rtts) * 1000, max(self.rtts) * 1000)
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def build_packet(ident, seq, payload):
+    header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    return ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, checksum(header + payload),
+                            ident, seq) + payload
+
+
+def open_socket():
+    """ 返回(套接字, 是否为原始套接字)，都不允许时返回(None, None) """
+    for kind in (socket.SOCK_RAW, socket.SOCK_DGRAM):
+        try:
+            return socket.socket(socket.AF_INET, kind, socket.IPPROTO_ICMP), kind == socket.SOCK_RAW
+        except socket.error as e:
+            if e.errno not in (errno.EPERM, errno.EACCES, errno.EPROTONOSUPPORT):
+                raise
+    return None, None
+
+
+def expand_targets(targets):
+    """ 支持单个地址和192.168.0.0/24这样的网段 """
+    ips = []
+    for target in targets:
+        target = target.strip()
+        if not target:
+            continue
+        if '/' in target:
+            if ipaddress is None:
+                raise SystemExit("network {0} needs the ipaddress module".format(target))
+            network = ipaddress.ip_network(u'' + target, strict=False)
+            hosts = list(network.hosts()) or [network.network_address]
+            ips.extend(str(ip) for ip in hosts)
+        else:
+            ips.append(socket.gethostbyname(target))
+    return ips
+
+
+class IcmpPinger(object):
+
+    def __init__(self, rate=1000, timeout=1.0, count=1, payload_size=32):
+        self.rate = rate
+        self.timeout = timeout
+        self.count = count
+        self.payload = b'Q' * payload_size
+        self.ident = os.getpid() & 0xffff
+        self.sock, self.raw = open_socket()
+        if self.sock is not None:
+            self.sock.setblocking(False)
+            # 扫描大网段时应答集中到达
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+
+    @property
+    def available(self):
+        return self.sock is not None
+
+    def ping(self, ips):
+        results = dict((ip, PingResult(ip)) for ip in ips)
+        # (ip, 序号) -> 发送时间
+        outstanding = {}
+        probes = [ip for _ in range(self.count) for ip in ips]
+        seq = 0
+        start = time.time()
+        sent = 0
+        deadline = None
+        while sent < len(probes) or outstanding:
+            now = time.time()
+            # 按速率发送到期的报文
+            while sent < len(probes) and (not self.rate or start + sent / self.rate <= now):
+                ip = probes[sent]
+                seq = (seq + 1) & 0xffff
+                try:
+                    self.sock.sendto(build_packet(self.ident, seq, self.payload), (ip, 0))
+                    outstanding[(ip, seq)] = time.time()
+                except socket.error:
+                    # 没有路由等错误，算作丢包
+                    pass
+                results[ip].sent += 1
+                sent += 1
+                now = time.time()
+            if sent == len(probes) and deadline is None:
+                deadline = now + self.timeout
+
+            if sent < len(probes):
+                wait = max(0, start + sent / self.rate - now)
+            else:
+                wait = deadline - now
+                if wait <= 0:
+                    break
+            readable, _, _ = select.select([self.sock], [], [], wait)
+            if readable:
+                self.receive(outstanding, results)
+            self.expire(outstanding, time.time())
+        return [results[ip] for ip in ips]
+
+    def receive(self, outstanding, results):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(2048)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            now = time.time()
+            if self.raw:
+                # 原始套接字收到的数据包含IP头
+                data = data[(ord(data[:1]) & 0x0f) * 4:]
+            if len(data) < ICMP_HEADER.size:
+                continue
+            icmp_type, _, _, ident, seq = ICMP_HEADER.unpack_from(data)
+            # SOCK_DGRAM套接字的标识符由内核改写，只会收到自己的应答
+            if icmp_type != ICMP_ECHO_REPLY or (self.raw and ident != self.ident):
+                continue
+            sent_at = outstanding.pop((addr[0], seq), None)
+            if sent_at is not None:
+                results[addr[0]].rtts.append(now - sent_at)
+
+    def expire(self, outstanding, now):
+        for key in [k for k, t in outstanding.items() if now - t > self.timeout]:
+            del outstanding[key]
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+
+
+RTT_RE = re.compile(r'= [\d.]+/([\d.]+)/')
+RECEIVED_RE = re.compile(r'(\d+) received')
+
+
+def subprocess_ping(ip, count, timeout):
+    """ 与ping.py相同的方法，ping命令的返回值为0表示主机存活 """
+    result = PingResult(ip)
+    result.sent = count
+    try:
+        proc = subprocess.Popen(['ping', '-n', '-q', '-c', str(count),
+                                 '-W', str(max(1, int(round(timeout)))), ip],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        result.error = str(e)
+        return result
+    out, err = proc.communicate()
+    output = out.decode('utf-8', 'replace')
+    received = RECEIVED_RE.search(output)
+    rtt = RTT_RE.search(output)
+    if proc.returncode == 0 and received and rtt:
+        # ping -q只输出平均时间
+        result.rtts = [float(rtt.group(1)) / 1000] * int(received.group(1))
+    elif proc.returncode not in (0, 1):
+        # 返回1表示没有应答，其他值表示ping本身出错，如地址无法解析
+        result.error = (err.decode('utf-8', 'replace').strip() or
+                        'ping exited with {0}'.format(proc.returncode))
+    return result
+
+
+def subprocess_ping_all(ips, count, timeout, workers=10):
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(lambda ip: subprocess_ping(ip, count, timeout), ips)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ICMP echo sweep')
+    parser.add_argument('targets', nargs='*',
+                        help='addresses or networks, default read ips.txt')
+    parser.add_argument('--count', type=int, default=1,
+                        help='echo requests sent to every host')
+    parser.add_argument('--rate', type=int, default=1000,
+                        help='echo requests per second, 0 for unlimited')
+    parser.add_argument('--timeout', type=float, default=1.0,
+                        help='seconds to wait for the last reply')
+    parser.add_argument('--method', choices=('auto', 'socket', 'subprocess'),
+                        default='auto')
+    parser.add_argument('--workers', type=int, default=10,
+                        help='threads used by the subprocess method')
+    parser.add_argument('--alive-only', action='store_true')
+    args = parser.parse_args()
+
+    targets = args.targets
+    if not targets:
+        with open('ips.txt') as f:
+            targets = f.readlines()
+    ips = expand_targets(targets)
+
+    start = time.time()
+    pinger = None
+    if args.method != 'subprocess':
+        pinger = IcmpPinger(args.rate, args.timeout, args.count)
+        if not pinger.available:
+            if args.method == 'socket':
+                raise SystemExit("ICMP sockets are not permitted, "
+                                 "run as root or check net.ipv4.ping_group_range")
+            pinger = None
+    if pinger is not None:
+        results = pinger.ping(ips)
+        pinger.close()
+    else:
+        results = subprocess_ping_all(ips, args.count, args.timeout, args.workers)
+
+    for result in results:
+        if result.alive or not args.alive_only:
+            print(result.summary())
+    print("{0} of {1} hosts alive in {2:.2f}s ({3})".format(
+        sum(1 for r in results if r.alive), len(results), time.time() - start,
+        'raw socket' if pinger and pinger.raw else
+        'icmp socket' if pinger else 'ping command'))
+
+
+if __name__ == '__main__':
+    main()
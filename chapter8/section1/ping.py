@@ -1,24 +1,45 @@
 from __future__ import print_function
+import os
 import subprocess
 import threading
 
-def is_reacheable(ip):
-    if subprocess.call(["ping", "-c", "1", ip]):
-        print("{0} is alive".format(ip))
-    else:
-        print("{0} is unreacheable".format(ip))
+def is_reacheable(ip, results):
+    # results[ip] is (alive, error); ping returns 0 when a reply was received
+    with open(os.devnull, 'w') as devnull:
+        try:
+            rc = subprocess.call(["ping", "-c", "1", ip],
+                                 stdout=devnull, stderr=devnull)
+        except OSError as e:
+            # no ping binary: an error, not an unreachable host
+            results[ip] = (False, str(e))
+            return
+    results[ip] = (rc == 0, None)
 
 def main():
     with open('ips.txt') as f:
-        lines = f.readlines()
-        threads = []
-        for line in lines:
-            thr = threading.Thread(target=is_reacheable, args=(line,))
-            thr.start()
-            threads.append(thr)
+        ips = [line.strip() for line in f if line.strip()]
 
-        for thr in threads:
-            thr.join()
+    results = {}
+    threads = []
+    for ip in ips:
+        thr = threading.Thread(target=is_reacheable, args=(ip, results))
+        thr.start()
+        threads.append(thr)
+
+    for thr in threads:
+        thr.join()
+
+    errors = []
+    for ip in ips:
+        alive, error = results[ip]
+        if error:
+            errors.append((ip, error))
+        elif alive:
+            print("{0} is alive".format(ip))
+        else:
+            print("{0} is unreacheable".format(ip))
+    for ip, error in errors:
+        print("{0} ping failed: {1}".format(ip, error))
 
 if __name__ == '__main__':
     main()
@@ -1,37 +1,146 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+固定数量的线程从队列中取出地址，调用ping命令检查主机是否存活
+
+每个地址的结果是一条记录（host, reachable, rtt, error），按ips.txt中的顺序
+输出为文本、JSON（每行一条）或CSV：
+
+    $ python ping_with_queue.py
+    $ python ping_with_queue.py --workers 50 --format json > result.json
+    $ python ping_with_queue.py --benchmark 10000 --benchmark-workers 10,50,200
+"""
 from __future__ import print_function
+import argparse
+import csv
+import json
+import re
 import subprocess
+import sys
 import threading
-from Queue import Queue
-from Queue import Empty
+import time
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
-def call_ping(ip):
-    if subprocess.call(["ping", "-c", "1", ip]):
-        print("{0} is alive".format(ip))
-    else:
-        print("{0} is unreacheable".format(ip))
+FIELDS = ('host', 'reachable', 'rtt', 'error')
+RTT_RE = re.compile(r'time[=<]([\d.]+) ?ms')
 
-def is_reacheable(q):
+
+def call_ping(ip, timeout=1):
+    """ ping命令返回0表示收到了应答，rtt的单位为毫秒 """
     try:
-        while True:
-            ip = q.get_nowait()
-            call_ping(ip)
-    except Empty:
-        pass
+        proc = subprocess.Popen(["ping", "-n", "-c", "1", "-W", str(timeout), ip],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        return dict(host=ip, reachable=False, rtt=None, error=str(e))
+    out, err = proc.communicate()
+    if proc.returncode == 0:
+        match = RTT_RE.search(out.decode('utf-8', 'replace'))
+        return dict(host=ip, reachable=True,
+                    rtt=float(match.group(1)) if match else None, error=None)
+    # 返回1表示没有应答，其他值表示ping本身出错，如地址无法解析
+    error = err.decode('utf-8', 'replace').strip()
+    if not error:
+        error = 'no reply' if proc.returncode == 1 else 'ping exited with {0}'.format(proc.returncode)
+    return dict(host=ip, reachable=False, rtt=None, error=error)
 
-def main():
-    q = Queue()
-    with open('ips.txt') as f:
-        for line in f:
-            q.put(line)
+
+def is_reacheable(q, results, timeout):
+    while True:
+        item = q.get()
+        # None表示所有地址都已经分配完
+        if item is None:
+            break
+        index, ip = item
+        results[index] = call_ping(ip, timeout)
+
+
+def sweep(ips, workers=10, timeout=1):
+    """ 返回与ips顺序相同的结果记录 """
+    # 有界队列：生产者在队列满时阻塞，不会一次把所有地址放进内存
+    q = Queue(maxsize=workers * 2)
+    results = [None] * len(ips)
 
     threads = []
-    for i in range(10):
-        thr = threading.Thread(target=is_reacheable, args=(q,))
+    for i in range(workers):
+        thr = threading.Thread(target=is_reacheable, args=(q, results, timeout))
         thr.start()
         threads.append(thr)
 
+    for item in enumerate(ips):
+        q.put(item)
+    for thr in threads:
+        q.put(None)
+
     for thr in threads:
         thr.join()
+    return results
+
+
+def read_ips(filename):
+    with open(filename) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def write_results(results, fmt, out=sys.stdout):
+    if fmt == 'json':
+        for record in results:
+            out.write(json.dumps(record) + '\n')
+    elif fmt == 'csv':
+        writer = csv.DictWriter(out, FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+    else:
+        for record in results:
+            if record['reachable']:
+                out.write("{0} is alive\n".format(record['host']))
+            else:
+                out.write("{0} is unreacheable ({1})\n".format(record['host'], record['error']))
+
+
+def benchmark(count, worker_counts, timeout, unreachable=0.1):
+    # 127.0.0.0/8中的地址都在本机，每个地址都会有应答；198.18.0.0/15是
+    # 测试用的地址段，一般不会有应答，每个地址都要等待超时
+    step = int(1 / unreachable) if unreachable else 0
+    ips = []
+    for i in range(1, count + 1):
+        if step and i % step == 0:
+            ips.append('198.{0}.{1}.{2}'.format(18 + (i >> 16 & 1), i >> 8 & 0xff, (i & 0xff) or 1))
+        else:
+            ips.append('127.{0}.{1}.{2}'.format(i >> 16 & 0xff, i >> 8 & 0xff, (i & 0xff) or 1))
+    for workers in worker_counts:
+        start = time.time()
+        results = sweep(ips, workers, timeout)
+        elapsed = time.time() - start
+        print("{0} addresses, {1:>4} workers: {2:.2f}s ({3:.0f}/s), {4} reachable".format(
+            count, workers, elapsed, count / elapsed,
+            sum(1 for r in results if r['reachable'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ping sweep with a worker queue')
+    parser.add_argument('--file', default='ips.txt')
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--timeout', type=int, default=1,
+                        help='seconds to wait for a reply')
+    parser.add_argument('--format', choices=('text', 'json', 'csv'), default='text')
+    parser.add_argument('--benchmark', type=int, default=0,
+                        help='sweep N test addresses and report the time')
+    parser.add_argument('--benchmark-workers', default='10,50,100,200')
+    parser.add_argument('--benchmark-unreachable', type=float, default=0.1,
+                        help='fraction of benchmark addresses that do not reply')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark,
+                  [int(n) for n in args.benchmark_workers.split(',')],
+                  args.timeout, args.benchmark_unreachable)
+        return
+
+    write_results(sweep(read_ips(args.file), args.workers, args.timeout), args.format)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,296 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""
+发现网络中的主机：ping扫描网段，再并发扫描存活主机的端口，结果保存在SQLite
+数据库中
+
+- ping使用chapter8/section1/icmp_ping.py，端口扫描使用scan_port_with_selectors.py，
+  所有主机的端口在一个扫描中并发进行
+- 数据库中记录每台主机最后一次ping和端口扫描的时间，再次运行时只处理过期的
+  主机：ping结果超过--ping-age、端口扫描结果超过--scan-age，或者扫描的端口
+  列表发生了变化的主机才重新扫描；其他存活的主机只检查已知开放的端口，有
+  端口关闭时重新扫描所有端口
+- hosts表的前五列与chapter10/section3/create_table.sql相同，可以直接作为
+  Ansible动态inventory的数据源：
+
+    $ sudo python3 discover.py 192.168.1.0/24 --ports 22,80,443,3306 --group webservers
+    $ python3 discover.py --show
+    $ python ../../chapter10/section3/hosts.py --sqlite hosts.db --list
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+from scan_port_with_asyncio import parse_ports, raise_nofile_limit
+from scan_port_with_selectors import Scanner
+
+sys.path.append(os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'section1')))
+from icmp_ping import IcmpPinger, expand_targets, subprocess_ping_all
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    host TEXT UNIQUE NOT NULL,
+    groupname TEXT,
+    username TEXT,
+    port INTEGER DEFAULT 22,
+    alive INTEGER NOT NULL DEFAULT 0,
+    rtt REAL,
+    first_seen REAL,
+    last_seen REAL,
+    last_ping REAL,
+    last_scan REAL,
+    scanned_ports TEXT
+);
+CREATE TABLE IF NOT EXISTS ports (
+    host TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (host, port)
+);
+"""
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def format_ports(ports):
+    return ','.join(str(p) for p in sorted(ports))
+
+
+def load_hosts(conn):
+    """ 返回host -> 数据库中的记录（dict） """
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute('SELECT * FROM hosts').fetchall()
+    finally:
+        conn.row_factory = None
+    return dict((row['host'], dict(row)) for row in rows)
+
+
+def load_open_ports(conn):
+    ports = {}
+    for host, port in conn.execute('SELECT host, port FROM ports'):
+        ports.setdefault(host, set()).add(port)
+    return ports
+
+
+def ping_hosts(ips, args):
+    """ 返回ip -> 往返时间（秒），没有应答的主机为None """
+    pinger = IcmpPinger(args.rate, args.timeout, args.count)
+    if pinger.available:
+        results = pinger.ping(ips)
+        pinger.close()
+    else:
+        results = subprocess_ping_all(ips, args.count, args.timeout, args.workers)
+        if results and all(r.error for r in results):
+            raise SystemExit("ping failed: {0}".format(results[0].error))
+    # ping出错的主机不在结果中，保留之前的状态，不当作下线
+    return dict((r.ip, min(r.rtts) if r.rtts else None)
+                for r in results if not r.error)
+
+
+def scan_hosts(targets, args):
+    """ targets为(host, port)的列表，返回host -> 开放的端口集合 """
+    found = {}
+
+    def record(result):
+        ports = found.setdefault(result.host, set())
+        if result.state == 'open':
+            ports.add(result.port)
+
+    scanner = Scanner(timeout=args.scan_timeout, max_concurrency=args.max_concurrency,
+                      pps=args.pps)
+    try:
+        scanner.scan_targets(targets, record)
+    finally:
+        scanner.close()
+    return found
+
+
+class Discovery(object):
+
+    def __init__(self, conn, args):
+        self.conn = conn
+        self.args = args
+        self.known = load_hosts(conn)
+        self.open_ports = load_open_ports(conn)
+        # host -> new/up/down/changed/cached，用于输出
+        self.status = {}
+
+    def run(self, ips, ports):
+        args = self.args
+        now = time.time()
+        wanted = format_ports(ports)
+
+        # 第一步：ping没有记录或者记录过期的主机
+        stale = [ip for ip in ips if ip not in self.known or
+                 now - (self.known[ip]['last_ping'] or 0) > args.ping_age]
+        if args.skip_ping:
+            # 禁止ICMP的网络中认为所有主机都存活，由端口扫描决定
+            rtts = dict((ip, None) for ip in stale)
+        else:
+            rtts = ping_hosts(stale, args)
+        # 不在rtts中的主机没有ping（记录未过期）或者ping出错，保留原来的状态；
+        # 出错的新地址不在known中，不认为存活
+        alive = set(ip for ip in ips if ip not in rtts and
+                    ip in self.known and self.known[ip]['alive'])
+        alive.update(ip for ip in stale if args.skip_ping or rtts.get(ip) is not None)
+
+        # 第二步：端口扫描。过期的主机扫描所有端口，其他主机只检查已知
+        # 开放的端口
+        full = set(ip for ip in alive if ip not in self.known or
+                   not self.known[ip]['alive'] or
+                   self.known[ip]['scanned_ports'] != wanted or
+                   now - (self.known[ip]['last_scan'] or 0) > args.scan_age)
+        verify = dict((ip, self.open_ports.get(ip, set())) for ip in alive - full)
+        targets = [(ip, port) for ip in sorted(full) for port in ports]
+        targets += [(ip, port) for ip, known in sorted(verify.items()) for port in sorted(known)]
+        found = scan_hosts(targets, args)
+
+        changed = set(ip for ip, known in verify.items() if found.get(ip, set()) != known)
+        if changed:
+            # 有端口关闭或者扫描出错，重新扫描这些主机的所有端口
+            found.update(scan_hosts([(ip, port) for ip in sorted(changed) for port in ports], args))
+            full |= changed
+
+        now = time.time()
+        for ip in ips:
+            if ip in full:
+                open_ports = found.get(ip, set())
+                if args.skip_ping and not open_ports:
+                    # 没有开放端口，无法判断是否存活
+                    alive.discard(ip)
+                    self.save(ip, False, None, now, ping_time=ip in rtts)
+                    if ip in self.known and self.known[ip]['alive']:
+                        self.status[ip] = 'down'
+                    continue
+                self.save(ip, True, rtts.get(ip), now, ping_time=ip in rtts,
+                          ports=open_ports, scanned=wanted)
+                self.status[ip] = 'changed' if ip in changed else \
+                    'new' if ip not in self.known else \
+                    'up' if not self.known[ip]['alive'] else 'rescanned'
+            elif ip in alive:
+                self.save(ip, True, rtts.get(ip), now, ping_time=ip in rtts)
+                self.status[ip] = 'cached'
+            elif ip in self.known and (self.known[ip]['alive'] or ip in rtts):
+                self.save(ip, False, None, now, ping_time=ip in rtts)
+                if self.known[ip]['alive']:
+                    self.status[ip] = 'down'
+        self.conn.commit()
+
+    def save(self, ip, alive, rtt, now, ping_time=False, ports=None, scanned=None):
+        known = self.known.get(ip)
+        if known is None:
+            if not alive:
+                # 不记录从未存活过的地址
+                return
+            self.conn.execute(
+                'INSERT INTO hosts (host, groupname, username, port, alive, first_seen) '
+                'VALUES (?, ?, ?, ?, 0, ?)',
+                (ip, self.args.group, self.args.user, self.args.ssh_port, now))
+        updates = {'alive': int(alive)}
+        if alive:
+            updates['last_seen'] = now
+        if ping_time:
+            updates['last_ping'] = now
+            updates['rtt'] = rtt
+        if scanned is not None:
+            updates['last_scan'] = now
+            updates['scanned_ports'] = scanned
+        self.conn.execute('UPDATE hosts SET {0} WHERE host = ?'.format(
+            ', '.join('{0} = ?'.format(k) for k in sorted(updates))),
+            [updates[k] for k in sorted(updates)] + [ip])
+        if ports is not None:
+            self.conn.execute('DELETE FROM ports WHERE host = ? AND port NOT IN ({0})'.format(
+                ','.join('?' * len(ports))), [ip] + sorted(ports))
+            for port in ports:
+                self.conn.execute(
+                    'INSERT OR IGNORE INTO ports (host, port, first_seen, last_seen) '
+                    'VALUES (?, ?, ?, ?)', (ip, port, now, now))
+            self.conn.execute('UPDATE ports SET last_seen = ? WHERE host = ?', (now, ip))
+
+
+def show(conn, only=None):
+    open_ports = load_open_ports(conn)
+    rows = conn.execute('SELECT host, groupname, alive, rtt, last_seen, last_scan '
+                        'FROM hosts ORDER BY id').fetchall()
+    for host, group, alive, rtt, last_seen, last_scan in rows:
+        if only is not None and host not in only:
+            continue
+        print("{0:<15} {1:<12} {2:<5} {3:>9} {4:<19} {5}".format(
+            host, group or '-', 'up' if alive else 'down',
+            '{0:.3f}ms'.format(rtt * 1000) if rtt is not None else '-',
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_scan)) if last_scan else '-',
+            format_ports(open_ports.get(host, ())) or '-'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='discover hosts and open ports')
+    parser.add_argument('targets', nargs='*', help='addresses or networks')
+    parser.add_argument('--db', default='hosts.db')
+    parser.add_argument('--ports', type=parse_ports,
+                        default='22,80,443,3306,6379,8080')
+    parser.add_argument('--group', default='discovered',
+                        help='ansible group of newly found hosts')
+    parser.add_argument('--user', help='ansible_user of newly found hosts')
+    parser.add_argument('--ssh-port', type=int, default=22,
+                        help='ansible_port of newly found hosts')
+    parser.add_argument('--ping-age', type=float, default=3600,
+                        help='seconds before a ping result is stale')
+    parser.add_argument('--scan-age', type=float, default=86400,
+                        help='seconds before a port scan is stale')
+    parser.add_argument('--force', action='store_true',
+                        help='probe every host again')
+    parser.add_argument('--skip-ping', action='store_true',
+                        help='treat hosts with an open port as alive')
+    parser.add_argument('--count', type=int, default=1)
+    parser.add_argument('--rate', type=int, default=1000,
+                        help='echo requests per second')
+    parser.add_argument('--timeout', type=float, default=1.0,
+                        help='seconds to wait for echo replies')
+    parser.add_argument('--workers', type=int, default=10,
+                        help='threads used when falling back to the ping command')
+    parser.add_argument('--scan-timeout', type=float, default=1.0)
+    parser.add_argument('--max-concurrency', type=int, default=2000)
+    parser.add_argument('--pps', type=int, default=0,
+                        help='connects per second, 0 for unlimited')
+    parser.add_argument('--show', action='store_true',
+                        help='print the database and exit')
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    try:
+        if args.show or not args.targets:
+            show(conn)
+            return
+        if args.force:
+            args.ping_age = args.scan_age = -1
+        limit = raise_nofile_limit(args.max_concurrency + 64)
+        args.max_concurrency = min(args.max_concurrency, limit - 64)
+
+        start = time.time()
+        ips = expand_targets(args.targets)
+        discovery = Discovery(conn, args)
+        discovery.run(ips, args.ports)
+        show(conn, set(ips))
+        counts = {}
+        for status in discovery.status.values():
+            counts[status] = counts.get(status, 0) + 1
+        print("{0} addresses in {1:.2f}s: {2}".format(
+            len(ips), time.time() - start,
+            ', '.join('{0} {1}'.format(v, k) for k, v in sorted(counts.items())) or 'no hosts'),
+            file=sys.stderr)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""
+使用asyncio并发扫描端口，需要Python 3.7以上版本
+
+scan_port.py依次阻塞地连接每个端口，也没有超时时间；这里同时进行的连接数
+由--concurrency限制，每个连接有超时时间，结果一产生就输出：
+
+    $ python3 scan_port_with_asyncio.py 192.168.1.100 --ports 20-5000
+    $ python3 scan_port_with_asyncio.py host1 host2 --ports 22,80,8000-8100 --banner
+    $ python3 scan_port_with_asyncio.py --benchmark 100   # 扫描本机65535个端口
+"""
+import argparse
+import asyncio
+import collections
+import resource
+import socket
+import sys
+import time
+
+ScanResult = collections.namedtuple('ScanResult', 'host port state banner')
+
+
+def parse_ports(text):
+    """ 解析"22,80,8000-8100"这样的端口列表，用作argparse的type，
+    端口不在1-65535之间时报错 """
+    ports = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        low, sep, high = part.partition('-')
+        try:
+            low = int(low)
+            high = int(high) if sep else low
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid port: {0}".format(part))
+        if not (1 <= low <= 65535 and 1 <= high <= 65535):
+            raise argparse.ArgumentTypeError(
+                "invalid port {0}, ports must be in 1-65535".format(part))
+        if low > high:
+            raise argparse.ArgumentTypeError(
+                "invalid port range {0}, start is greater than end".format(part))
+        ports.extend(range(low, high + 1))
+    if not ports:
+        raise argparse.ArgumentTypeError("no ports given")
+    return ports
+
+
+def raise_nofile_limit(wanted):
+    """ 每个进行中的连接占用一个文件描述符 """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        new = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new, hard))
+        soft = new
+    return soft
+
+
+async def probe(host, port, timeout, banner_size=0, banner_timeout=1.0):
+    # 直接使用非阻塞套接字，不为每个端口创建transport和StreamReader
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, (host, port)), timeout)
+        except asyncio.TimeoutError:
+            # 没有任何应答，一般是被防火墙丢弃
+            return ScanResult(host, port, 'filtered', None)
+        except ConnectionRefusedError:
+            return ScanResult(host, port, 'closed', None)
+        except OSError as e:
+            return ScanResult(host, port, 'error', str(e))
+
+        banner = None
+        if banner_size:
+            try:
+                banner = await asyncio.wait_for(loop.sock_recv(sock, banner_size),
+                                                banner_timeout)
+            except (asyncio.TimeoutError, OSError):
+                banner = b''
+        return ScanResult(host, port, 'open', banner)
+    finally:
+        sock.close()
+
+
+async def scan(hosts, ports, concurrency=500, timeout=1.0, banner_size=0,
+               banner_timeout=1.0):
+    """ 逐个返回扫描结果，同时进行的连接数不超过concurrency """
+    targets = ((host, port) for host in hosts for port in ports)
+    results = asyncio.Queue()
+
+    async def worker():
+        # 所有worker共享同一个迭代器，不需要预先为每个端口创建任务
+        for host, port in targets:
+            results.put_nowait(await probe(host, port, timeout,
+                                           banner_size, banner_timeout))
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    done = asyncio.ensure_future(asyncio.gather(*workers))
+    done.add_done_callback(lambda _: results.put_nowait(None))
+    try:
+        while True:
+            result = await results.get()
+            if result is None:
+                break
+            yield result
+        await done
+    finally:
+        for w in workers:
+            w.cancel()
+
+
+async def run_scan(hosts, ports, args, show_closed=False):
+    counts = collections.Counter()
+    async for result in scan(hosts, ports, args.concurrency, args.timeout,
+                             1024 if args.banner else 0, args.banner_timeout):
+        counts[result.state] += 1
+        if result.state == 'open':
+            line = '{0} {1} is available'.format(result.host, result.port)
+            if result.banner:
+                line += ' ' + repr(result.banner.strip()[:80])
+            print(line, flush=True)
+        elif show_closed:
+            print(result.host, result.port, 'is not available', result.state)
+    return counts
+
+
+async def benchmark(args):
+    """ 在本机启动若干个监听端口，然后扫描所有65535个端口 """
+    async def greet(reader, writer):
+        writer.write(b'hello\r\n')
+        writer.close()
+
+    servers = []
+    for _ in range(args.benchmark):
+        servers.append(await asyncio.start_server(greet, '127.0.0.1', 0))
+    listening = set(s.sockets[0].getsockname()[1] for s in servers)
+
+    found = set()
+    start = time.time()
+    async for result in scan(['127.0.0.1'], range(1, 65536), args.concurrency,
+                             args.timeout, 16 if args.banner else 0,
+                             args.banner_timeout):
+        if result.state == 'open':
+            found.add(result.port)
+    elapsed = time.time() - start
+    for s in servers:
+        s.close()
+        await s.wait_closed()
+
+    print("scanned 65535 ports in {0:.2f}s ({1:.0f} ports/s), concurrency {2}".format(
+        elapsed, 65535 / elapsed, args.concurrency))
+    print("{0} of {1} listeners found, {2} other open ports".format(
+        len(listening & found), len(listening), len(found - listening)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='asyncio port scanner')
+    parser.add_argument('hosts', nargs='*')
+    parser.add_argument('--ports', type=parse_ports, default='20-5000')
+    parser.add_argument('--concurrency', type=int, default=500,
+                        help='connections in flight at the same time')
+    parser.add_argument('--timeout', type=float, default=1.0,
+                        help='seconds to wait for one connect')
+    parser.add_argument('--banner', action='store_true',
+                        help='read what open ports send first')
+    parser.add_argument('--banner-timeout', type=float, default=1.0)
+    parser.add_argument('--show-closed', action='store_true')
+    parser.add_argument('--benchmark', type=int, metavar='LISTENERS', default=0,
+                        help='scan all ports of localhost with LISTENERS open')
+    args = parser.parse_args()
+
+    limit = raise_nofile_limit(args.concurrency + args.benchmark + 64)
+    if limit < args.concurrency + 64:
+        args.concurrency = max(1, limit - 64 - args.benchmark)
+        print("open files limit is {0}, concurrency lowered to {1}".format(
+            limit, args.concurrency), file=sys.stderr)
+
+    loop = asyncio.new_event_loop()
+    try:
+        if args.benchmark:
+            loop.run_until_complete(benchmark(args))
+            return
+        if not args.hosts:
+            parser.error('at least one host is required')
+        hosts = [socket.gethostbyname(h) for h in args.hosts]
+        ports = args.ports
+        start = time.time()
+        counts = loop.run_until_complete(run_scan(hosts, ports, args, args.show_closed))
+        print("{0} ports scanned in {1:.2f}s: {2}".format(
+            len(hosts) * len(ports), time.time() - start,
+            ', '.join('{0} {1}'.format(v, k) for k, v in sorted(counts.items()))))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""
+基于selectors（Linux下为epoll）的端口扫描引擎
+
+- 非阻塞地connect_ex，一个线程同时等待大量连接
+- 根据每台主机连接的往返时间估算超时时间（与TCP的RTO相同的算法，下限
+  200ms），不依赖内核的连接超时
+- 超时的连接用加倍的超时时间重试（默认一次），仍然超时才认为端口被过滤，丢了一个
+  SYN不会漏掉开放的端口
+- 并发数按AIMD调整：超时比例低时逐渐增加，超时比例高时减半
+- --pps限制每秒发起的连接数（每个连接一个SYN），避免压垮防火墙
+
+conn_scan和scan_ports的输出与scan_port.py相同，其他脚本可以直接替换：
+
+    from scan_port_with_selectors import scan_ports
+    scan_ports('192.168.1.100', range(20, 5000))
+
+    $ python3 scan_port_with_selectors.py 192.168.1.100 --ports 20-5000 --pps 2000
+    $ python3 scan_port_with_selectors.py --benchmark 100
+"""
+import argparse
+import collections
+import errno
+import heapq
+import itertools
+import selectors
+import socket
+import sys
+import time
+
+# 端口列表的解析和文件描述符上限与asyncio版本相同
+from scan_port_with_asyncio import parse_ports, raise_nofile_limit
+
+ScanResult = collections.namedtuple('ScanResult', 'host port state rtt')
+
+IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+def print_result(result):
+    """ 与scan_port.py中conn_scan的输出相同 """
+    if result.state == 'open':
+        print(result.host, result.port, 'is available')
+    else:
+        print(result.host, result.port, 'is not available')
+
+
+class RateLimiter(object):
+    """ 令牌桶，rate为每秒的令牌数，0表示不限速 """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate // 10)
+        self.tokens = self.capacity
+        self.last = time.time()
+
+    def take(self, now):
+        if not self.rate:
+            return True
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self):
+        """ 下一个令牌到来前的等待时间 """
+        if not self.rate or self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Scanner(object):
+
+    def __init__(self, timeout=1.0, min_timeout=0.2, concurrency=100,
+                 min_concurrency=10, max_concurrency=5000, pps=0,
+                 adaptive=True, retries=1):
+        self.max_timeout = timeout
+        # RFC 6298建议RTO不小于1秒，Linux内核用200ms；下限太小时偶尔慢一点
+        # 的应答会被当作超时
+        self.min_timeout = min(min_timeout, timeout)
+        self.concurrency = min(max(concurrency, min_concurrency), max_concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.adaptive = adaptive
+        self.retries = retries
+        self.limiter = RateLimiter(pps)
+        self.selector = selectors.DefaultSelector()
+        # 每台主机的往返时间估计：host -> [srtt, rttvar]，不同主机的延迟
+        # 可能相差很大，不能共用一个估计值
+        self.rtt = {}
+        # 本轮调整窗口中完成和超时的连接数
+        self.window_done = 0
+        self.window_timeouts = 0
+        self.stats = collections.Counter()
+        self.retried = 0
+
+    def update_rtt(self, host, rtt):
+        # RFC 6298
+        estimate = self.rtt.get(host)
+        if estimate is None:
+            self.rtt[host] = [rtt, rtt / 2]
+        else:
+            srtt, rttvar = estimate
+            estimate[1] = 0.75 * rttvar + 0.25 * abs(srtt - rtt)
+            estimate[0] = 0.875 * srtt + 0.125 * rtt
+
+    def rto(self, host, attempt=0):
+        """ 连接host的超时时间，还没有测量值时使用上限，每次重试加倍 """
+        estimate = self.rtt.get(host)
+        if not self.adaptive or estimate is None:
+            return self.max_timeout
+        srtt, rttvar = estimate
+        rto = max(self.min_timeout, srtt + max(0.01, 4 * rttvar))
+        return min(self.max_timeout, rto * 2 ** attempt)
+
+    def adjust(self, timed_out):
+        self.window_done += 1
+        if timed_out:
+            self.window_timeouts += 1
+        if not self.adaptive or self.window_done < max(20, self.concurrency // 2):
+            return
+        # 乘性减少，加性增加
+        if self.window_timeouts > self.window_done * 0.05:
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+        else:
+            self.concurrency = min(self.max_concurrency,
+                                   self.concurrency + max(1, self.concurrency // 10))
+        self.window_done = self.window_timeouts = 0
+
+    def shrink(self, limit):
+        """ 同时打开的套接字不能超过limit，之后的加性增加也不超过它 """
+        if limit < self.max_concurrency:
+            print("too many open files, concurrency limited to {0}".format(limit),
+                  file=sys.stderr)
+        self.max_concurrency = min(self.max_concurrency, limit)
+        self.min_concurrency = min(self.min_concurrency, limit)
+        self.concurrency = min(self.concurrency, limit)
+
+    def scan(self, hosts, ports, callback=print_result):
+        """ 每个结果产生时调用callback，返回所有结果的计数 """
+        return self.scan_targets(((host, port) for host in hosts for port in ports),
+                                 callback)
+
+    def scan_targets(self, targets, callback=print_result):
+        """ targets为(host, port)的迭代器，每台主机可以扫描不同的端口 """
+        targets = iter(targets)
+        exhausted = False
+        # 超时后等待重试的(host, port, 第几次重试)，优先于新的目标
+        retry = collections.deque()
+        # 每台主机的超时时间不同，按截止时间排序：(截止时间, 序号, 套接字)
+        deadlines = []
+        sequence = itertools.count()
+        # 套接字 -> (host, port, 发起时间, 第几次重试)
+        inflight = {}
+
+        def release(sock):
+            self.selector.unregister(sock)
+            sock.close()
+            return inflight.pop(sock)
+
+        def finish(sock, state, rtt=None):
+            host, port, _, _ = release(sock)
+            self.stats[state] += 1
+            callback(ScanResult(host, port, state, rtt))
+
+        while True:
+            now = time.time()
+            while (retry or not exhausted) and len(inflight) < self.concurrency \
+                    and self.limiter.take(now):
+                if retry:
+                    host, port, attempt = retry.popleft()
+                else:
+                    try:
+                        host, port = next(targets)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    attempt = 0
+                try:
+                    sock = self.connect(host, port, attempt, now, inflight, callback)
+                except OSError as e:
+                    if e.errno not in (errno.EMFILE, errno.ENFILE) or not inflight:
+                        raise
+                    # 文件描述符用完，放回队列，窗口缩小到当前在途的连接数
+                    retry.appendleft((host, port, attempt))
+                    self.shrink(len(inflight))
+                    break
+                if sock is not None:
+                    heapq.heappush(deadlines, (now + self.rto(host, attempt),
+                                               next(sequence), sock))
+            if exhausted and not retry and not inflight:
+                break
+
+            wait = self.max_timeout
+            if deadlines:
+                wait = max(0, deadlines[0][0] - now)
+            if (retry or not exhausted) and len(inflight) < self.concurrency:
+                wait = min(wait, self.limiter.delay())
+            for key, _ in self.selector.select(wait):
+                sock = key.fileobj
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                host, _, started, _ = inflight[sock]
+                rtt = time.time() - started
+                if err == 0:
+                    state = 'open'
+                elif err == errno.ECONNREFUSED:
+                    state = 'closed'
+                else:
+                    state = 'error'
+                if state != 'error':
+                    self.update_rtt(host, rtt)
+                finish(sock, state, rtt)
+                self.adjust(False)
+
+            now = time.time()
+            while deadlines and deadlines[0][0] <= now:
+                _, _, sock = heapq.heappop(deadlines)
+                if sock not in inflight:
+                    continue
+                self.adjust(True)
+                _, _, _, attempt = inflight[sock]
+                if attempt < self.retries:
+                    host, port, _, _ = release(sock)
+                    retry.append((host, port, attempt + 1))
+                    self.retried += 1
+                else:
+                    finish(sock, 'filtered')
+            # 已经完成的连接留在堆中，没有在途连接时直接清空
+            if not inflight:
+                del deadlines[:]
+        return self.stats
+
+    def connect(self, host, port, attempt, now, inflight, callback):
+        """ 发起连接，返回需要等待的套接字，立即有结果时返回None """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex((host, port))
+        if err in IN_PROGRESS:
+            inflight[sock] = (host, port, now, attempt)
+            self.selector.register(sock, selectors.EVENT_WRITE)
+            return sock
+        sock.close()
+        state = 'open' if err == 0 else 'closed' if err == errno.ECONNREFUSED else 'error'
+        self.stats[state] += 1
+        callback(ScanResult(host, port, state, 0.0))
+        return None
+
+    def close(self):
+        self.selector.close()
+
+
+def conn_scan(host, port, timeout=1.0):
+    """ 与scan_port.py中的conn_scan用法相同 """
+    scanner = Scanner(timeout=timeout, adaptive=False)
+    scanner.scan([host], [port])
+    scanner.close()
+
+
+def scan_ports(host, ports, callback=print_result, **kwargs):
+    """ 一次扫描多个端口，输出与逐个调用conn_scan相同 """
+    hosts = [host] if isinstance(host, str) else host
+    scanner = Scanner(**kwargs)
+    try:
+        return scanner.scan(hosts, ports, callback)
+    finally:
+        scanner.close()
+
+
+def benchmark(args):
+    listeners = []
+    for _ in range(args.benchmark):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        s.listen(128)
+        listeners.append(s)
+    listening = set(s.getsockname()[1] for s in listeners)
+    found = set()
+
+    def record(result):
+        if result.state == 'open':
+            found.add(result.port)
+
+    scanner = Scanner(args.timeout, concurrency=args.concurrency,
+                      max_concurrency=args.max_concurrency, pps=args.pps,
+                      retries=args.retries)
+    start = time.time()
+    stats = scanner.scan(['127.0.0.1'], range(1, 65536), record)
+    elapsed = time.time() - start
+    scanner.close()
+    for s in listeners:
+        s.close()
+    print("scanned 65535 ports in {0:.2f}s ({1:.0f} ports/s), final concurrency {2}, timeout {3:.3f}s".format(
+        elapsed, 65535 / elapsed, scanner.concurrency, scanner.rto('127.0.0.1')))
+    print("{0} of {1} listeners found, {2}".format(
+        len(listening & found), len(listening), dict(stats)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='selectors based port scanner')
+    parser.add_argument('hosts', nargs='*')
+    parser.add_argument('--ports', type=parse_ports, default='20-5000')
+    parser.add_argument('--timeout', type=float, default=1.0,
+                        help='upper bound of the adaptive connect timeout')
+    parser.add_argument('--concurrency', type=int, default=100,
+                        help='initial connections in flight')
+    parser.add_argument('--max-concurrency', type=int, default=5000)
+    parser.add_argument('--pps', type=int, default=0,
+                        help='connects per second, 0 for unlimited')
+    parser.add_argument('--retries', type=int, default=1,
+                        help='connects retried after a timeout before a port'
+                             ' is reported as filtered')
+    parser.add_argument('--fixed', action='store_true',
+                        help='do not adapt concurrency and timeout')
+    parser.add_argument('--open-only', action='store_true')
+    parser.add_argument('--benchmark', type=int, metavar='LISTENERS', default=0,
+                        help='scan all ports of localhost with LISTENERS open')
+    args = parser.parse_args()
+
+    limit = raise_nofile_limit(args.max_concurrency + args.benchmark + 64)
+    args.max_concurrency = min(args.max_concurrency, limit - args.benchmark - 64)
+    if args.benchmark:
+        benchmark(args)
+        return
+    if not args.hosts:
+        parser.error('at least one host is required')
+
+    def report(result):
+        if result.state == 'open' or not args.open_only:
+            print_result(result)
+
+    hosts = [socket.gethostbyname(h) for h in args.hosts]
+    start = time.time()
+    scanner = Scanner(timeout=args.timeout, concurrency=args.concurrency,
+                      max_concurrency=args.max_concurrency, pps=args.pps,
+                      adaptive=not args.fixed, retries=args.retries)
+    try:
+        stats = scanner.scan(hosts, args.ports, report)
+    finally:
+        scanner.close()
+    print("scanned in {0:.2f}s: {1}, {2} retried".format(
+        time.time() - start, dict(stats), scanner.retried), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
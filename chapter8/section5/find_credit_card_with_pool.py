@@ -0,0 +1,679 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+抓包与匹配分离的信用卡号嗅探器
+
+find_credit_card.py在scapy的抓包线程中把每个报文格式化成字符串，再执行三个
+正则表达式，流量稍大就会丢包。这里：
+
+- 抓包线程只接收原始报文，攒成一批放入有界队列，队列满时丢弃并计数，不阻塞抓包
+- 多个worker进程直接从报文字节中取出TCP载荷，用一个合并后的bytes正则匹配，
+  再用Luhn校验过滤掉随机出现的数字串
+- --reassemble按TCP流重组后扫描（见tcp_stream.py），能找到被拆分到两个
+  报文中的卡号；同一个流的报文由同一个worker处理
+- --backend ring从PACKET_MMAP环形缓冲区读取报文（见packet_ring.py），
+  内核中的BPF过滤器只留下TCP报文，不用为每个报文调用一次recvfrom
+- 可以读取pcap文件离线分析，--make-pcap生成测试用的pcap文件
+
+    $ sudo python find_credit_card_with_pool.py --interface eth0 --workers 4
+    $ python find_credit_card_with_pool.py --pcap capture.pcap
+    $ python find_credit_card_with_pool.py --pcap capture.pcap --reassemble
+    $ python find_credit_card_with_pool.py --make-pcap test.pcap --packets 200000
+    $ python find_credit_card_with_pool.py --pcap test.pcap --benchmark --benchmark-workers 0,1,2,4
+    $ sudo python3 find_credit_card_with_pool.py --interface eth0 --backend ring
+    $ sudo python3 find_credit_card_with_pool.py --pcap test.pcap --benchmark-capture --interface lo
+"""
+from __future__ import division
+from __future__ import print_function
+import argparse
+import collections
+import multiprocessing
+import random
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+try:
+    from queue import Full
+except ImportError:
+    from Queue import Full
+try:
+    from time import process_time
+except ImportError:
+    from time import clock as process_time
+
+from packet_ring import PacketRing, TCP_FILTER, load_filter
+from tcp_stream import FlowTable
+
+# 第一个字符是字符类时re模块可以快速跳过不可能匹配的位置，比把前后的
+# 数字边界写在最前面快得多
+CARD_RE = re.compile(br'[345](?<![0-9][345])'
+                     br'(?:(?<=3)[47][0-9]{13}'          # American Express
+                     br'|(?<=5)[1-5][0-9]{14}'           # MasterCard
+                     br'|(?<=4)[0-9]{12}(?:[0-9]{3})?)'  # Visa
+                     br'(?![0-9])')
+CARD_NAMES = {b'3': 'American Express', b'5': 'MasterCard', b'4': 'Visa'}
+# 重组时与下一段数据一起扫描的字节数，必须大于最长的卡号
+CARD_OVERLAP = 32
+
+# Luhn校验中偶数位数字乘2后的各位之和
+DOUBLED = [0, 2, 4, 6, 8, 1, 3, 5, 7, 9]
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86dd
+VLAN_TYPES = (0x8100, 0x88a8)
+PACKET_OUTGOING = 4
+
+IPV4_HEADER = struct.Struct('!BBHHHBBH4s4s')
+IPV6_HEADER = struct.Struct('!IHBB16s16s')
+TCP_HEADER = struct.Struct('!HHIIBB')
+ETHER_TYPE = struct.Struct('!H')
+IP_VERSION = struct.Struct('!B')
+
+PCAP_HEADER = 'IHHiIII'
+PCAP_RECORD = 'IIII'
+# 魔数 -> (字节序, 时间戳的小数部分是否为纳秒)
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', False),
+    b'\xa1\xb2\xc3\xd4': ('>', False),
+    b'\x4d\x3c\xb2\xa1': ('<', True),
+    b'\xa1\xb2\x3c\x4d': ('>', True),
+}
+
+
+def luhn_valid(number):
+    digits = bytearray(number)
+    total = sum(digits[-1::-2]) - 48 * len(digits[-1::-2])
+    total += sum(DOUBLED[d - 48] for d in digits[-2::-2])
+    return total % 10 == 0
+
+
+def find_cards(payload):
+    """ 返回载荷中通过Luhn校验的[(卡类型, 卡号)] """
+    return [(CARD_NAMES[number[:1]], number)
+            for number in CARD_RE.findall(payload) if luhn_valid(number)]
+
+
+def scan_stream(data):
+    """ FlowTable使用的扫描函数，返回[(结束位置, (卡类型, 卡号))] """
+    return [(m.end(), (CARD_NAMES[m.group()[:1]], m.group()))
+            for m in CARD_RE.finditer(data) if luhn_valid(m.group())]
+
+
+class PcapReader(object):
+    """ 读取libpcap格式的文件，逐个产生(时间戳, 帧) """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        magic = fileobj.read(4)
+        if magic == b'\x0a\x0d\x0d\x0a':
+            raise ValueError("pcapng is not supported, convert it with "
+                             "'editcap -F libpcap in.pcapng out.pcap'")
+        if magic not in PCAP_MAGIC:
+            raise ValueError("not a pcap file")
+        order, self.nanosecond = PCAP_MAGIC[magic]
+        self.record = struct.Struct(order + PCAP_RECORD)
+        header = struct.Struct(order + PCAP_HEADER[1:])
+        _, _, _, _, self.snaplen, self.linktype = header.unpack(fileobj.read(header.size))
+
+    def __iter__(self):
+        read = self.fileobj.read
+        record = self.record
+        divisor = 1e9 if self.nanosecond else 1e6
+        while True:
+            header = read(record.size)
+            if len(header) < record.size:
+                return
+            sec, frac, caplen, _ = record.unpack(header)
+            frame = read(caplen)
+            if len(frame) < caplen:
+                return
+            yield sec + frac / divisor, frame
+
+
+class PcapWriter(object):
+
+    def __init__(self, fileobj, linktype=LINKTYPE_ETHERNET, snaplen=65535):
+        self.fileobj = fileobj
+        self.record = struct.Struct('<' + PCAP_RECORD)
+        fileobj.write(struct.pack('<' + PCAP_HEADER, 0xa1b2c3d4, 2, 4, 0, 0,
+                                  snaplen, linktype))
+
+    def write(self, ts, frame):
+        sec = int(ts)
+        self.fileobj.write(self.record.pack(sec, int((ts - sec) * 1e6),
+                                            len(frame), len(frame)))
+        self.fileobj.write(frame)
+
+
+def network_offset(frame, linktype):
+    """ 返回IP头在帧中的偏移，不是IP报文时返回None """
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 12
+        ether_type, = ETHER_TYPE.unpack_from(frame, offset)
+        while ether_type in VLAN_TYPES:
+            offset += 4
+            ether_type, = ETHER_TYPE.unpack_from(frame, offset)
+        if ether_type not in (ETH_P_IP, ETH_P_IPV6):
+            return None
+        return offset + 2
+    if linktype == LINKTYPE_RAW:
+        return 0
+    if linktype == LINKTYPE_LINUX_SLL:
+        ether_type, = ETHER_TYPE.unpack_from(frame, 14)
+        return 16 if ether_type in (ETH_P_IP, ETH_P_IPV6) else None
+    if linktype == LINKTYPE_NULL:
+        return 4
+    raise ValueError("unsupported link type {0}".format(linktype))
+
+
+def parse_tcp(frame, linktype):
+    """ 返回(src, sport, dst, dport, seq, flags, payload)，地址为打包后的
+    字节串；不是TCP报文或者不是第一个分片时返回None """
+    try:
+        offset = network_offset(frame, linktype)
+        if offset is None:
+            return None
+        version = IP_VERSION.unpack_from(frame, offset)[0] >> 4
+        if version == 4:
+            ver_ihl, _, length, _, frag, _, proto, _, src, dst = IPV4_HEADER.unpack_from(frame, offset)
+            if proto != socket.IPPROTO_TCP or frag & 0x1fff:
+                return None
+            # 以IP头中的长度为准，去掉以太网帧末尾的填充
+            end = offset + length
+            offset += (ver_ihl & 0x0f) * 4
+        elif version == 6:
+            _, length, next_header, _, src, dst = IPV6_HEADER.unpack_from(frame, offset)
+            # 不处理扩展头
+            if next_header != socket.IPPROTO_TCP:
+                return None
+            offset += IPV6_HEADER.size
+            end = offset + length
+        else:
+            return None
+        sport, dport, seq, _, data_offset, flags = TCP_HEADER.unpack_from(frame, offset)
+    except struct.error:
+        # 被截断的报文
+        return None
+    return src, sport, dst, dport, seq, flags, frame[offset + (data_offset >> 4) * 4:end]
+
+
+def format_address(addr, port):
+    family = socket.AF_INET if len(addr) == 4 else socket.AF_INET6
+    return '{0}:{1}'.format(socket.inet_ntop(family, addr), port)
+
+
+class Scanner(object):
+    """ 一个worker中的扫描状态；reassemble为FlowTable的参数时按TCP流扫描，
+    这时batch中是parse_tcp的结果而不是原始的帧 """
+
+    def __init__(self, linktype, report, reassemble=None):
+        self.linktype = linktype
+        self.report = report
+        self.packets = 0
+        self.payload_bytes = 0
+        self.ts = 0
+        self.table = None
+        if reassemble is not None:
+            self.table = FlowTable(scan_stream, self.report_stream,
+                                   overlap=CARD_OVERLAP, **reassemble)
+
+    def scan_batch(self, batch):
+        table = self.table
+        for ts, item in batch:
+            self.packets += 1
+            parsed = item if table is not None else parse_tcp(item, self.linktype)
+            if parsed is None:
+                continue
+            src, sport, dst, dport, seq, flags, payload = parsed
+            self.payload_bytes += len(payload)
+            if table is not None:
+                self.ts = ts
+                table.add(ts, (src, sport, dst, dport), seq, flags, payload)
+            elif payload:
+                for kind, number in find_cards(payload):
+                    self.report(('hit', ts, kind, number, src, sport, dst, dport))
+
+    def report_stream(self, key, item):
+        self.report(('hit', self.ts) + item + key)
+
+    def close(self):
+        """ 返回流重组的统计 """
+        if self.table is None:
+            return {}
+        self.table.close()
+        return dict(self.table.stats)
+
+
+def worker(batches, hits, linktype, reassemble):
+    scanner = Scanner(linktype, hits.put, reassemble)
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        scanner.scan_batch(batch)
+    stats = scanner.close()
+    hits.put(('done', scanner.packets, scanner.payload_bytes, stats))
+
+
+def print_hit(hit):
+    _, ts, kind, number, src, sport, dst, dport = hit
+    print("{0} Found {1} card {2} {3} -> {4}".format(
+        time.strftime('%H:%M:%S', time.localtime(ts)), kind, number.decode('ascii'),
+        format_address(src, sport), format_address(dst, dport)))
+    sys.stdout.flush()
+
+
+class Pipeline(object):
+    """ 抓包线程调用put，workers个进程扫描；workers为0时在当前线程扫描 """
+
+    def __init__(self, linktype, workers=2, batch_size=256, queue_size=64,
+                 block=True, on_hit=print_hit, reassemble=None):
+        self.linktype = linktype
+        self.workers = workers
+        self.batch_size = batch_size
+        # 离线分析时阻塞等待worker，实时抓包时丢弃，避免内核缓冲区溢出
+        self.block = block
+        self.on_hit = on_hit
+        self.reassemble = reassemble
+        # 重组时同一个流的报文必须由同一个worker处理，每个worker一个队列
+        shards = workers if reassemble is not None and workers else 1
+        self.batches = [[] for _ in range(shards)]
+        self.captured = 0
+        self.dropped = 0
+        self.kernel_dropped = 0
+        self.packets = 0
+        self.payload_bytes = 0
+        self.hits = 0
+        self.flow_stats = collections.Counter()
+        self.processes = []
+        if not workers:
+            self.scanner = Scanner(linktype, self.hit, reassemble)
+            return
+        self.queues = [multiprocessing.Queue(queue_size) for _ in range(shards)]
+        self.hit_queue = multiprocessing.Queue()
+        for i in range(workers):
+            proc = multiprocessing.Process(target=worker, args=(
+                self.queues[i % shards], self.hit_queue, linktype, reassemble))
+            proc.daemon = True
+            proc.start()
+            self.processes.append(proc)
+        self.reporter = threading.Thread(target=self.report)
+        self.reporter.daemon = True
+        self.reporter.start()
+
+    def put(self, ts, frame):
+        self.captured += 1
+        if self.reassemble is None:
+            shard = 0
+            item = frame
+        else:
+            item = parse_tcp(frame, self.linktype)
+            if item is None:
+                return
+            shard = hash(item[:4]) % len(self.batches) if len(self.batches) > 1 else 0
+        batch = self.batches[shard]
+        batch.append((ts, item))
+        if len(batch) >= self.batch_size:
+            self.flush(shard)
+
+    def put_block(self, frames):
+        """ frames中是指向环形缓冲区的memoryview，返回后就会失效 """
+        if not self.workers and self.reassemble is None:
+            # 在当前线程中直接扫描，不复制
+            self.captured += len(frames)
+            self.scanner.scan_batch(frames)
+            return
+        for ts, frame in frames:
+            self.put(ts, frame.tobytes())
+        if not frames:
+            self.flush()
+
+    def flush(self, shard=None):
+        for i in range(len(self.batches)) if shard is None else [shard]:
+            batch = self.batches[i]
+            if not batch:
+                continue
+            self.batches[i] = []
+            if not self.workers:
+                self.scanner.scan_batch(batch)
+                continue
+            try:
+                self.queues[i].put(batch, self.block)
+            except Full:
+                self.dropped += len(batch)
+
+    def hit(self, hit):
+        self.hits += 1
+        if self.on_hit is not None:
+            self.on_hit(hit)
+
+    def report(self):
+        """ 在主进程中输出worker发回的结果 """
+        running = self.workers
+        while running:
+            message = self.hit_queue.get()
+            if message[0] == 'done':
+                running -= 1
+                self.packets += message[1]
+                self.payload_bytes += message[2]
+                self.flow_stats.update(message[3])
+            else:
+                self.hit(message)
+
+    def close(self):
+        self.flush()
+        if not self.workers:
+            self.flow_stats.update(self.scanner.close())
+            self.packets = self.scanner.packets
+            self.payload_bytes = self.scanner.payload_bytes
+            return
+        for queue in self.queues:
+            for _ in range(self.workers // len(self.queues)):
+                queue.put(None)
+        self.reporter.join()
+        for proc in self.processes:
+            proc.join()
+
+    def summary(self):
+        text = "{0} packets captured, {1} dropped, {2} scanned, {3} cards found".format(
+            self.captured, self.dropped + self.kernel_dropped, self.packets, self.hits)
+        if self.reassemble is not None:
+            text += "\n" + ', '.join('{0} {1}'.format(k, v) for k, v in sorted(self.flow_stats.items()))
+        return text
+
+
+def read_pcap(filename, pipeline_args):
+    with open(filename, 'rb') as f:
+        reader = PcapReader(f)
+        pipeline = Pipeline(reader.linktype, block=True, **pipeline_args)
+        for ts, frame in reader:
+            pipeline.put(ts, frame)
+    pipeline.close()
+    return pipeline
+
+
+def capture(interface, pipeline_args, flush_interval=0.05, stop=None):
+    """ 从AF_PACKET套接字接收报文，直到按下Ctrl+C，或者没有报文时stop()
+    返回True """
+    # SOCK_DGRAM类型的套接字收到的报文不含链路层头部，各种网卡的处理都相同
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_ALL))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 << 20)
+    if interface:
+        sock.bind((interface, ETH_P_ALL))
+    sock.settimeout(flush_interval)
+    pipeline = Pipeline(LINKTYPE_RAW, block=False, **pipeline_args)
+    try:
+        while True:
+            try:
+                frame, addr = sock.recvfrom(65535)
+            except socket.timeout:
+                pipeline.flush()
+                if stop is not None and stop():
+                    break
+                continue
+            ifname, proto, pkttype = addr[:3]
+            if proto not in (ETH_P_IP, ETH_P_IPV6):
+                continue
+            # 回环接口上的报文发出和收到时各出现一次
+            if pkttype == PACKET_OUTGOING and ifname == 'lo':
+                continue
+            pipeline.put(time.time(), frame)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        pipeline.close()
+    return pipeline
+
+
+def capture_ring(interface, pipeline_args, program=TCP_FILTER, stop=None):
+    """ 从PACKET_MMAP环形缓冲区读取报文，结束的条件与capture相同 """
+    # 回环接口上的报文发出和收到时各出现一次
+    ring = PacketRing(interface, program, ignore_outgoing=interface == 'lo')
+    pipeline = Pipeline(LINKTYPE_ETHERNET, block=False, **pipeline_args)
+    blocks = ring.blocks()
+    try:
+        for frames in blocks:
+            pipeline.put_block(frames)
+            if not frames and stop is not None and stop():
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        blocks.close()
+        pipeline.kernel_dropped = ring.stats()[1]
+        ring.close()
+        pipeline.close()
+    return pipeline
+
+
+def luhn_number(r, prefix, length):
+    number = prefix + ''.join(str(r.randint(0, 9)) for _ in range(length - len(prefix) - 1))
+    for check in '0123456789':
+        if luhn_valid((number + check).encode('ascii')):
+            return number + check
+
+
+def make_pcap(filename, packets, card_ratio=0.01, split_ratio=0.5, seed=1):
+    """ 生成HTTP请求组成的测试文件，每个请求是一个TCP流，SYN之后分成1到4个报文，
+    几个流的报文交错出现，少量报文乱序。card_ratio的请求中含有一个有效的
+    卡号，其中split_ratio的卡号被拆分到两个报文中；同样多的请求中含有不能
+    通过Luhn校验的数字串。返回(报文数, 有效卡号数, 被拆分的卡号数) """
+    r = random.Random(seed)
+    words = ['GET', 'POST', '/index.html', '/api/v1/orders', 'HTTP/1.1', 'Host:',
+             'example.com', 'id=12345', 'date=2024-01-01', 'Content-Length:',
+             'tel=13800138000', 'order=20240101123456', 'ts=1704067200']
+    ether = b'\x02\x00\x00\x00\x00\x01\x02\x00\x00\x00\x00\x02\x08\x00'
+    expected = split = 0
+    written = flow = 0
+    ts = 1704067200.0
+    with open(filename, 'wb') as f:
+        writer = PcapWriter(f)
+        while written < packets:
+            # 同时进行的8个流
+            flows = []
+            for _ in range(8):
+                flow += 1
+                text = ' '.join(r.choice(words) for _ in range(r.randint(5, 400)))
+                cuts = set(r.randint(1, len(text) - 1) for _ in range(r.randint(0, 3)))
+                roll = r.random()
+                if roll < card_ratio:
+                    prefix, length = r.choice((('4', 16), ('4', 13), ('51', 16), ('55', 16), ('37', 15)))
+                    text += ' card=' + luhn_number(r, prefix, length) + ' end'
+                    expected += 1
+                    if r.random() < split_ratio:
+                        cuts.add(len(text) - 4 - r.randint(1, length - 1))
+                        split += 1
+                elif roll < card_ratio * 2:
+                    number = luhn_number(r, '4', 16)
+                    text += ' card=' + number[:-1] + str((int(number[-1]) + 1) % 10) + ' end'
+                payload = text.encode('ascii')
+                bounds = [0] + sorted(cuts) + [len(payload)]
+                seq = r.randint(0, 0xffffffff)
+                src = struct.pack('!I', 0x0a000000 + flow % 250 + 1)
+                segments = []
+                # SYN，然后是数据，最后一个数据报文带有FIN
+                for i in range(-1, len(bounds) - 1):
+                    if i < 0:
+                        flags, seg_seq, data = 0x02, seq - 1, b''
+                    else:
+                        flags = 0x18 | (0x01 if i == len(bounds) - 2 else 0)
+                        seg_seq, data = seq + bounds[i], payload[bounds[i]:bounds[i + 1]]
+                    tcp = struct.pack('!HHIIBBHHH', 1024 + flow % 60000, 80,
+                                      seg_seq & 0xffffffff, 0, 5 << 4, flags, 65535, 0, 0)
+                    ip = IPV4_HEADER.pack(0x45, 0, IPV4_HEADER.size + len(tcp) + len(data),
+                                          written & 0xffff, 0, 64, socket.IPPROTO_TCP, 0,
+                                          src, b'\x0a\x00\x01\x01')
+                    segments.append(ether + ip + tcp + data)
+                if len(segments) > 2 and r.random() < 0.05:
+                    segments[-1], segments[-2] = segments[-2], segments[-1]
+                flows.append(segments)
+            while flows:
+                for segments in flows:
+                    ts += 0.0001
+                    writer.write(ts, segments.pop(0))
+                    written += 1
+                flows = [segments for segments in flows if segments]
+    return written, expected, split
+
+
+def benchmark(filename, worker_counts, args, reassemble=None):
+    # 先把文件读入内存，只测量扫描的速度
+    with open(filename, 'rb') as f:
+        reader = PcapReader(f)
+        linktype = reader.linktype
+        frames = list(reader)
+    size = sum(len(frame) for _, frame in frames)
+    for workers in worker_counts:
+        pipeline = Pipeline(linktype, workers, args.batch_size, args.queue_size,
+                            block=True, on_hit=None, reassemble=reassemble)
+        start = time.time()
+        for ts, frame in frames:
+            pipeline.put(ts, frame)
+        pipeline.close()
+        elapsed = time.time() - start
+        print("{0:>2} workers: {1} packets in {2:.2f}s, {3:.0f} pps, {4:.1f} MB/s, {5} cards".format(
+            workers, pipeline.packets, elapsed, len(frames) / elapsed,
+            size / elapsed / 1e6, pipeline.hits))
+
+
+def replay(filename, interface, loops, sent):
+    """ 把pcap文件中的帧从interface发出loops遍，sent为发出的报文数 """
+    with open(filename, 'rb') as f:
+        frames = [frame for _, frame in PcapReader(f)]
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+    sock.bind((interface, 0))
+    count = 0
+    for _ in range(loops):
+        for frame in frames:
+            try:
+                sock.send(frame)
+                count += 1
+            except socket.error:
+                # 超过网卡MTU的帧
+                pass
+    sock.close()
+    sent.value = count
+
+
+def benchmark_capture(filename, interface, send_interface, backends, args):
+    """ 从send_interface重放pcap文件，在interface上抓包并在当前线程中扫描，
+    比较每个报文消耗的CPU时间。interface为回环接口时两者相同，也可以是
+    veth网卡对的两端：
+        ip link add vb0 type veth peer name vb1
+        ip link set vb0 up mtu 9000; ip link set vb1 up mtu 9000
+    """
+    for backend in backends:
+        sent = multiprocessing.Value('l', 0)
+        sender = multiprocessing.Process(target=replay, args=(
+            filename, send_interface, args.replay_loops, sent))
+        pipeline_args = dict(workers=0, on_hit=None)
+        start = time.time()
+        cpu = process_time()
+        # 发送进程在抓包开始后才启动
+        timer = threading.Timer(0.2, sender.start)
+        timer.start()
+
+        def stop():
+            return sender.pid is not None and not sender.is_alive()
+
+        if backend == 'ring':
+            pipeline = capture_ring(interface, pipeline_args, stop=stop)
+        else:
+            pipeline = capture(interface, pipeline_args, stop=stop)
+        sender.join()
+        cpu = process_time() - cpu
+        elapsed = time.time() - start
+        print("{0:>6}: {1} sent, {2} captured ({3:.1%}), {4} cards, "
+              "{5:.2f} us CPU per packet, {6:.2f}s".format(
+                  backend, sent.value, pipeline.captured,
+                  pipeline.captured / sent.value if sent.value else 0,
+                  pipeline.hits, cpu / max(1, pipeline.captured) * 1e6, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='credit card number sniffer')
+    parser.add_argument('--interface', help='capture on one interface, default all')
+    parser.add_argument('--pcap', help='read packets from a pcap file instead')
+    parser.add_argument('--backend', choices=('socket', 'ring'), default='socket',
+                        help='receive packets one by one or from a PACKET_MMAP ring')
+    parser.add_argument('--filter-file',
+                        help="BPF program for the ring from 'tcpdump -ddd', default tcp")
+    parser.add_argument('--workers', type=int, default=2,
+                        help='scanning processes, 0 to scan in the capture thread')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='batches waiting for the workers')
+    parser.add_argument('--reassemble', action='store_true',
+                        help='scan reassembled TCP streams instead of single packets')
+    parser.add_argument('--max-flows', type=int, default=100000)
+    parser.add_argument('--idle-timeout', type=float, default=120,
+                        help='seconds before an idle flow is dropped')
+    parser.add_argument('--flow-buffer', type=int, default=64,
+                        help='KB of out of order data kept per flow')
+    parser.add_argument('--max-buffer', type=int, default=64,
+                        help='MB of out of order data kept per worker')
+    parser.add_argument('--make-pcap', metavar='FILE',
+                        help='write a test capture and exit')
+    parser.add_argument('--packets', type=int, default=100000)
+    parser.add_argument('--benchmark', action='store_true',
+                        help='scan --pcap once for each --benchmark-workers')
+    parser.add_argument('--benchmark-workers', default='0,1,2,4')
+    parser.add_argument('--benchmark-capture', action='store_true',
+                        help='replay --pcap on --send-interface and compare backends')
+    parser.add_argument('--send-interface',
+                        help='interface to replay on, default --interface')
+    parser.add_argument('--replay-loops', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.make_pcap:
+        written, expected, split = make_pcap(args.make_pcap, args.packets)
+        print("wrote {0} packets with {1} valid card numbers ({2} split across "
+              "packets) to {3}".format(written, expected, split, args.make_pcap))
+        return
+
+    reassemble = None
+    if args.reassemble:
+        reassemble = dict(max_flows=args.max_flows, idle_timeout=args.idle_timeout,
+                          max_flow_buffer=args.flow_buffer << 10,
+                          max_buffer=args.max_buffer << 20)
+    if args.benchmark_capture:
+        if not args.pcap:
+            parser.error('--benchmark-capture needs --pcap')
+        interface = args.interface or 'lo'
+        benchmark_capture(args.pcap, interface, args.send_interface or interface,
+                          ('socket', 'ring'), args)
+        return
+    if args.benchmark:
+        if not args.pcap:
+            parser.error('--benchmark needs --pcap')
+        benchmark(args.pcap, [int(n) for n in args.benchmark_workers.split(',')],
+                  args, reassemble)
+        return
+
+    pipeline_args = dict(workers=args.workers, batch_size=args.batch_size,
+                         queue_size=args.queue_size, reassemble=reassemble)
+    start = time.time()
+    if args.pcap:
+        pipeline = read_pcap(args.pcap, pipeline_args)
+    else:
+        print("Starting Credit Card Sniffer")
+        if args.backend == 'ring':
+            program = load_filter(args.filter_file) if args.filter_file else TCP_FILTER
+            pipeline = capture_ring(args.interface, pipeline_args, program)
+        else:
+            pipeline = capture(args.interface, pipeline_args)
+    print("{0} in {1:.2f}s".format(pipeline.summary(), time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
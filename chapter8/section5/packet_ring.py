@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""
+基于AF_PACKET和PACKET_MMAP（TPACKET_V3）环形缓冲区的抓包，只支持Linux
+
+- 内核把报文直接写入与用户空间共享的环形缓冲区，一次系统调用都不需要就可以
+  读取一整块报文；每个报文是指向缓冲区的memoryview，不复制
+- BPF过滤器在内核中执行，不匹配的报文不会进入缓冲区
+- 需要root权限或者CAP_NET_RAW
+
+    ring = PacketRing('eth0', TCP_FILTER)
+    for frames in ring.blocks():
+        for ts, frame in frames:
+            ...
+    ring.close()
+
+blocks()产生的memoryview在生成器继续执行后就被交还给内核，需要保留的数据
+必须先复制。
+"""
+from __future__ import print_function
+import ctypes
+import mmap
+import select
+import socket
+import struct
+
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+PACKET_IGNORE_OUTGOING = 23
+TPACKET_V3 = 2
+SO_ATTACH_FILTER = 26
+ETH_P_ALL = 0x0003
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# struct tpacket_req3
+TPACKET_REQ3 = struct.Struct('=IIIIIII')
+# struct tpacket_block_desc中的version, offset_to_priv, block_status,
+# num_pkts, offset_to_first_pkt
+BLOCK_HEADER = struct.Struct('=IIIII')
+BLOCK_STATUS_OFFSET = 8
+# struct tpacket3_hdr中的tp_next_offset, tp_sec, tp_nsec, tp_snaplen,
+# tp_len, tp_status, tp_mac
+PACKET_HEADER = struct.Struct('=IIIIIIH')
+# struct tpacket_stats_v3
+TPACKET_STATS_V3 = struct.Struct('=III')
+BPF_INSN = struct.Struct('=HBBI')
+
+# tcpdump -dd tcp，以太网帧中的IPv4和IPv6 TCP报文
+TCP_FILTER = [
+    (0x28, 0, 0, 0x0000000c),
+    (0x15, 0, 5, 0x000086dd),
+    (0x30, 0, 0, 0x00000014),
+    (0x15, 6, 0, 0x00000006),
+    (0x15, 0, 6, 0x0000002c),
+    (0x30, 0, 0, 0x00000036),
+    (0x15, 3, 4, 0x00000006),
+    (0x15, 0, 3, 0x00000800),
+    (0x30, 0, 0, 0x00000017),
+    (0x15, 0, 1, 0x00000006),
+    (0x06, 0, 0, 0x00040000),
+    (0x06, 0, 0, 0x00000000),
+]
+
+
+def load_filter(filename):
+    """ 读取tcpdump -ddd的输出：第一行是指令数，之后每行一条指令 """
+    with open(filename) as f:
+        lines = [line.split() for line in f if line.strip()]
+    program = [tuple(int(v) for v in line) for line in lines[1:]]
+    if len(program) != int(lines[0][0]):
+        raise ValueError("{0}: expected {1} instructions, got {2}".format(
+            filename, lines[0][0], len(program)))
+    return program
+
+
+def attach_filter(sock, program):
+    insns = b''.join(BPF_INSN.pack(*insn) for insn in program)
+    buf = ctypes.create_string_buffer(insns, len(insns))
+    # struct sock_fprog {unsigned short len; struct sock_filter *filter;}
+    fprog = struct.pack('HP', len(program), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+class PacketRing(object):
+
+    def __init__(self, interface=None, program=None, block_size=1 << 20,
+                 block_nr=64, frame_size=2048, timeout_ms=50,
+                 ignore_outgoing=False):
+        """ block_size必须是页大小的整数倍；timeout_ms内没有写满的块也会被
+        交给用户空间，报文的延迟不超过这个时间 """
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.timeout_ms = timeout_ms
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        try:
+            # 先设置过滤器再绑定网卡，不会收到不匹配的报文
+            if program:
+                attach_filter(self.sock, program)
+            if ignore_outgoing:
+                self.sock.setsockopt(SOL_PACKET, PACKET_IGNORE_OUTGOING, 1)
+            self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            frame_nr = block_size // frame_size * block_nr
+            self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, TPACKET_REQ3.pack(
+                block_size, block_nr, frame_size, frame_nr, timeout_ms, 0, 0))
+            self.map = mmap.mmap(self.sock.fileno(), block_size * block_nr,
+                                 mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            if interface:
+                self.sock.bind((interface, ETH_P_ALL))
+        except Exception:
+            self.sock.close()
+            raise
+        self.view = memoryview(self.map)
+        self.poll = select.poll()
+        self.poll.register(self.sock.fileno(), select.POLLIN | select.POLLERR)
+        self.current = 0
+
+    def blocks(self, timeout_ms=None):
+        """ 逐个产生一个块中的[(时间戳, 帧)]；等待timeout_ms后仍然没有报文时
+        产生空列表，调用者可以借此处理超时 """
+        if timeout_ms is None:
+            timeout_ms = self.timeout_ms * 2
+        unpack_block = BLOCK_HEADER.unpack_from
+        unpack_packet = PACKET_HEADER.unpack_from
+        view = self.view
+        while True:
+            offset = self.current * self.block_size
+            _, _, status, num_pkts, first = unpack_block(self.map, offset)
+            if not status & TP_STATUS_USER:
+                if not self.poll.poll(timeout_ms):
+                    yield []
+                continue
+            frames = []
+            pos = offset + first
+            for _ in range(num_pkts):
+                next_offset, sec, nsec, snaplen, _, _, mac = unpack_packet(self.map, pos)
+                start = pos + mac
+                frames.append((sec + nsec / 1e9, view[start:start + snaplen]))
+                pos += next_offset
+            try:
+                yield frames
+            finally:
+                # 调用者处理完这一块（或者关闭生成器）后交还给内核
+                del frames
+                struct.pack_into('=I', self.map, offset + BLOCK_STATUS_OFFSET, TP_STATUS_KERNEL)
+                self.current = (self.current + 1) % self.block_nr
+
+    def stats(self):
+        """ 返回上次调用之后内核收到和丢弃的报文数 """
+        packets, drops, _ = TPACKET_STATS_V3.unpack(self.sock.getsockopt(
+            SOL_PACKET, PACKET_STATISTICS, TPACKET_STATS_V3.size))
+        return packets, drops
+
+    def close(self):
+        self.sock.close()
+        try:
+            self.view.release()
+            self.map.close()
+        except BufferError:
+            # 调用者仍然持有某个帧的memoryview，映射在它们被回收时释放
+            pass
@@ -0,0 +1,204 @@
+# -*- coding: UTF-8 -*-
+"""
+TCP流重组：按序列号把报文的载荷拼接成字节流，再用一个跨越报文边界的滑动
+窗口扫描，一个卡号被拆分到两个报文中时也能找到
+
+- 以(src, sport, dst, dport)为键，每个方向是一个独立的流
+- 乱序到达的报文暂存起来，等缺失的部分到达后按顺序交付；重传的部分被丢弃
+- 流的数量、每个流暂存的字节数和所有流暂存的总字节数都有上限，超过时按LRU
+  顺序淘汰最久没有报文的流；空闲超过idle_timeout的流也会被淘汰
+- 时间使用报文的时间戳，离线分析pcap文件时与实时抓包的行为相同
+
+    table = FlowTable(scan, report)
+    table.add(ts, (src, sport, dst, dport), seq, flags, payload)
+    table.close()
+
+scan(data)返回[(匹配结束的位置, 结果)]；report(key, 结果)在每个新的匹配
+上调用一次。
+"""
+from __future__ import print_function
+import collections
+
+TH_FIN = 0x01
+TH_SYN = 0x02
+TH_RST = 0x04
+
+
+def seq_diff(a, b):
+    """ 序列号a - b，考虑32位回绕 """
+    diff = (a - b) & 0xffffffff
+    return diff - 0x100000000 if diff & 0x80000000 else diff
+
+
+class Stream(object):
+    __slots__ = ('next_seq', 'offset', 'tail', 'reported', 'pending',
+                 'buffered', 'last_seen', 'fin_seq')
+
+    def __init__(self, seq, ts):
+        # 下一个应该交付的序列号，以及它在流中的偏移
+        self.next_seq = seq
+        self.offset = 0
+        # 上次扫描的窗口的末尾，与新的数据一起扫描
+        self.tail = b''
+        # 已经报告过的匹配的结束位置（流中的偏移）
+        self.reported = 0
+        # 序列号 -> 乱序到达的载荷
+        self.pending = {}
+        self.buffered = 0
+        self.last_seen = ts
+        # FIN之前的数据全部交付后流才结束
+        self.fin_seq = None
+
+
+class FlowTable(object):
+
+    def __init__(self, scan, report, overlap=32, max_flows=100000,
+                 idle_timeout=120, max_flow_buffer=64 << 10, max_buffer=64 << 20):
+        """ overlap必须大于最长的匹配 """
+        self.scan = scan
+        self.report = report
+        self.overlap = overlap
+        self.max_flows = max_flows
+        self.idle_timeout = idle_timeout
+        self.max_flow_buffer = max_flow_buffer
+        self.max_buffer = max_buffer
+        # 按最后一个报文的时间排序，最久没有报文的在最前面
+        self.flows = collections.OrderedDict()
+        self.buffered = 0
+        self.last_expire = 0
+        self.stats = collections.Counter()
+
+    def add(self, ts, key, seq, flags, payload):
+        stream = self.flows.pop(key, None)
+        if flags & TH_RST:
+            if stream is not None:
+                self.finish(key, stream, 'reset')
+            return
+        if flags & TH_SYN:
+            if stream is not None:
+                # 同一个四元组上的新连接
+                self.finish(key, stream, 'reused')
+            stream = Stream((seq + 1) & 0xffffffff, ts)
+            seq = stream.next_seq
+            self.stats['flows'] += 1
+        elif stream is None:
+            if not payload:
+                return
+            # 抓包开始前建立的连接，从第一个有数据的报文开始
+            stream = Stream(seq, ts)
+            self.stats['flows'] += 1
+            self.stats['midstream'] += 1
+        stream.last_seen = ts
+        self.flows[key] = stream
+
+        if payload:
+            if seq_diff(seq, stream.next_seq) <= 0:
+                self.append(key, stream, seq, payload)
+                if stream.pending:
+                    self.drain(key, stream)
+            else:
+                self.hold(key, stream, seq, payload)
+        if flags & TH_FIN:
+            stream.fin_seq = (seq + len(payload)) & 0xffffffff
+        if stream.fin_seq is not None and seq_diff(stream.next_seq, stream.fin_seq) >= 0:
+            del self.flows[key]
+            self.finish(key, stream, 'closed')
+
+        while len(self.flows) > self.max_flows:
+            self.evict('evicted_lru')
+        while self.flows and self.buffered > self.max_buffer:
+            self.evict('evicted_memory')
+        if ts - self.last_expire >= 1:
+            self.expire(ts)
+
+    def append(self, key, stream, seq, data):
+        """ 交付从seq开始的数据，seq不晚于next_seq """
+        skip = seq_diff(stream.next_seq, seq)
+        if skip >= len(data):
+            self.stats['retransmitted_bytes'] += len(data)
+            return
+        if skip:
+            self.stats['retransmitted_bytes'] += skip
+            data = data[skip:]
+        self.deliver(key, stream, data)
+        stream.next_seq = (stream.next_seq + len(data)) & 0xffffffff
+
+    def deliver(self, key, stream, data, final=False):
+        tail = stream.tail
+        window = tail + data
+        base = stream.offset - len(tail)
+        for end, item in self.scan(window):
+            # 结束在tail中的匹配上次已经扫描过；结束在窗口末尾的匹配后面
+            # 可能还有数据，等下一次交付或者流结束时再报告
+            if end < len(tail) or (end == len(window) and not final):
+                continue
+            if base + end > stream.reported:
+                stream.reported = base + end
+                self.report(key, item)
+        stream.offset += len(data)
+        stream.tail = window[-self.overlap:]
+
+    def hold(self, key, stream, seq, data):
+        """ 暂存乱序的报文，超过每个流的上限时放弃等待缺失的部分 """
+        old = stream.pending.get(seq)
+        if old is not None:
+            if len(old) >= len(data):
+                self.stats['retransmitted_bytes'] += len(data)
+                return
+            self.unbuffer(stream, len(old))
+        stream.pending[seq] = data
+        stream.buffered += len(data)
+        self.buffered += len(data)
+        while stream.buffered > self.max_flow_buffer:
+            self.skip_gap(stream)
+            self.drain(key, stream)
+
+    def skip_gap(self, stream):
+        first = min(stream.pending, key=lambda s: seq_diff(s, stream.next_seq))
+        gap = seq_diff(first, stream.next_seq)
+        self.stats['gaps'] += 1
+        self.stats['gap_bytes'] += gap
+        stream.offset += gap
+        # 缺失的数据前后的内容不能拼接在一起扫描
+        stream.tail = b''
+        stream.next_seq = first
+
+    def drain(self, key, stream):
+        """ 交付已经连续的暂存数据 """
+        while stream.pending:
+            ready = [s for s in stream.pending if seq_diff(s, stream.next_seq) <= 0]
+            if not ready:
+                break
+            for seq in sorted(ready, key=lambda s: seq_diff(s, stream.next_seq)):
+                data = stream.pending.pop(seq)
+                self.unbuffer(stream, len(data))
+                self.append(key, stream, seq, data)
+
+    def unbuffer(self, stream, size):
+        stream.buffered -= size
+        self.buffered -= size
+
+    def finish(self, key, stream, reason):
+        """ 报告留在窗口末尾的匹配，丢弃仍在等待的乱序数据 """
+        self.deliver(key, stream, b'', final=True)
+        if stream.pending:
+            self.stats['dropped_bytes'] += stream.buffered
+            self.unbuffer(stream, stream.buffered)
+            stream.pending.clear()
+        self.stats[reason] += 1
+
+    def evict(self, reason):
+        key, stream = self.flows.popitem(last=False)
+        self.finish(key, stream, reason)
+
+    def expire(self, now):
+        self.last_expire = now
+        while self.flows:
+            key = next(iter(self.flows))
+            if now - self.flows[key].last_seen < self.idle_timeout:
+                break
+            self.evict('expired')
+
+    def close(self):
+        while self.flows:
+            self.evict('flushed')
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+并行地部署到多台主机：连接、执行命令、上传文件
+
+depoly_monitor_with_paramiko.py依次处理hosts中的每台主机，连接超时为300秒，
+一台主机没有响应就会让后面的所有主机一起等待。这里：
+
+- 最多--workers台主机同时进行，每一步都有超时时间：TCP连接和SSH握手
+  （--connect-timeout）、命令执行（--command-timeout）、文件上传
+  （--transfer-timeout）
+- 收集每台主机的退出码、输出和错误，最后输出汇总，失败的主机写入
+  --failed-file，修复后可以只重试这些主机
+- 所有主机都成功时退出码为0
+- 连接由ssh_pool.ConnectionCache管理：一台主机上的多个--command和所有
+  上传的文件共用一个连接和一个SFTP会话，主机处理完后关闭连接
+
+    $ python parallel_deploy.py --hosts hosts --user pi --password yangyi
+    $ python parallel_deploy.py --hosts failed.txt --workers 50 --command 'uptime' --json
+    $ python parallel_deploy.py --hosts hosts --put monitor.py:/usr/local/bin/monitor.py:755
+    $ python parallel_deploy.py --hosts hosts --command 'mkdir -p bin' --command 'uptime'
+
+hosts文件中每行一台主机，可以写成host:port，空行和#开头的行被忽略，
+有格式错误的行时直接退出，不部署任何主机。
+在本机测试时可以用容器启动若干个sshd：
+
+    $ docker run -d -p 2201:2222 -e PASSWORD_ACCESS=true -e USER_PASSWORD=yangyi \\
+          -e USER_NAME=pi linuxserver/openssh-server
+"""
+from __future__ import division
+from __future__ import print_function
+import argparse
+import collections
+import json
+import logging
+import socket
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+import paramiko
+
+from ssh_pool import ConnectionCache, StepTimeout, client_factory
+
+DeployResult = collections.namedtuple(
+    'DeployResult', 'host ok exit_status stdout stderr error elapsed')
+
+
+def check_host(host):
+    """ host或host:port，与ssh_pool.split_host的写法相同，端口必须是1-65535 """
+    if host.count(':') != 1:
+        return True
+    name, port = host.split(':')
+    return bool(name) and port.isdigit() and 1 <= int(port) <= 65535
+
+
+def read_hosts(filename):
+    """ 有格式错误的行时抛出ValueError，指出所在的行，一台主机也不部署 """
+    hosts = []
+    with open(filename) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if not check_host(line):
+                raise ValueError("{0}:{1}: invalid host '{2}', expected host or "
+                                 "host:port".format(filename, lineno, line))
+            hosts.append(line)
+    return hosts
+
+
+def parse_put(spec):
+    """ 本地文件[:远程路径[:权限]]，权限为八进制 """
+    parts = spec.split(':')
+    local = parts[0]
+    remote = parts[1] if len(parts) > 1 and parts[1] else local.split('/')[-1]
+    mode = int(parts[2], 8) if len(parts) > 2 else None
+    return local, remote, mode
+
+
+def deploy(host, args, cache):
+    start = time.time()
+    exit_status, stdout, stderr, error = None, [], [], None
+    try:
+        # 依次执行每个命令，有命令失败时不再执行后面的命令
+        for command in args.command:
+            exit_status, out, err = cache.run(host, command, args.command_timeout)
+            stdout.append(out)
+            stderr.append(err)
+            if exit_status != 0:
+                break
+        if args.files and (exit_status in (None, 0) or args.keep_going):
+            with cache.sftp(host, args.transfer_timeout) as sftp:
+                for local, remote, mode in args.files:
+                    sftp.put(local, remote)
+                    if mode is not None:
+                        sftp.chmod(remote, mode)
+    except StepTimeout as e:
+        error = str(e)
+    except socket.timeout:
+        error = 'timed out'
+    except paramiko.AuthenticationException as e:
+        error = 'authentication failed: {0}'.format(e)
+    except (paramiko.SSHException, socket.error, IOError) as e:
+        error = '{0}: {1}'.format(e.__class__.__name__, e)
+    except Exception as e:
+        # 其他异常（如连接中途断开时paramiko抛出的EOFError）只影响这台主机，
+        # 不能让imap_unordered中断，丢掉其他主机的结果
+        error = '{0}: {1}'.format(e.__class__.__name__, e)
+    finally:
+        cache.close(host)
+    ok = error is None and exit_status in (None, 0)
+    return DeployResult(host, ok, exit_status, ''.join(stdout), ''.join(stderr), error,
+                        time.time() - start)
+
+
+def print_result(result, as_json=False):
+    if as_json:
+        print(json.dumps(result._asdict()))
+    elif result.ok:
+        print("{0:<24} ok      {1:6.2f}s".format(result.host, result.elapsed))
+    else:
+        lines = result.stderr.strip().splitlines()
+        reason = result.error or 'exit status {0}: {1}'.format(
+            result.exit_status, lines[-1] if lines else '')
+        print("{0:<24} FAILED  {1:6.2f}s  {2}".format(result.host, result.elapsed, reason))
+    sys.stdout.flush()
+
+
+def summarize(results, elapsed, out=sys.stderr):
+    ok = [r for r in results if r.ok]
+    failed = [r for r in results if not r.ok]
+    print("\n{0} hosts in {1:.1f}s: {2} ok, {3} failed".format(
+        len(results), elapsed, len(ok), len(failed)), file=out)
+    reasons = collections.Counter(
+        (r.error.split(':')[0] if r.error else 'exit status {0}'.format(r.exit_status))
+        for r in failed)
+    for reason, count in reasons.most_common():
+        print("  {0:>5}  {1}".format(count, reason), file=out)
+    if results:
+        times = sorted(r.elapsed for r in results)
+        print("per host: median {0:.2f}s, slowest {1:.2f}s ({2})".format(
+            times[len(times) // 2], times[-1],
+            max(results, key=lambda r: r.elapsed).host), file=out)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='deploy to many hosts over SSH in parallel')
+    parser.add_argument('--hosts', default='hosts', help='file with one host per line')
+    parser.add_argument('--user', default='pi')
+    parser.add_argument('--password', help='default: use ssh-agent and ~/.ssh keys')
+    parser.add_argument('--key-file')
+    parser.add_argument('--port', type=int, default=22)
+    parser.add_argument('--command', action='append', default=[],
+                        help="command to run, may be repeated (default: 'ls -l')")
+    parser.add_argument('--put', action='append', default=[],
+                        metavar='LOCAL[:REMOTE[:MODE]]',
+                        help='file to upload, may be repeated')
+    parser.add_argument('--workers', type=int, default=20,
+                        help='hosts handled at the same time')
+    parser.add_argument('--connect-timeout', type=float, default=10)
+    parser.add_argument('--command-timeout', type=float, default=60)
+    parser.add_argument('--transfer-timeout', type=float, default=60)
+    parser.add_argument('--keep-going', action='store_true',
+                        help='upload files even if the command failed')
+    parser.add_argument('--failed-file', default='failed.txt')
+    parser.add_argument('--json', action='store_true', help='print one JSON record per host')
+    args = parser.parse_args()
+    # 错误已经记录在每台主机的结果中，不需要paramiko在后台线程中再输出
+    logging.getLogger('paramiko').addHandler(logging.NullHandler())
+    if not args.put:
+        args.put = ['depoly_monitor_with_paramiko.py::755']
+    args.files = [parse_put(spec) for spec in args.put]
+    # --command ''表示不执行命令
+    args.command = [c for c in args.command or ['ls -l'] if c]
+
+    try:
+        hosts = read_hosts(args.hosts)
+    except ValueError as e:
+        parser.error(str(e))
+    start = time.time()
+    pool = ThreadPool(min(args.workers, len(hosts)) or 1)
+    results = []
+    cache = ConnectionCache(client_factory(user=args.user, password=args.password,
+                                           key_file=args.key_file, port=args.port,
+                                           timeout=args.connect_timeout))
+    try:
+        for result in pool.imap_unordered(lambda host: deploy(host, args, cache), hosts):
+            results.append(result)
+            print_result(result, args.json)
+    finally:
+        pool.close()
+        pool.join()
+        cache.close()
+
+    failed = summarize(results, time.time() - start)
+    with open(args.failed_file, 'w') as f:
+        for result in failed:
+            f.write(result.host + '\n')
+    if failed:
+        print("failed hosts written to {0}".format(args.failed_file), file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
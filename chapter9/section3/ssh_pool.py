@@ -0,0 +1,354 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+SSH连接缓存：每台主机保持一个已经认证的连接，重复执行命令时不再进行TCP握手、
+密钥交换和认证
+
+- 同一个连接上可以同时打开多个channel，每个命令一个；同时使用的channel数
+  不超过max_sessions（OpenSSH的MaxSessions默认为10）
+- 每台主机的SFTP会话也被缓存，上传多个文件时共用
+- 空闲超过idle_timeout的连接被关闭，连接数超过max_connections时关闭最久
+  没有使用的连接；连接断开后下次使用时自动重连
+
+    cache = ConnectionCache(client_factory(user='pi', password='yangyi'))
+    status, out, err = cache.run('192.168.1.10', 'uptime')
+    cache.put('192.168.1.10', 'monitor.py', 'monitor.py', 0o755)
+    cache.close()
+
+    $ python ssh_pool.py --benchmark 192.168.1.10 --user pi --password yangyi --count 200
+"""
+from __future__ import division
+from __future__ import print_function
+import argparse
+import collections
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+import paramiko
+
+
+class StepTimeout(Exception):
+    pass
+
+
+def split_host(host, default_port=22):
+    if host.count(':') == 1:
+        name, port = host.split(':')
+        return name, int(port)
+    return host, default_port
+
+
+def connect(host, user=None, password=None, key_file=None, port=22, timeout=10):
+    """ 返回已经认证的paramiko.SSHClient，host可以写成host:port """
+    name, port = split_host(host, port)
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        # timeout同时限制TCP连接和SSH协商，协商超时后paramiko不报错，到认证时才
+        # 失败，因此让banner_timeout先到期，得到明确的错误
+        client.connect(name, port, username=user, password=password,
+                       key_filename=key_file, timeout=timeout + 1,
+                       banner_timeout=timeout, auth_timeout=timeout,
+                       allow_agent=password is None, look_for_keys=password is None)
+    except Exception:
+        client.close()
+        raise
+    # 每个命令只有几个很小的报文，Nagle算法和对方的延迟确认会让每次请求
+    # 多等待40毫秒
+    client.get_transport().sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return client
+
+
+def client_factory(**kwargs):
+    """ 返回ConnectionCache使用的连接函数，参数与connect相同 """
+    return lambda host: connect(host, **kwargs)
+
+
+def run_command(client, command, timeout):
+    """ 返回(退出码, 标准输出, 标准错误)，超过timeout秒没有结束时抛出StepTimeout """
+    channel = client.get_transport().open_session(timeout=timeout)
+    return exec_channel(channel, command, timeout)
+
+
+def exec_channel(channel, command, timeout):
+    """ 在打开的channel上执行命令，结束后关闭channel """
+    try:
+        channel.settimeout(timeout)
+        channel.exec_command(command)
+        deadline = time.time() + timeout
+        stdout, stderr = [], []
+        # 同时读取两个输出，避免其中一个的缓冲区写满后远程命令阻塞
+        while not (channel.exit_status_ready() and not channel.recv_ready()
+                   and not channel.recv_stderr_ready()):
+            if time.time() > deadline:
+                raise StepTimeout('command timed out after {0}s'.format(timeout))
+            if channel.recv_ready():
+                stdout.append(channel.recv(32768))
+            elif channel.recv_stderr_ready():
+                stderr.append(channel.recv_stderr(32768))
+            else:
+                channel.status_event.wait(0.05)
+        return (channel.recv_exit_status(), b''.join(stdout).decode('utf-8', 'replace'),
+                b''.join(stderr).decode('utf-8', 'replace'))
+    finally:
+        channel.close()
+
+
+class Connection(object):
+    """ 缓存中的一台主机 """
+
+    def __init__(self, host, max_sessions):
+        self.host = host
+        self.client = None
+        self.sftp_client = None
+        # 建立连接时持有，同一台主机只连接一次
+        self.lock = threading.Lock()
+        self.sftp_lock = threading.Lock()
+        self.sessions = threading.BoundedSemaphore(max_sessions)
+        self.in_use = 0
+        self.last_used = time.time()
+
+    @property
+    def active(self):
+        transport = self.client.get_transport() if self.client else None
+        return transport is not None and transport.is_active()
+
+    def close_sftp(self):
+        if self.sftp_client is not None:
+            self.sftp_client.close()
+            self.sftp_client = None
+            self.sessions.release()
+
+    def close(self):
+        self.close_sftp()
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+
+class ConnectionCache(object):
+
+    def __init__(self, connect, idle_timeout=300, max_connections=1000,
+                 max_sessions=10, keepalive=30, reap_interval=None):
+        """ connect(host)返回已经认证的SSHClient；reap_interval不为None时
+        启动一个后台线程定期关闭空闲的连接，否则只在每次使用时检查。
+        使用SFTP时max_sessions至少为2，缓存的SFTP会话占用其中一个 """
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.max_sessions = max_sessions
+        self.keepalive = keepalive
+        # 按最后使用的时间排序
+        self.connections = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.last_reap = time.time()
+        self.stats = collections.Counter()
+        self.reaper = None
+        self.closed = threading.Event()
+        if reap_interval:
+            self.reaper = threading.Thread(target=self.reap_loop, args=(reap_interval,))
+            self.reaper.daemon = True
+            self.reaper.start()
+
+    @contextmanager
+    def connection(self, host):
+        """ 得到host已经连接好的Connection，使用期间不会被当作空闲连接关闭 """
+        conn = self.acquire(host)
+        try:
+            with conn.lock:
+                if not conn.active:
+                    if conn.client is not None:
+                        self.stats['reconnects'] += 1
+                    conn.close()
+                    conn.client = self.connect(host)
+                    conn.client.get_transport().set_keepalive(self.keepalive)
+                    self.stats['connects'] += 1
+                else:
+                    self.stats['reused'] += 1
+            yield conn
+        finally:
+            self.release(conn)
+
+    def acquire(self, host):
+        now = time.time()
+        with self.lock:
+            conn = self.connections.pop(host, None)
+            if conn is None:
+                conn = Connection(host, self.max_sessions)
+            self.connections[host] = conn
+            conn.in_use += 1
+            conn.last_used = now
+            idle = self.collect(now)
+        self.close_connections(idle)
+        return conn
+
+    def release(self, conn):
+        with self.lock:
+            conn.in_use -= 1
+            conn.last_used = time.time()
+            # 移到末尾，collect遇到第一个没有过期的连接就可以停止
+            if self.connections.get(conn.host) is conn:
+                self.connections[conn.host] = self.connections.pop(conn.host)
+
+    def collect(self, now, force=False):
+        """ 在持有self.lock时调用，从缓存中移除空闲和多余的连接并返回 """
+        removed = []
+        if force or now - self.last_reap >= 1:
+            self.last_reap = now
+            for host, conn in list(self.connections.items()):
+                if now - conn.last_used < self.idle_timeout:
+                    break
+                if not conn.in_use:
+                    removed.append(self.connections.pop(host))
+                    self.stats['idle_closed'] += 1
+        if len(self.connections) > self.max_connections:
+            for host, conn in list(self.connections.items()):
+                if len(self.connections) <= self.max_connections:
+                    break
+                if not conn.in_use:
+                    removed.append(self.connections.pop(host))
+                    self.stats['evicted'] += 1
+        return removed
+
+    def close_connections(self, connections):
+        # 关闭连接可能需要等待网络，不在持有self.lock时进行
+        for conn in connections:
+            with conn.lock:
+                conn.close()
+
+    def run(self, host, command, timeout=60):
+        """ 在缓存的连接上打开一个新的channel执行命令 """
+        with self.connection(host) as conn:
+            with conn.sessions:
+                try:
+                    channel = conn.client.get_transport().open_session(timeout=timeout)
+                except (paramiko.SSHException, EOFError):
+                    # 服务器关闭了空闲的连接。命令还没有开始执行，重新连接
+                    # 后再试一次是安全的
+                    if conn.active:
+                        raise
+                    channel = None
+                if channel is not None:
+                    return exec_channel(channel, command, timeout)
+        with self.connection(host) as conn:
+            with conn.sessions:
+                return run_command(conn.client, command, timeout)
+
+    @contextmanager
+    def sftp(self, host, timeout=60):
+        """ 得到host的SFTPClient，同一台主机的SFTP会话被依次使用；会话一直
+        占用一个channel，直到连接被关闭 """
+        with self.connection(host) as conn:
+            with conn.sftp_lock:
+                sftp = conn.sftp_client
+                if sftp is None or sftp.get_channel().closed:
+                    conn.close_sftp()
+                    conn.sessions.acquire()
+                    try:
+                        conn.sftp_client = sftp = conn.client.open_sftp()
+                    except Exception:
+                        conn.sessions.release()
+                        raise
+                    self.stats['sftp_opened'] += 1
+                sftp.get_channel().settimeout(timeout)
+                yield sftp
+
+    def put(self, host, local, remote, mode=None, timeout=60):
+        with self.sftp(host, timeout) as sftp:
+            sftp.put(local, remote)
+            if mode is not None:
+                sftp.chmod(remote, mode)
+
+    def reap_loop(self, interval):
+        while not self.closed.wait(interval):
+            with self.lock:
+                idle = self.collect(time.time(), force=True)
+            self.close_connections(idle)
+
+    def close(self, host=None):
+        """ 关闭一台主机或者所有主机的连接 """
+        with self.lock:
+            if host is None:
+                removed = list(self.connections.values())
+                self.connections.clear()
+                self.closed.set()
+            else:
+                removed = [self.connections.pop(host)] if host in self.connections else []
+        self.close_connections(removed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def benchmark(args):
+    factory = client_factory(user=args.user, password=args.password,
+                             key_file=args.key_file, timeout=args.timeout)
+    host = args.benchmark
+
+    def report(name, count, elapsed):
+        print("{0:<36} {1:5d} in {2:6.2f}s  {3:8.1f}/s".format(
+            name, count, elapsed, count / elapsed))
+
+    # 之前的做法：每个命令一个新的SSHClient
+    start = time.time()
+    for _ in range(args.count // 10 or 1):
+        with factory(host) as client:
+            run_command(client, args.command, args.timeout)
+    report('new connection per command', args.count // 10 or 1, time.time() - start)
+
+    with ConnectionCache(factory, max_sessions=args.sessions) as cache:
+        cache.run(host, args.command)
+        start = time.time()
+        for _ in range(args.count):
+            cache.run(host, args.command)
+        report('cached connection, serial', args.count, time.time() - start)
+
+        pool = ThreadPool(args.sessions)
+        start = time.time()
+        pool.map(lambda _: cache.run(host, args.command), range(args.count))
+        report('cached connection, {0} channels'.format(args.sessions),
+               args.count, time.time() - start)
+        pool.close()
+        pool.join()
+
+        start = time.time()
+        for i in range(args.count // 10 or 1):
+            with factory(host) as client:
+                sftp = client.open_sftp()
+                sftp.put(__file__, 'ssh_pool_benchmark.py')
+                sftp.close()
+        report('new connection per upload', args.count // 10 or 1, time.time() - start)
+
+        start = time.time()
+        for i in range(args.count):
+            cache.put(host, __file__, 'ssh_pool_benchmark.py')
+        report('cached SFTP session per upload', args.count, time.time() - start)
+        cache.run(host, 'rm -f ssh_pool_benchmark.py')
+        print(dict(cache.stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SSH connection cache benchmark')
+    parser.add_argument('--benchmark', metavar='HOST[:PORT]', required=True)
+    parser.add_argument('--user', default='pi')
+    parser.add_argument('--password')
+    parser.add_argument('--key-file')
+    parser.add_argument('--command', default='true')
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=8,
+                        help='channels used at the same time on one connection')
+    parser.add_argument('--timeout', type=float, default=10)
+    args = parser.parse_args()
+    logging.getLogger('paramiko').addHandler(logging.NullHandler())
+    benchmark(args)
+
+
+if __name__ == '__main__':
+    main()
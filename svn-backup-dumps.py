@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # svn-backup-dumps.py -- Create dumpfiles to backup a subversion repository.
 #
@@ -45,6 +45,33 @@
 #    8. Transfer the dumpfile to another host using smb.
 #    9. Transfer the dumpfile to Dropbox
 #
+# Several repositories can be dumped in one run by giving more than
+# one repository path before <dumpdir>:
+#
+#    svn-backup-dumps.py [options] <repos> [<repos> ...] <dumpdir>
+#
+# Every dump file written is recorded in '<dumpdir>/src.manifest'
+# with its revision range, size and sha256 checksum, computed while
+# the file is written. The dump files can be checked against the
+# manifests without running svnadmin:
+#
+#    svn-backup-dumps.py --verify [<repos> ...] <dumpdir>
+#
+#    Without <repos> the manifests of all repositories in <dumpdir>
+#    are checked. --verify-threads sets the number of files checked
+#    in parallel (default 4).
+#
+# To keep a backup from slowing down a busy server, the dump data and
+# the FTP uploads can be rate limited, and the priority of the backup
+# (inherited by svnadmin and the compression commands) can be lowered:
+#
+#    svn-backup-dumps.py --bwlimit-write 20M --bwlimit-transfer 5M \
+#        --nice 10 --ionice-class 3 --progress 10 ...
+#
+# The script requires Python 3. Dump data is passed on as bytes from
+# the svnadmin pipe to the outputs without being decoded, FTP uploads
+# are sent with sendfile(2).
+#
 # See also 'svn-backup-dumps.py -h'.
 #
 #
@@ -105,6 +132,11 @@
 #    src.000000-002923.svndmp.gz
 #    src.002924-003045.svndmp.gz
 #
+#    The head revision and the stat of 'db/current' of each dumped
+#    repository are saved in '<dumpdir>/.svn-backup-state' (see
+#    --state-file). A repository whose 'db/current' is unchanged
+#    since its last dump is skipped without running svnlook.
+#
 #
 # 5. Create gzipped dump files.
 #
@@ -133,6 +165,15 @@
 #    If <path> contains the string '%r' it is replaced by the
 #    repository name (basename of the repository path).
 #
+#    One FTP connection is kept open and reused for all dump files of
+#    a run. Interrupted uploads are retried with an increasing delay
+#    and resumed (REST) at the size already stored on the server:
+#
+#    --ftp-blocksize <n>   Block size for STOR (default 8192).
+#    --ftp-retries <n>     Retries per file (default 3).
+#    --ftp-backoff <sec>   Delay before the first retry, doubled for
+#                          each following retry (default 1).
+#
 #
 # 8. Transfer the dumpfile to another host using smb.
 #
@@ -177,11 +218,15 @@ import gzip
 import os.path
 import re
 from optparse import OptionParser
-from ftplib import FTP
+from ftplib import FTP, all_errors, error_perm
 from subprocess import Popen, PIPE
-import urllib2
+import urllib.request
 import json
 import time
+import hashlib
+import threading
+import queue
+import codecs
 
 try:
     import bz2
@@ -198,11 +243,56 @@ except ImportError:
     have_mechanize = False
 
 
+CHECKSUM_ALGORITHM = "sha256"
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+
+class SvnBackupChecksumFile:
+    """ Writes to a file and computes size and checksum of what's written """
+
+    def __init__(self, absfilename):
+        self.name = absfilename
+        self.__ofd = open(absfilename, "wb")
+        self.__hash = hashlib.new(CHECKSUM_ALGORITHM)
+        self.__size = 0
+
+    def write(self, data):
+        self.__hash.update(data)
+        self.__size += len(data)
+        self.__ofd.write(data)
+
+    def flush(self):
+        self.__ofd.flush()
+
+    def close(self):
+        self.__ofd.close()
+
+    def get_size(self):
+        return self.__size
+
+    def get_checksum(self):
+        return self.__hash.hexdigest()
+
+
+def file_checksum(absfilename):
+    h = hashlib.new(CHECKSUM_ALGORITHM)
+    ifd = open(absfilename, "rb")
+    try:
+        buf = ifd.read(CHECKSUM_CHUNK_SIZE)
+        while len(buf) > 0:
+            h.update(buf)
+            buf = ifd.read(CHECKSUM_CHUNK_SIZE)
+    finally:
+        ifd.close()
+    return h.hexdigest()
+
+
 class SvnBackupOutput:
 
     def __init__(self, abspath, filename):
         self.__filename = filename
         self.__absfilename = os.path.join(abspath, filename)
+        self._ofd = None
 
     def open(self):
         pass
@@ -211,7 +301,8 @@ class SvnBackupOutput:
         pass
 
     def close(self):
-        pass
+        """ Returns False if the output couldn't be written completely """
+        return True
 
     def get_filename(self):
         return self.__filename
@@ -219,6 +310,17 @@ class SvnBackupOutput:
     def get_absfilename(self):
         return self.__absfilename
 
+    def get_size(self):
+        if self._ofd is None:
+            return os.path.getsize(self.__absfilename)
+        return self._ofd.get_size()
+
+    def get_checksum(self):
+        # outputs written by an external command are read back once
+        if self._ofd is None:
+            return file_checksum(self.__absfilename)
+        return self._ofd.get_checksum()
+
 
 class SvnBackupOutputPlain(SvnBackupOutput):
 
@@ -226,13 +328,14 @@ class SvnBackupOutputPlain(SvnBackupOutput):
         SvnBackupOutput.__init__(self, abspath, filename)
 
     def open(self):
-        self.__ofd = open(self.get_absfilename(), "wb")
+        self._ofd = SvnBackupChecksumFile(self.get_absfilename())
 
     def write(self, data):
-        self.__ofd.write(data)
+        self._ofd.write(data)
 
     def close(self):
-        self.__ofd.close()
+        self._ofd.close()
+        return True
 
 
 class SvnBackupOutputGzip(SvnBackupOutput):
@@ -241,8 +344,8 @@ class SvnBackupOutputGzip(SvnBackupOutput):
         SvnBackupOutput.__init__(self, abspath, filename + ".gz")
 
     def open(self):
-        self.__compressor = gzip.GzipFile(filename=self.get_absfilename(),
-                                          mode="wb")
+        self._ofd = SvnBackupChecksumFile(self.get_absfilename())
+        self.__compressor = gzip.GzipFile(fileobj=self._ofd, mode="wb")
 
     def write(self, data):
         self.__compressor.write(data)
@@ -250,6 +353,8 @@ class SvnBackupOutputGzip(SvnBackupOutput):
     def close(self):
         self.__compressor.flush()
         self.__compressor.close()
+        self._ofd.close()
+        return True
 
 
 class SvnBackupOutputBzip2(SvnBackupOutput):
@@ -259,14 +364,15 @@ class SvnBackupOutputBzip2(SvnBackupOutput):
 
     def open(self):
         self.__compressor = bz2.BZ2Compressor()
-        self.__ofd = open(self.get_absfilename(), "wb")
+        self._ofd = SvnBackupChecksumFile(self.get_absfilename())
 
     def write(self, data):
-        self.__ofd.write(self.__compressor.compress(data))
+        self._ofd.write(self.__compressor.compress(data))
 
     def close(self):
-        self.__ofd.write(self.__compressor.flush())
-        self.__ofd.close()
+        self._ofd.write(self.__compressor.flush())
+        self._ofd.close()
+        return True
 
 
 class SvnBackupOutputCommand(SvnBackupOutput):
@@ -291,12 +397,210 @@ class SvnBackupOutputCommand(SvnBackupOutput):
         self.__stdin = proc.stdin
 
     def write(self, data):
-        self.__stdin.write(data)
+        try:
+            self.__stdin.write(data)
+        except BrokenPipeError:
+            # the compressor died, close() reports its exit status
+            pass
 
     def close(self):
-        self.__stdin.close()
+        try:
+            self.__stdin.close()
+        except BrokenPipeError:
+            pass
         rc = self.__proc.wait()
         self.__ofd.close()
+        if rc != 0:
+            print("%s failed with exit status %d, '%s' is incomplete." %
+                  (self.__cmd_path, rc, self.get_absfilename()))
+        return rc == 0
+
+
+class SvnBackupManifest:
+    """ Revision range, size and checksum of every dump file of a repos """
+
+    def __init__(self, dumpdir, reposname):
+        self.__reposname = reposname
+        self.__absfilename = os.path.join(dumpdir, reposname + ".manifest")
+        self.__files = None
+
+    def get_absfilename(self):
+        return self.__absfilename
+
+    def get_files(self):
+        if self.__files is None:
+            self.__files = {}
+            if os.path.exists(self.__absfilename):
+                ifd = open(self.__absfilename, "r")
+                try:
+                    self.__files = json.load(ifd)["files"]
+                finally:
+                    ifd.close()
+        return self.__files
+
+    def record(self, filename, fromrev, torev, size, checksum):
+        self.get_files()[filename] = {
+            "fromrev": fromrev,
+            "torev": torev,
+            "size": size,
+            CHECKSUM_ALGORITHM: checksum,
+            "time": int(time.time()),
+        }
+        self.save()
+
+    def forget(self, filename):
+        if filename in self.get_files():
+            del self.get_files()[filename]
+            self.save()
+
+    def save(self):
+        # write a new file and rename it, a crash never leaves half a manifest
+        tmpfilename = self.__absfilename + ".tmp"
+        ofd = open(tmpfilename, "w")
+        try:
+            json.dump({"repos": self.__reposname, "files": self.get_files()},
+                      ofd, indent=2, sort_keys=True)
+        finally:
+            ofd.close()
+        os.rename(tmpfilename, self.__absfilename)
+
+
+def verify_file(dumpdir, filename, entry):
+    absfilename = os.path.join(dumpdir, filename)
+    if not os.path.exists(absfilename):
+        return "missing"
+    size = os.path.getsize(absfilename)
+    if size != entry["size"]:
+        return "size is %d, expected %d" % (size, entry["size"])
+    if file_checksum(absfilename) != entry[CHECKSUM_ALGORITHM]:
+        return "%s checksum mismatch" % CHECKSUM_ALGORITHM
+    return None
+
+
+def verify_dumps(dumpdir, reposnames=None, threads=4):
+    """ Check all dump files listed in the manifests of dumpdir """
+    if reposnames is None:
+        reposnames = [f[:-len(".manifest")] for f in os.listdir(dumpdir)
+                      if f.endswith(".manifest")]
+    filename_regex = re.compile(r"(.+)\.\d+(-\d+)?\.svndmp.*")
+    jobs = queue.Queue()
+    recorded = set()
+    total = 0
+    for reposname in reposnames:
+        manifest = SvnBackupManifest(dumpdir, reposname)
+        if not os.path.exists(manifest.get_absfilename()):
+            print("%s: no manifest." % reposname)
+            continue
+        for filename, entry in sorted(manifest.get_files().items()):
+            jobs.put((filename, entry))
+            recorded.add(filename)
+            total += entry["size"]
+    for filename in sorted(os.listdir(dumpdir)):
+        m = filename_regex.match(filename)
+        if m and m.group(1) in reposnames and filename not in recorded:
+            print("%s: not in manifest, not verified." % filename)
+
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                filename, entry = jobs.get_nowait()
+            except queue.Empty:
+                return
+            error = verify_file(dumpdir, filename, entry)
+            if error:
+                with lock:
+                    errors.append(filename)
+                    print("%s: %s" % (filename, error))
+
+    start = time.time()
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for thr in workers:
+        thr.start()
+    for thr in workers:
+        thr.join()
+    elapsed = max(time.time() - start, 0.001)
+    print("verified %d files, %.1f MB in %.1fs (%.1f MB/s), %d errors." %
+          (len(recorded), total / 1048576.0, elapsed,
+           total / 1048576.0 / elapsed, len(errors)))
+    return len(errors) == 0
+
+
+class SvnBackupDumpDir:
+    """ Last dumped revision of every repos, from one listing of dumpdir """
+
+    cache = {}
+
+    def __init__(self, dumpdir):
+        filename_regex = re.compile(r"(.+)\.\d+-(\d+)\.svndmp.*")
+        self.__highest_revs = {}
+        for filename in os.listdir(dumpdir):
+            m = filename_regex.match(filename)
+            if m:
+                self.update(m.group(1), int(m.group(2)))
+
+    @classmethod
+    def get(cls, dumpdir):
+        if dumpdir not in cls.cache:
+            cls.cache[dumpdir] = cls(dumpdir)
+        return cls.cache[dumpdir]
+
+    def get_last_dumped_rev(self, reposname):
+        # -1 so the next one will be rev 0
+        return self.__highest_revs.get(reposname, -1)
+
+    def update(self, reposname, rev_end):
+        if rev_end > self.__highest_revs.get(reposname, -1):
+            self.__highest_revs[reposname] = rev_end
+
+
+class SvnBackupState:
+    """ Head revision and db/current stat of every repos at its last dump """
+
+    cache = {}
+
+    def __init__(self, absfilename):
+        self.__absfilename = absfilename
+        self.__repos = {}
+        if os.path.exists(absfilename):
+            ifd = open(absfilename, "r")
+            try:
+                self.__repos = json.load(ifd)
+            except ValueError:
+                # a broken state file only costs one svnlook per repos
+                self.__repos = {}
+            ifd.close()
+
+    @classmethod
+    def get(cls, absfilename):
+        if absfilename not in cls.cache:
+            cls.cache[absfilename] = cls(absfilename)
+        return cls.cache[absfilename]
+
+    def is_unchanged(self, repospath, st, last_dumped_rev):
+        state = self.__repos.get(os.path.abspath(repospath))
+        return state is not None and \
+            state["rev"] == last_dumped_rev and \
+            state["mtime"] == st.st_mtime and \
+            state["size"] == st.st_size and \
+            state["ino"] == st.st_ino
+
+    def update(self, repospath, st, rev):
+        self.__repos[os.path.abspath(repospath)] = {
+            "rev": rev,
+            "mtime": st.st_mtime,
+            "size": st.st_size,
+            "ino": st.st_ino,
+        }
+        tmpfilename = self.__absfilename + ".tmp"
+        ofd = open(tmpfilename, "w")
+        try:
+            json.dump(self.__repos, ofd, indent=2, sort_keys=True)
+        finally:
+            ofd.close()
+        os.rename(tmpfilename, self.__absfilename)
 
 
 class SvnBackupException(Exception):
@@ -308,6 +612,254 @@ class SvnBackupException(Exception):
         return self.errortext
 
 
+class SvnBackupRateLimiter:
+    """ Token bucket, consume() sleeps while more than rate bytes/s pass """
+
+    cache = {}
+
+    def __init__(self, rate):
+        self.__rate = rate
+        self.__tokens = rate
+        self.__last = time.time()
+
+    @classmethod
+    def get(cls, key, rate):
+        if key not in cls.cache:
+            cls.cache[key] = cls(rate)
+        return cls.cache[key]
+
+    def consume(self, nbytes):
+        if self.__rate <= 0:
+            return
+        now = time.time()
+        # at most one second worth of bytes may be sent in a burst
+        self.__tokens = min(self.__rate,
+                            self.__tokens + (now - self.__last) * self.__rate)
+        self.__last = now
+        self.__tokens -= nbytes
+        if self.__tokens < 0:
+            time.sleep(-self.__tokens / float(self.__rate))
+
+
+class SvnBackupThroughput:
+    """ Counts bytes and prints the throughput every interval seconds """
+
+    def __init__(self, label, interval):
+        self.__label = label
+        self.__interval = interval
+        self.__bytes = 0
+        self.__start = time.time()
+        self.__last = self.__start
+        self.__last_bytes = 0
+
+    def add(self, nbytes):
+        self.__bytes += nbytes
+        if self.__interval <= 0:
+            return
+        now = time.time()
+        if now - self.__last >= self.__interval:
+            rate = (self.__bytes - self.__last_bytes) / (now - self.__last)
+            print("  %s: %.1f MB, %.2f MB/s" % (self.__label,
+                                                self.__bytes / 1048576.0,
+                                                rate / 1048576.0))
+            self.__last = now
+            self.__last_bytes = self.__bytes
+
+    def finish(self):
+        if self.__interval <= 0:
+            return
+        elapsed = max(time.time() - self.__start, 0.001)
+        print("  %s: %.1f MB in %.1fs, %.2f MB/s" % (self.__label,
+                                                     self.__bytes / 1048576.0,
+                                                     elapsed,
+                                                     self.__bytes / 1048576.0 /
+                                                     elapsed))
+
+
+class SvnBackupOutputThrottle:
+    """ Limits and measures the dump data passed to another output """
+
+    def __init__(self, output, limiter, meter):
+        self.__output = output
+        self.__limiter = limiter
+        self.__meter = meter
+
+    def write(self, data):
+        self.__limiter.consume(len(data))
+        self.__output.write(data)
+        self.__meter.add(len(data))
+
+
+def parse_size(value):
+    """ '512K', '10M' or '1G' as a number of bytes """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if value[-1:].upper() in units:
+        return int(float(value[:-1]) * units[value[-1:].upper()])
+    return int(value)
+
+
+def set_priority(niceness=None, ioclass=None, iolevel=None):
+    """ Lower the priority of this process, inherited by svnadmin & co """
+    if niceness:
+        os.nice(niceness)
+    if ioclass is not None:
+        cmd = ["ionice", "-c", str(ioclass), "-p", str(os.getpid())]
+        if iolevel is not None:
+            cmd[3:3] = ["-n", str(iolevel)]
+        try:
+            proc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=False)
+        except OSError:
+            raise SvnBackupException("ionice failed:\n  %s" %
+                                     str(sys.exc_info()[1]))
+        err = proc.communicate()[1]
+        if proc.returncode != 0:
+            raise SvnBackupException("ionice failed:\n  %s" %
+                                     err.decode("utf-8", "replace").strip())
+
+
+class SvnBackupFtpTransport:
+    """ Keeps one FTP connection per server open for all uploads of a run """
+
+    pool = {}
+
+    def __init__(self, host, user, passwd, blocksize=8192, retries=3,
+                 backoff=1.0, bwlimit=0, progress=0):
+        self.__host = host
+        self.__user = user
+        self.__passwd = passwd
+        self.__blocksize = blocksize
+        self.__retries = retries
+        self.__backoff = backoff
+        # shared by all uploads, the limit holds across files
+        self.__limiter = SvnBackupRateLimiter(bwlimit)
+        self.__progress = progress
+        self.__ftp = None
+        self.__home = None
+        self.__cwd = None
+
+    @classmethod
+    def get(cls, host, user, passwd, blocksize=8192, retries=3, backoff=1.0,
+            bwlimit=0, progress=0):
+        key = (host, user, passwd)
+        if key not in cls.pool:
+            cls.pool[key] = cls(host, user, passwd, blocksize, retries,
+                                backoff, bwlimit, progress)
+        return cls.pool[key]
+
+    @classmethod
+    def close_all(cls):
+        for transport in cls.pool.values():
+            transport.close()
+        cls.pool.clear()
+
+    def connect(self):
+        if self.__ftp is None:
+            self.__ftp = FTP(self.__host, self.__user, self.__passwd)
+            self.__home = self.__ftp.pwd()
+            self.__cwd = self.__home
+        return self.__ftp
+
+    def reset(self):
+        # drop a broken connection, the next call reconnects
+        if self.__ftp is not None:
+            try:
+                self.__ftp.close()
+            except all_errors:
+                pass
+        self.__ftp = None
+        self.__cwd = None
+
+    def close(self):
+        if self.__ftp is not None:
+            try:
+                self.__ftp.quit()
+            except all_errors:
+                pass
+        self.reset()
+
+    def chdir(self, destdir):
+        ftp = self.connect()
+        if destdir != self.__cwd:
+            # relative paths are relative to the login directory
+            if not destdir.startswith("/"):
+                ftp.cwd(self.__home)
+            ftp.cwd(destdir)
+            self.__cwd = destdir
+
+    def remote_size(self, filename):
+        # -1 if the file is missing or the server doesn't support SIZE
+        ftp = self.connect()
+        try:
+            ftp.voidcmd("TYPE I")
+            size = ftp.size(filename)
+        except error_perm:
+            return -1
+        if size is None:
+            return -1
+        return size
+
+    def store(self, absfilename, filename, offset):
+        # storbinary() without the copies: the data connection is fed
+        # with sendfile(2), one block at a time for the rate limiter
+        ftp = self.connect()
+        meter = SvnBackupThroughput("ftp " + filename, self.__progress)
+        ftp.voidcmd("TYPE I")
+        ifd = open(absfilename, "rb")
+        try:
+            size = os.fstat(ifd.fileno()).st_size
+            pos = offset
+            conn = ftp.transfercmd("STOR %s" % filename, offset or None)
+            try:
+                while pos < size:
+                    sent = conn.sendfile(ifd, pos,
+                                         min(self.__blocksize, size - pos))
+                    if sent == 0:
+                        break
+                    pos += sent
+                    meter.add(sent)
+                    self.__limiter.consume(sent)
+            finally:
+                conn.close()
+            ftp.voidresp()
+        finally:
+            ifd.close()
+        meter.finish()
+        return pos == size
+
+    def upload(self, absfilename, destdir, filename):
+        size = os.path.getsize(absfilename)
+        attempt = 0
+        while True:
+            try:
+                self.chdir(destdir)
+                offset = 0
+                if attempt > 0:
+                    # resume where the interrupted upload stopped
+                    offset = self.remote_size(filename)
+                    if offset < 0 or offset > size:
+                        offset = 0
+                    elif offset > 0:
+                        print("resuming upload of %s at byte %d" % (filename,
+                                                                     offset))
+                if offset < size or size == 0:
+                    if not self.store(absfilename, filename, offset):
+                        return False
+                remote = self.remote_size(filename)
+                if remote not in (-1, size):
+                    raise IOError("remote size %d differs from local size %d" %
+                                  (remote, size))
+                return True
+            except all_errors:
+                self.reset()
+                if attempt >= self.__retries:
+                    raise
+                delay = self.__backoff * (2 ** attempt)
+                print("ftp upload of %s failed (%s), retrying in %.1fs" %
+                      (filename, str(sys.exc_info()[1]), delay))
+                time.sleep(delay)
+                attempt += 1
+
+
 class SvnBackup:
 
     def __init__(self, options, args):
@@ -340,6 +892,9 @@ class SvnBackup:
         self.__reposname = rpathparts[1]
         if self.__reposname in ["", ".", ".."]:
             raise SvnBackupException("couldn't extract repos name from '%s'." % self.__repospath)
+        self.__manifest = SvnBackupManifest(self.__dumpdir, self.__reposname)
+        self.__write_limiter = SvnBackupRateLimiter.get(self.__dumpdir,
+                                                        options.bwlimit_write)
         # check dumpdir
         if not os.path.exists(self.__dumpdir):
             raise SvnBackupException("dumpdir '%s' does not exist." % self.__dumpdir)
@@ -351,6 +906,15 @@ class SvnBackup:
         self.__quiet = options.quiet
         self.__deltas = options.deltas
         self.__relative_incremental = options.relative_incremental
+        self.__ftp_blocksize = options.ftp_blocksize
+        self.__ftp_retries = options.ftp_retries
+        self.__ftp_backoff = options.ftp_backoff
+        self.__state_file = options.state_file
+        self.__bwlimit_transfer = options.bwlimit_transfer
+        self.__progress = options.progress
+        if self.__state_file is None:
+            self.__state_file = os.path.join(self.__dumpdir,
+                                             ".svn-backup-state")
 
         # svnadmin/svnlook path
         self.__svnadmin_path = "svnadmin"
@@ -411,57 +975,65 @@ class SvnBackup:
         try:
             proc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=False)
         except:
-            return (256, "", "Popen failed (%s ...):\n  %s" % (cmd[0],
-                                                               str(sys.exc_info()[1])))
+            return (256, b"", ("Popen failed (%s ...):\n  %s" % (cmd[0],
+                                                                 str(sys.exc_info()[1]))).encode())
         stdout = proc.stdout
         stderr = proc.stderr
         self.set_nonblock(stdout)
         self.set_nonblock(stderr)
         readfds = [stdout, stderr]
         selres = select.select(readfds, [], [])
-        bufout = ""
-        buferr = ""
+        # stdout is read into one buffer, output gets views of it
+        chunk = bytearray(65536)
+        view = memoryview(chunk)
+        bufout = bytearray()
+        buferr = bytearray()
         while len(selres[0]) > 0:
             for fd in selres[0]:
-                buf = fd.read(16384)
-                if len(buf) == 0:
+                n = os.readv(fd.fileno(), [chunk])
+                if n == 0:
                     readfds.remove(fd)
                 elif fd == stdout:
                     if output:
-                        output.write(buf)
+                        output.write(view[:n])
                     else:
-                        bufout += buf
+                        bufout += view[:n]
                 else:
                     if printerr:
-                        sys.stdout.write("%s " % buf)
+                        sys.stdout.flush()
+                        sys.stdout.buffer.write(view[:n])
+                        sys.stdout.buffer.write(b" ")
                     else:
-                        buferr += buf
+                        buferr += view[:n]
             if len(readfds) == 0:
                 break
             selres = select.select(readfds, [], [])
         rc = proc.wait()
         if printerr:
+            sys.stdout.buffer.flush()
             print("")
-        return (rc, bufout, buferr)
+        return (rc, bytes(bufout), bytes(buferr))
 
     def exec_cmd_nt(self, cmd, output=None, printerr=False):
         try:
             proc = Popen(cmd, stdout=PIPE, stderr=None, shell=False)
         except:
-            return (256, "", "Popen failed (%s ...):\n  %s" % (cmd[0],
-                                                               str(sys.exc_info()[1])))
+            return (256, b"", ("Popen failed (%s ...):\n  %s" % (cmd[0],
+                                                                 str(sys.exc_info()[1]))).encode())
         stdout = proc.stdout
-        bufout = ""
-        buferr = ""
-        buf = stdout.read(16384)
-        while len(buf) > 0:
+        chunk = bytearray(65536)
+        view = memoryview(chunk)
+        bufout = bytearray()
+        buferr = b""
+        n = stdout.readinto(chunk)
+        while n > 0:
             if output:
-                output.write(buf)
+                output.write(view[:n])
             else:
-                bufout += buf
-            buf = stdout.read(16384)
+                bufout += view[:n]
+            n = stdout.readinto(chunk)
         rc = proc.wait()
-        return (rc, bufout, buferr)
+        return (rc, bytes(bufout), buferr)
 
     def get_head_rev(self):
         cmd = [self.__svnlook_path, "youngest", self.__repospath]
@@ -469,24 +1041,13 @@ class SvnBackup:
         if r[0] == 0 and len(r[2]) == 0:
             return int(r[1].strip())
         else:
-            print(r[2])
+            print(r[2].decode("utf-8", "replace"))
         return -1
 
     def get_last_dumped_rev(self):
-        filename_regex = re.compile("(.+)\.\d+-(\d+)\.svndmp.*")
-        # start with -1 so the next one will be rev 0
-        highest_rev = -1
-
-        for filename in os.listdir(self.__dumpdir):
-            m = filename_regex.match(filename)
-            if m and (m.group(1) == self.__reposname):
-                rev_end = int(m.group(2))
-
-                if rev_end > highest_rev:
-                    # determine the latest revision dumped
-                    highest_rev = rev_end
-
-        return highest_rev
+        # dumpdir is listed once for all repositories of a run
+        dumps = SvnBackupDumpDir.get(self.__dumpdir)
+        return dumps.get_last_dumped_rev(self.__reposname)
 
     def transfer_ftp(self, absfilename, filename):
         rc = False
@@ -495,14 +1056,14 @@ class SvnBackup:
             user = self.__transfer[2]
             passwd = self.__transfer[3]
             destdir = self.__transfer[4].replace("%r", self.__reposname)
-            ftp = FTP(host, user, passwd)
-            ftp.cwd(destdir)
-            ifd = open(absfilename, "rb")
-            ftp.storbinary("STOR %s" % filename, ifd)
-            ftp.quit()
-            rc = len(ifd.read(1)) == 0
-            ifd.close()
-        except Exception, e:
+            ftp = SvnBackupFtpTransport.get(host, user, passwd,
+                                            self.__ftp_blocksize,
+                                            self.__ftp_retries,
+                                            self.__ftp_backoff,
+                                            self.__bwlimit_transfer,
+                                            self.__progress)
+            rc = ftp.upload(absfilename, destdir, filename)
+        except Exception as e:
             raise SvnBackupException("ftp transfer failed:\n  file:  '%s'\n  error: %s" % \
                                      (absfilename, str(e)))
         return rc
@@ -519,7 +1080,7 @@ class SvnBackup:
         r = self.exec_cmd(cmd)
         rc = r[0] == 0
         if not rc:
-            print(r[2])
+            print(r[2].decode("utf-8", "replace"))
         return rc
 
     def transfer_dropbox(self, absfilename, filename):
@@ -579,12 +1140,26 @@ class SvnBackup:
             cmd[2:2] = ["-q"]
         if self.__deltas:
             cmd[2:2] = ["--deltas"]
+        meter = SvnBackupThroughput("dump " + realfilename, self.__progress)
         output.open()
-        r = self.exec_cmd(cmd, output, True)
-        output.close()
-        rc = r[0] == 0
+        r = self.exec_cmd(cmd, SvnBackupOutputThrottle(output,
+                                                       self.__write_limiter,
+                                                       meter), True)
+        # a failed external compressor leaves a truncated file, which must
+        # not get a manifest entry
+        closed = output.close()
+        meter.finish()
+        rc = r[0] == 0 and closed
         if rc:
+            if torev != None:
+                SvnBackupDumpDir.get(self.__dumpdir).update(self.__reposname,
+                                                            torev)
+            self.__manifest.record(realfilename, fromrev,
+                                   torev if torev != None else fromrev,
+                                   output.get_size(), output.get_checksum())
             self.transfer(absfilename, realfilename)
+        else:
+            self.__manifest.forget(realfilename)
         return rc
 
     def export_single_rev(self):
@@ -615,20 +1190,31 @@ class SvnBackup:
         return rc
 
     def export_relative_incremental(self):
+        # every commit replaces db/current, if it's unchanged since the
+        # last dump there is nothing to do and svnlook isn't needed
+        state = SvnBackupState.get(self.__state_file)
+        st = os.stat(os.path.join(self.__repospath, "db", "current"))
+        last_dumped_rev = self.get_last_dumped_rev()
+        if state.is_unchanged(self.__repospath, st, last_dumped_rev):
+            return True
+
         headrev = self.get_head_rev()
         if headrev == -1:
             return False
 
-        last_dumped_rev = self.get_last_dumped_rev();
         if headrev < last_dumped_rev:
             # that should not happen...
             return False
 
         if headrev == last_dumped_rev:
             # already up-to-date
+            state.update(self.__repospath, st, headrev)
             return True
 
-        return self.create_dump(False, False, last_dumped_rev + 1, headrev)
+        rc = self.create_dump(False, False, last_dumped_rev + 1, headrev)
+        if rc:
+            state.update(self.__repospath, st, headrev)
+        return rc
 
     def execute(self):
         if self.__rev_nr != None:
@@ -693,7 +1279,7 @@ class DropboxConnection:
         self.browser.set_handle_robots(False)
 
         # Browse to the login page
-        login_src = self.browser.open('https://www.dropbox.com/login').read()
+        login_src = self.browser.open('https://www.dropbox.com/login').read().decode('utf-8')
 
         # Enter the username and password into the login form
         isLoginForm = lambda l: (
@@ -722,7 +1308,8 @@ class DropboxConnection:
 
         try:
             self.root_ns = re.findall(r"\"root_ns\": (\d+)", src)[0]
-            self.token = re.findall(r"\"TOKEN\": ['\"](.+?)['\"]", src)[0].decode('string_escape')
+            self.token = re.findall(r"\"TOKEN\": ['\"](.+?)['\"]", src)[0]
+            self.token = codecs.decode(self.token, 'unicode_escape')
 
         except:
             raise (Exception("Unable to find constants for AJAX requests"))
@@ -730,11 +1317,12 @@ class DropboxConnection:
     def refresh_constants(self):
         """ Update constants from page """
 
-        src = self.browser.open('https://www.dropbox.com/home').read()
+        src = self.browser.open('https://www.dropbox.com/home').read().decode('utf-8')
 
         try:
             self.root_ns = re.findall(r"\"root_ns\": (\d+)", src)[0]
-            self.token = re.findall(r"\"TOKEN\": ['\"](.+?)['\"]", src)[0].decode('string_escape')
+            self.token = re.findall(r"\"TOKEN\": ['\"](.+?)['\"]", src)[0]
+            self.token = codecs.decode(self.token, 'unicode_escape')
             self.uid = re.findall(r"\"id\": (\d+)", src)[0]
             self.request_id = re.findall(r"\"REQUEST_ID\": ['\"]([a-z0-9]+)['\"]", src)[0]
 
@@ -776,8 +1364,8 @@ class DropboxConnection:
 
         req_vars = "ns_id=" + self.root_ns + "&referrer=&t=" + self.token + "&is_xhr=true" + "&parent_request_id=" + self.request_id
 
-        req = urllib2.Request('https://www.dropbox.com/browse' + remote_dir + '?_subject_uid=' + self.uid,
-                              data=req_vars)
+        req = urllib.request.Request('https://www.dropbox.com/browse' + remote_dir + '?_subject_uid=' + self.uid,
+                                     data=req_vars.encode('utf-8'))
         req.add_header('Referer', 'https://www.dropbox.com/home' + remote_dir)
 
         dir_info = json.loads(self.browser.open(req).read())
@@ -838,7 +1426,7 @@ def upload_file_dropbox(local_file, remote_dir, remote_file, email, password):
 
 
 if __name__ == "__main__":
-    usage = "usage: svn-backup-dumps.py [options] repospath dumpdir"
+    usage = "usage: svn-backup-dumps.py [options] repospath [repospath ...] dumpdir"
     parser = OptionParser(usage=usage, version="%prog " + __version)
     parser.add_option("-b",
                       action="store_true",
@@ -897,6 +1485,63 @@ if __name__ == "__main__":
                       action="store", type="string",
                       dest="svnlook_path", default=None,
                       help="svnlook command path.")
+    parser.add_option("--ftp-blocksize",
+                      action="store", type="int",
+                      dest="ftp_blocksize", default=8192,
+                      help="block size for ftp uploads (default 8192).")
+    parser.add_option("--ftp-retries",
+                      action="store", type="int",
+                      dest="ftp_retries", default=3,
+                      help="retries of an interrupted ftp upload (default 3).")
+    parser.add_option("--ftp-backoff",
+                      action="store", type="float",
+                      dest="ftp_backoff", default=1.0,
+                      help="seconds to wait before the first ftp retry, "
+                           "doubled on each further retry (default 1).")
+    parser.add_option("--bwlimit-write",
+                      action="store", type="string",
+                      dest="bwlimit_write", default="0",
+                      help="limit the dump data written to N bytes/s, "
+                           "K, M and G suffixes allowed (default no limit).")
+    parser.add_option("--bwlimit-transfer",
+                      action="store", type="string",
+                      dest="bwlimit_transfer", default="0",
+                      help="limit ftp uploads to N bytes/s, K, M and G "
+                           "suffixes allowed (default no limit).")
+    parser.add_option("--nice",
+                      action="store", type="int",
+                      dest="nice", default=None,
+                      help="run with this nice increment, inherited by "
+                           "svnadmin and the compression commands.")
+    parser.add_option("--ionice-class",
+                      action="store", type="int",
+                      dest="ionice_class", default=None,
+                      help="io scheduling class: 1 realtime, 2 best-effort, "
+                           "3 idle (see ionice(1)).")
+    parser.add_option("--ionice-level",
+                      action="store", type="int",
+                      dest="ionice_level", default=None,
+                      help="io priority 0-7 within the io scheduling class.")
+    parser.add_option("--progress",
+                      action="store", type="int",
+                      dest="progress", default=0,
+                      help="print the throughput of dumps and uploads every "
+                           "N seconds.")
+    parser.add_option("--state-file",
+                      action="store", type="string",
+                      dest="state_file", default=None,
+                      help="state of the last incremental dumps (default "
+                           "<dumpdir>/.svn-backup-state).")
+    parser.add_option("--verify",
+                      action="store_true",
+                      dest="verify", default=False,
+                      help="check the dump files against the manifests "
+                           "instead of dumping.")
+    parser.add_option("--verify-threads",
+                      action="store", type="int",
+                      dest="verify_threads", default=4,
+                      help="files checked in parallel by --verify "
+                           "(default 4).")
     parser.add_option("--help-transfer",
                       action="store_true",
                       dest="help_transfer", default=False,
@@ -907,17 +1552,64 @@ if __name__ == "__main__":
         print("")
         print("  FTP:")
         print("    -t ftp:<host>:<user>:<password>:<dest-path>")
+        print("    One connection is reused for all dumps of a run,")
+        print("    interrupted uploads are resumed (see --ftp-retries).")
         print("")
         print("  SMB (using smbclient):")
         print("    -t smb:<share>:<user>:<password>:<dest-path>")
+        print("    smbclient can't be rate limited, --bwlimit-transfer")
+        print("    applies to FTP only; --nice and --ionice-* apply.")
         print("")
         sys.exit(0)
+    if options.verify:
+        # svn-backup-dumps.py --verify [repospath ...] dumpdir
+        if len(args) < 2:
+            print("svn-backup-dumps.py: specify dumpdir.")
+            sys.exit(1)
+        reposnames = None
+        if len(args) > 2:
+            reposnames = [os.path.basename(os.path.normpath(repospath))
+                          for repospath in args[1:-1]]
+        if verify_dumps(args[-1], reposnames, options.verify_threads):
+            print("Everything OK.")
+            sys.exit(0)
+        else:
+            print("An error occured!")
+            sys.exit(1)
     rc = False
     try:
-        backup = SvnBackup(options, args)
-        rc = backup.execute()
-    except SvnBackupException, e:
+        try:
+            options.bwlimit_write = parse_size(options.bwlimit_write)
+            options.bwlimit_transfer = parse_size(options.bwlimit_transfer)
+        except ValueError:
+            raise SvnBackupException("invalid --bwlimit value.")
+        set_priority(options.nice, options.ionice_class, options.ionice_level)
+        if len(args) > 3:
+            # several repositories, dumped in one run to the same dumpdir;
+            # a failing repository is reported and the others still run
+            rc = True
+            failed = []
+            for repospath in args[1:-1]:
+                try:
+                    backup = SvnBackup(options, [args[0], repospath, args[-1]])
+                    ok = backup.execute()
+                except (SvnBackupException, EnvironmentError) as e:
+                    print("svn-backup-dumps.py: %s: %s" % (repospath, e))
+                    ok = False
+                if not ok:
+                    failed.append(repospath)
+                rc = ok and rc
+            if failed:
+                print("svn-backup-dumps.py: %d of %d repositories failed:"
+                      % (len(failed), len(args) - 2))
+                for repospath in failed:
+                    print("  %s" % repospath)
+        else:
+            rc = SvnBackup(options, args).execute()
+    except SvnBackupException as e:
+        rc = False
         print("svn-backup-dumps.py: %s" % e)
+    SvnBackupFtpTransport.close_all()
     if rc:
         print("Everything OK.")
         sys.exit(0)
@@ -0,0 +1,187 @@
+# -*- coding: UTF-8 -*-
+"""
+chapter6/section3/alert.py中邮件发送的测试
+
+用aiosmtpd在本机启动一个SMTP服务器，检查合并发送、服务器不可用时的
+退避重试、丢弃最旧的邮件以及服务器断开连接后的重新连接。没有安装
+aiosmtpd时跳过。
+
+    $ python3 -m pytest tests/test_alert.py
+"""
+import email
+import os
+import socket
+import sys
+import time
+import unittest
+from email.header import decode_header, make_header
+
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:
+    Controller = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "chapter6", "section3"))
+
+from alert import AlertManager, AsyncNotifier, MailNotifier, Rule  # noqa: E402
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class Inbox(object):
+
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        msg = email.message_from_bytes(envelope.content)
+        subject = str(make_header(decode_header(msg["Subject"])))
+        body = msg.get_payload(decode=True).decode("utf-8")
+        self.messages.append((subject, body, envelope.rcpt_tos))
+        return "250 OK"
+
+    def subjects(self):
+        return [m[0] for m in self.messages]
+
+
+class RecordingNotifier(MailNotifier):
+    """ 记录每次发送的时间和失败的原因 """
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingNotifier, self).__init__(*args, **kwargs)
+        self.attempts = []
+        self.failures = []
+
+    def send(self, subject, body):
+        self.attempts.append(time.time())
+        try:
+            super(RecordingNotifier, self).send(subject, body)
+        except Exception as e:
+            self.failures.append(e)
+            raise
+
+
+@unittest.skipIf(Controller is None, "aiosmtpd is not installed")
+class MailTest(unittest.TestCase):
+
+    def setUp(self):
+        self.port = free_port()
+        self.inbox = Inbox()
+        self.controller = None
+        self.start_server()
+        self.mail = RecordingNotifier("127.0.0.1", self.port, "agent@example.com",
+                                      ["ops@example.com", "dba@example.com"], timeout=5)
+        self.notifiers = []
+
+    def tearDown(self):
+        for notifier in self.notifiers:
+            notifier.close(timeout=1)
+        self.mail.close()
+        self.stop_server()
+
+    def start_server(self):
+        self.controller = Controller(self.inbox, hostname="127.0.0.1", port=self.port)
+        self.controller.start()
+
+    def stop_server(self):
+        if self.controller is not None:
+            self.controller.stop()
+            self.controller = None
+
+    def async_notifier(self, **kwargs):
+        notifier = AsyncNotifier(self.mail, **kwargs)
+        self.notifiers.append(notifier)
+        return notifier
+
+    def test_batch_is_one_mail(self):
+        notifier = self.async_notifier()
+        rules = [Rule("cpu_percent", ">", 80), Rule("disk_percent", ">", 90)]
+        alerts = AlertManager(rules, notifier, batch_interval=60, hostname="web1")
+        now = time.time()
+        alerts.evaluate(dict(time=now, cpu_percent=95, disk_percent=99))
+        # 不到batch_interval时不发送
+        self.assertEqual(alerts.flush(now=now + 1), 0)
+        self.assertEqual(alerts.flush(now=now + 60), 2)
+        self.assertTrue(wait_for(lambda: self.inbox.messages))
+        notifier.close()
+        self.assertEqual(len(self.inbox.messages), 1)
+        subject, body, recipients = self.inbox.messages[0]
+        self.assertEqual(subject, "[web1] 2 firing")
+        self.assertIn("[FIRING] cpu_percent > 80 (value 95)", body)
+        self.assertIn("[FIRING] disk_percent > 90 (value 99)", body)
+        self.assertEqual(recipients, ["ops@example.com", "dba@example.com"])
+
+    def test_send_does_not_block_and_backs_off(self):
+        self.stop_server()
+        notifier = self.async_notifier(retry_interval=0.1, max_retry_interval=0.4)
+        start = time.time()
+        notifier.send("down", "body")
+        self.assertLess(time.time() - start, 0.05)
+        self.assertTrue(wait_for(lambda: len(self.mail.attempts) >= 5))
+        attempts = self.mail.attempts
+        gaps = [b - a for a, b in zip(attempts, attempts[1:])]
+        # 0.1、0.2、0.4，之后不超过max_retry_interval
+        for gap, expected in zip(gaps, (0.1, 0.2, 0.4, 0.4)):
+            self.assertGreaterEqual(gap, expected * 0.9)
+        self.assertLess(gaps[3], 0.8)
+        self.assertEqual(len(notifier.queue), 1)
+
+        # 服务器恢复后发送队列中的邮件
+        self.start_server()
+        self.assertTrue(wait_for(lambda: self.inbox.messages))
+        self.assertEqual(self.inbox.subjects(), ["down"])
+        self.assertTrue(wait_for(lambda: not notifier.queue))
+
+    def test_full_queue_drops_oldest(self):
+        self.stop_server()
+        notifier = self.async_notifier(retry_interval=0.2, max_queue=2)
+        notifier.send("first", "body")
+        self.assertTrue(wait_for(lambda: self.mail.failures))
+        for subject in ("second", "third", "fourth"):
+            notifier.send(subject, "body")
+        self.assertEqual([m[0] for m in notifier.queue], ["third", "fourth"])
+        self.start_server()
+        self.assertTrue(wait_for(lambda: len(self.inbox.messages) == 2))
+        self.assertEqual(self.inbox.subjects(), ["third", "fourth"])
+
+    def test_reconnect_after_server_disconnect(self):
+        self.mail.send("one", "body")
+        first = self.mail.smtp
+        self.assertIsNotNone(first)
+        # 服务器重启后原来的连接已经断开，send重新连接一次
+        self.stop_server()
+        self.start_server()
+        self.mail.send("two", "body")
+        self.assertEqual(self.inbox.subjects(), ["one", "two"])
+        self.assertIsNot(self.mail.smtp, first)
+        self.assertEqual(self.mail.failures, [])
+
+    def test_close_gives_up_while_server_is_down(self):
+        self.stop_server()
+        notifier = self.async_notifier(retry_interval=30)
+        notifier.send("lost", "body")
+        self.assertTrue(wait_for(lambda: self.mail.failures))
+        start = time.time()
+        notifier.close(timeout=5)
+        self.assertLess(time.time() - start, 1)
+        self.assertFalse(notifier.thread.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+"""
+chapter8/section2/discover.py的回归测试
+
+ping和端口扫描替换成固定的结果，检查Discovery.run对数据库的更新，
+特别是ping出错（结果中没有这台主机）时的处理。
+
+    $ python3 -m pytest tests/test_discover.py
+"""
+import argparse
+import os
+import sys
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "chapter8", "section2"))
+
+import discover  # noqa: E402
+
+
+class DiscoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = discover.connect(":memory:")
+        self.args = argparse.Namespace(ping_age=3600, scan_age=86400, skip_ping=False,
+                                       group="test", user=None, ssh_port=22)
+        self.rtts = {}
+        self.open_ports = {}
+        self.pinged = []
+        self.orig = discover.ping_hosts, discover.scan_hosts
+        discover.ping_hosts = self.ping_hosts
+        discover.scan_hosts = self.scan_hosts
+
+    def tearDown(self):
+        discover.ping_hosts, discover.scan_hosts = self.orig
+        self.conn.close()
+
+    def ping_hosts(self, ips, args):
+        # 与discover.ping_hosts相同：出错的主机不在结果中
+        self.pinged.append(list(ips))
+        return dict((ip, self.rtts[ip]) for ip in ips if ip in self.rtts)
+
+    def scan_hosts(self, targets, args):
+        found = {}
+        for host, port in targets:
+            ports = found.setdefault(host, set())
+            if port in self.open_ports.get(host, ()):
+                ports.add(port)
+        return found
+
+    def run_discovery(self, ips, ports=(22, 80)):
+        discovery = discover.Discovery(self.conn, self.args)
+        discovery.run(ips, list(ports))
+        return discovery.status
+
+    def hosts(self):
+        return dict((host, alive) for host, alive in
+                    self.conn.execute("SELECT host, alive FROM hosts"))
+
+    def expire_pings(self):
+        self.conn.execute("UPDATE hosts SET last_ping = ?", (time.time() - 7200,))
+
+    def test_new_hosts(self):
+        self.rtts = {"10.0.0.1": 0.001, "10.0.0.2": None}
+        self.open_ports = {"10.0.0.1": {22}}
+        status = self.run_discovery(["10.0.0.1", "10.0.0.2"])
+        self.assertEqual(status, {"10.0.0.1": "new"})
+        self.assertEqual(self.hosts(), {"10.0.0.1": 1})
+
+    def test_ping_error_for_new_host(self):
+        # 10.0.0.2的ping出错，不在结果中
+        self.rtts = {"10.0.0.1": 0.001}
+        self.open_ports = {"10.0.0.1": {22}, "10.0.0.2": {22}}
+        status = self.run_discovery(["10.0.0.1", "10.0.0.2"])
+        self.assertEqual(status, {"10.0.0.1": "new"})
+        self.assertEqual(self.hosts(), {"10.0.0.1": 1})
+
+    def test_ping_error_keeps_known_state(self):
+        self.rtts = {"10.0.0.1": 0.001, "10.0.0.2": 0.002, "10.0.0.3": None}
+        self.open_ports = {"10.0.0.1": {22}, "10.0.0.2": {80}}
+        self.run_discovery(["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+        self.conn.execute("INSERT INTO hosts (host, alive) VALUES ('10.0.0.3', 0)")
+        self.expire_pings()
+
+        # 所有主机都需要重新ping，但只有10.0.0.1有结果
+        self.rtts = {"10.0.0.1": None}
+        status = self.run_discovery(["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+        self.assertEqual(sorted(self.pinged[-1]), ["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+        self.assertEqual(status, {"10.0.0.1": "down", "10.0.0.2": "cached"})
+        self.assertEqual(self.hosts(), {"10.0.0.1": 0, "10.0.0.2": 1, "10.0.0.3": 0})
+        # ping出错时不更新ping时间，下次运行再试
+        last_ping = dict(self.conn.execute("SELECT host, last_ping FROM hosts"))
+        self.assertLess(last_ping["10.0.0.2"], time.time() - 3600)
+
+
+if __name__ == "__main__":
+    unittest.main()
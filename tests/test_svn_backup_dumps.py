@@ -0,0 +1,468 @@
+# -*- coding: UTF-8 -*-
+"""
+svn-backup-dumps.py的回归测试
+
+需要svnadmin和svnlook的测试用svnadmin create创建临时仓库，没有安装
+subversion时跳过；其他测试只检查输出文件、manifest和--verify。FTP上传
+使用进程内的FakeFtpServer，可以在传输中途断开连接。
+
+    $ python3 -m pytest tests
+    $ python3 -m unittest discover tests
+"""
+import bz2
+import ftplib
+import gzip
+import importlib.util
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, "svn-backup-dumps.py")
+
+spec = importlib.util.spec_from_file_location("svn_backup_dumps", SCRIPT)
+svn_backup_dumps = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(svn_backup_dumps)
+
+HAVE_SVN = shutil.which("svnadmin") is not None and shutil.which("svnlook") is not None
+
+
+def dump_stream(first, count):
+    """ 返回一个dump流，包含count个修订版本，每个版本添加一个文件 """
+    out = io.BytesIO()
+    out.write(b"SVN-fs-dump-format-version: 2\n\n")
+    for rev in range(first, first + count):
+        props = (b"K 7\nsvn:log\nV 8\nrev %04d\n"
+                 b"K 10\nsvn:author\nV 4\ntest\n"
+                 b"K 8\nsvn:date\nV 27\n2017-01-01T00:00:00.000000Z\n"
+                 b"PROPS-END\n") % rev
+        out.write(b"Revision-number: %d\n" % rev)
+        out.write(b"Prop-content-length: %d\n" % len(props))
+        out.write(b"Content-length: %d\n\n" % len(props))
+        out.write(props + b"\n")
+        text = b"file %d\n" % rev + bytes(range(256)) * 4
+        node_props = b"PROPS-END\n"
+        out.write(b"Node-path: file%d.bin\n" % rev)
+        out.write(b"Node-kind: file\nNode-action: add\n")
+        out.write(b"Prop-content-length: %d\n" % len(node_props))
+        out.write(b"Text-content-length: %d\n" % len(text))
+        out.write(b"Content-length: %d\n\n" % (len(node_props) + len(text)))
+        out.write(node_props + text + b"\n\n")
+    return out.getvalue()
+
+
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="svn-backup-test-")
+        self.dumpdir = os.path.join(self.tmpdir, "dumps")
+        os.mkdir(self.dumpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def backup(self, *args):
+        proc = subprocess.run([sys.executable, SCRIPT] + list(args),
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return proc.returncode, proc.stdout.decode("utf-8", "replace")
+
+    def manifest(self, reposname="src"):
+        absfilename = os.path.join(self.dumpdir, reposname + ".manifest")
+        if not os.path.exists(absfilename):
+            return {}
+        with open(absfilename) as f:
+            return json.load(f)["files"]
+
+
+class OutputTest(TempDirTestCase):
+
+    DATA = b"SVN-fs-dump-format-version: 2\n\n" + bytes(range(256)) * 1000
+
+    def write(self, output):
+        output.open()
+        view = memoryview(self.DATA)
+        for i in range(0, len(self.DATA), 65536):
+            output.write(view[i:i + 65536])
+        self.assertTrue(output.close())
+        with open(output.get_absfilename(), "rb") as f:
+            data = f.read()
+        self.assertEqual(output.get_size(), len(data))
+        self.assertEqual(output.get_checksum(),
+                         svn_backup_dumps.file_checksum(output.get_absfilename()))
+        return data
+
+    def test_plain(self):
+        output = svn_backup_dumps.SvnBackupOutputPlain(self.dumpdir, "src.000000.svndmp")
+        self.assertEqual(output.get_filename(), "src.000000.svndmp")
+        self.assertEqual(self.write(output), self.DATA)
+
+    def test_gzip(self):
+        output = svn_backup_dumps.SvnBackupOutputGzip(self.dumpdir, "src.000000.svndmp")
+        self.assertEqual(output.get_filename(), "src.000000.svndmp.gz")
+        self.assertEqual(gzip.decompress(self.write(output)), self.DATA)
+
+    def test_bzip2(self):
+        output = svn_backup_dumps.SvnBackupOutputBzip2(self.dumpdir, "src.000000.svndmp")
+        self.assertEqual(output.get_filename(), "src.000000.svndmp.bz2")
+        self.assertEqual(bz2.decompress(self.write(output)), self.DATA)
+
+    @unittest.skipUnless(shutil.which("gzip"), "gzip not installed")
+    def test_command(self):
+        output = svn_backup_dumps.SvnBackupOutputCommand(
+            self.dumpdir, "src.000000.svndmp", ".gz", shutil.which("gzip"), "-cf")
+        self.assertEqual(gzip.decompress(self.write(output)), self.DATA)
+
+    @unittest.skipUnless(shutil.which("false"), "false not installed")
+    def test_failed_command(self):
+        output = svn_backup_dumps.SvnBackupOutputCommand(
+            self.dumpdir, "src.000000.svndmp", ".gz", shutil.which("false"), "-cf")
+        output.open()
+        output.write(self.DATA)
+        self.assertFalse(output.close())
+
+
+class VerifyTest(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        manifest = svn_backup_dumps.SvnBackupManifest(self.dumpdir, "src")
+        for name, data in (("src.000000-000001.svndmp", b"a" * 100),
+                           ("src.000002-000003.svndmp", b"b" * 100)):
+            with open(os.path.join(self.dumpdir, name), "wb") as f:
+                f.write(data)
+            manifest.record(name, 0, 1, len(data), svn_backup_dumps.file_checksum(
+                os.path.join(self.dumpdir, name)))
+
+    def test_ok(self):
+        self.assertEqual(self.backup("--verify", self.dumpdir)[0], 0)
+
+    def test_corrupt(self):
+        with open(os.path.join(self.dumpdir, "src.000002-000003.svndmp"), "r+b") as f:
+            f.write(b"c")
+        rc, out = self.backup("--verify", self.dumpdir)
+        self.assertEqual(rc, 1)
+        self.assertIn("src.000002-000003.svndmp", out)
+
+    def test_missing(self):
+        os.remove(os.path.join(self.dumpdir, "src.000000-000001.svndmp"))
+        self.assertEqual(self.backup("--verify", self.dumpdir)[0], 1)
+
+
+@unittest.skipUnless(HAVE_SVN, "svnadmin and svnlook not installed")
+class BackupTest(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.repos = self.create_repos("src", 5)
+
+    def create_repos(self, name, revisions):
+        repos = os.path.join(self.tmpdir, name)
+        subprocess.check_call(["svnadmin", "create", repos])
+        self.load(repos, 1, revisions)
+        return repos
+
+    def load(self, repos, first, count):
+        proc = subprocess.run(["svnadmin", "load", "-q", repos],
+                              input=dump_stream(first, count),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+
+    def youngest(self, repos):
+        return int(subprocess.check_output(["svnlook", "youngest", repos]))
+
+    def restore(self, *filenames):
+        """ 把dump文件依次载入一个新仓库，返回它的修订版本数 """
+        repos = os.path.join(self.tmpdir, "restored")
+        shutil.rmtree(repos, ignore_errors=True)
+        subprocess.check_call(["svnadmin", "create", repos])
+        for filename in filenames:
+            with open(os.path.join(self.dumpdir, filename), "rb") as f:
+                data = f.read()
+            if filename.endswith(".gz"):
+                data = gzip.decompress(data)
+            elif filename.endswith(".bz2"):
+                data = bz2.decompress(data)
+            proc = subprocess.run(["svnadmin", "load", "-q", repos], input=data,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.assertEqual(proc.returncode, 0, proc.stderr)
+        return self.youngest(repos)
+
+    def dumpfiles(self):
+        return sorted(f for f in os.listdir(self.dumpdir) if ".svndmp" in f)
+
+    def test_full_dump(self):
+        rc, out = self.backup(self.repos, self.dumpdir)
+        self.assertEqual(rc, 0, out)
+        self.assertEqual(self.dumpfiles(), ["src.000000-000005.svndmp"])
+        self.assertEqual(self.restore("src.000000-000005.svndmp"), 5)
+        entry = self.manifest()["src.000000-000005.svndmp"]
+        self.assertEqual((entry["fromrev"], entry["torev"]), (0, 5))
+        self.assertEqual(entry["size"], os.path.getsize(
+            os.path.join(self.dumpdir, "src.000000-000005.svndmp")))
+
+    def test_existing_dump_is_kept(self):
+        self.assertEqual(self.backup(self.repos, self.dumpdir)[0], 0)
+        rc, out = self.backup(self.repos, self.dumpdir)
+        self.assertEqual(rc, 0, out)
+        self.assertIn("already exists", out)
+
+    def test_gzip(self):
+        self.assertEqual(self.backup("-z", self.repos, self.dumpdir)[0], 0)
+        self.assertEqual(self.dumpfiles(), ["src.000000-000005.svndmp.gz"])
+        self.assertEqual(self.restore("src.000000-000005.svndmp.gz"), 5)
+
+    def test_bzip2(self):
+        self.assertEqual(self.backup("-b", self.repos, self.dumpdir)[0], 0)
+        self.assertEqual(self.dumpfiles(), ["src.000000-000005.svndmp.bz2"])
+        self.assertEqual(self.restore("src.000000-000005.svndmp.bz2"), 5)
+
+    @unittest.skipUnless(shutil.which("gzip"), "gzip not installed")
+    def test_gzip_path(self):
+        rc, out = self.backup("--gzip-path", shutil.which("gzip"), self.repos, self.dumpdir)
+        self.assertEqual(rc, 0, out)
+        self.assertEqual(self.restore("src.000000-000005.svndmp.gz"), 5)
+        self.assertIn("src.000000-000005.svndmp.gz", self.manifest())
+
+    @unittest.skipUnless(shutil.which("false"), "false not installed")
+    def test_failed_compressor_not_in_manifest(self):
+        rc, out = self.backup("--gzip-path", shutil.which("false"), self.repos, self.dumpdir)
+        self.assertEqual(rc, 1, out)
+        self.assertNotIn("src.000000-000005.svndmp.gz", self.manifest())
+
+    def test_count(self):
+        rc, out = self.backup("-c", "2", self.repos, self.dumpdir)
+        self.assertEqual(rc, 0, out)
+        files = ["src.000000-000001.svndmp", "src.000002-000003.svndmp",
+                 "src.000004-000005.svndmp"]
+        self.assertEqual(self.dumpfiles(), files)
+        self.assertEqual(self.restore(*files), 5)
+
+    def test_single_revision(self):
+        rc, out = self.backup("-r", "3", self.repos, self.dumpdir)
+        self.assertEqual(rc, 0, out)
+        self.assertEqual(self.dumpfiles(), ["src.000003.svndmp"])
+
+    def test_relative_incremental(self):
+        self.assertEqual(self.backup("-i", self.repos, self.dumpdir)[0], 0)
+        self.assertEqual(self.dumpfiles(), ["src.000000-000005.svndmp"])
+        # 没有新的提交，不生成新文件
+        rc, out = self.backup("-i", self.repos, self.dumpdir)
+        self.assertEqual(rc, 0, out)
+        self.assertEqual(self.dumpfiles(), ["src.000000-000005.svndmp"])
+        self.load(self.repos, 6, 2)
+        self.assertEqual(self.backup("-i", self.repos, self.dumpdir)[0], 0)
+        files = ["src.000000-000005.svndmp", "src.000006-000007.svndmp"]
+        self.assertEqual(self.dumpfiles(), files)
+        self.assertEqual(self.restore(*files), 7)
+
+    def test_verify(self):
+        self.assertEqual(self.backup("-c", "2", self.repos, self.dumpdir)[0], 0)
+        self.assertEqual(self.backup("--verify", self.repos, self.dumpdir)[0], 0)
+        with open(os.path.join(self.dumpdir, "src.000002-000003.svndmp"), "ab") as f:
+            f.write(b"x")
+        self.assertEqual(self.backup("--verify", self.repos, self.dumpdir)[0], 1)
+
+    def test_several_repositories(self):
+        other = self.create_repos("other", 2)
+        notrepos = os.path.join(self.tmpdir, "notrepos")
+        os.mkdir(notrepos)
+        rc, out = self.backup(self.repos, notrepos, other, self.dumpdir)
+        # 一个目录不是仓库时，其他仓库仍然被备份
+        self.assertEqual(rc, 1, out)
+        self.assertIn("notrepos", out)
+        self.assertEqual(self.dumpfiles(), ["other.000000-000002.svndmp",
+                                            "src.000000-000005.svndmp"])
+
+
+
+class FakeFtpServer(object):
+    """ 只实现上传用到的命令的FTP服务器，文件保存在files中
+
+    drop_after不为None时，前drops次STOR收到的文件达到这么多字节后关闭
+    数据连接和控制连接，模拟传输中途断线 """
+
+    def __init__(self, drop_after=None, drops=1):
+        self.files = {}
+        self.commands = []
+        self.logins = 0
+        self.drop_after = drop_after
+        self.drops = drops
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.sock.close()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self.session, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def session(self, conn):
+        f = conn.makefile("rb")
+        reply = lambda line: conn.sendall(line.encode("ascii") + b"\r\n")
+        cwd, rest, pasv = "/", 0, None
+        try:
+            reply("220 fake ftp")
+            for line in f:
+                cmd, _, arg = line.decode("utf-8").strip().partition(" ")
+                cmd = cmd.upper()
+                self.commands.append((cmd, arg))
+                path = os.path.normpath(os.path.join(cwd, arg))
+                if cmd == "USER":
+                    reply("331 password required")
+                elif cmd == "PASS":
+                    self.logins += 1
+                    reply("230 logged in")
+                elif cmd == "PWD":
+                    reply('257 "%s"' % cwd)
+                elif cmd == "CWD":
+                    cwd = path
+                    reply("250 ok")
+                elif cmd == "TYPE":
+                    reply("200 ok")
+                elif cmd == "SIZE":
+                    if path in self.files:
+                        reply("213 %d" % len(self.files[path]))
+                    else:
+                        reply("550 no such file")
+                elif cmd == "PASV":
+                    pasv = socket.socket()
+                    pasv.bind(("127.0.0.1", 0))
+                    pasv.listen(1)
+                    port = pasv.getsockname()[1]
+                    reply("227 Entering Passive Mode (127,0,0,1,%d,%d)" % (port >> 8, port & 255))
+                elif cmd == "REST":
+                    rest = int(arg)
+                    reply("350 restarting at %d" % rest)
+                elif cmd == "STOR":
+                    reply("150 ok")
+                    data, _ = pasv.accept()
+                    pasv.close()
+                    content = self.files.get(path, bytearray())[:rest]
+                    self.files[path] = content
+                    rest = 0
+                    if not self.receive(data, content):
+                        return
+                    reply("226 transfer complete")
+                elif cmd == "QUIT":
+                    reply("221 bye")
+                    return
+                else:
+                    reply("502 not implemented")
+        finally:
+            f.close()
+            conn.close()
+
+    def receive(self, data, content):
+        """ 把数据连接中的内容追加到content，断线时返回False """
+        try:
+            while True:
+                chunk = data.recv(65536)
+                if not chunk:
+                    return True
+                if self.drop_after is not None:
+                    chunk = chunk[:self.drop_after - len(content)]
+                    content.extend(chunk)
+                    if len(content) >= self.drop_after:
+                        self.drops -= 1
+                        if self.drops == 0:
+                            self.drop_after = None
+                        return False
+                else:
+                    content.extend(chunk)
+        finally:
+            data.close()
+
+
+class FtpUploadTest(TempDirTestCase):
+
+    DATA = bytes(range(256)) * 4096
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.absfilename = os.path.join(self.dumpdir, "src.000000-000010.svndmp")
+        with open(self.absfilename, "wb") as f:
+            f.write(self.DATA)
+        self.server = None
+
+    def tearDown(self):
+        svn_backup_dumps.SvnBackupFtpTransport.close_all()
+        if self.server is not None:
+            self.server.close()
+        TempDirTestCase.tearDown(self)
+
+    def transport(self, drop_after=None, drops=1):
+        self.server = FakeFtpServer(drop_after, drops)
+        port = self.server.port
+
+        def connect(host, user, passwd):
+            ftp = ftplib.FTP()
+            ftp.connect(host, port, timeout=10)
+            ftp.login(user, passwd)
+            return ftp
+
+        patcher = mock.patch.object(svn_backup_dumps, "FTP", connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return svn_backup_dumps.SvnBackupFtpTransport.get(
+            "127.0.0.1", "backup", "secret", blocksize=16384, backoff=0)
+
+    def upload(self, transport, destdir="backups"):
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as out:
+            self.assertTrue(transport.upload(self.absfilename, destdir,
+                                             os.path.basename(self.absfilename)))
+        return out.getvalue()
+
+    def remote(self, destdir="/backups"):
+        return bytes(self.server.files[destdir + "/src.000000-000010.svndmp"])
+
+    def test_upload(self):
+        transport = self.transport()
+        self.upload(transport)
+        self.upload(transport, "/other")
+        self.assertEqual(self.remote(), self.DATA)
+        self.assertEqual(self.remote("/other"), self.DATA)
+        # 两次上传共用一个连接
+        self.assertEqual(self.server.logins, 1)
+        self.assertNotIn("REST", [cmd for cmd, _ in self.server.commands])
+
+    def test_resume_after_dropped_connection(self):
+        transport = self.transport(drop_after=300000)
+        out = self.upload(transport)
+        self.assertIn("retrying", out)
+        self.assertIn("resuming upload of src.000000-000010.svndmp at byte 300000", out)
+        self.assertIn(("REST", "300000"), self.server.commands)
+        self.assertEqual([cmd for cmd, _ in self.server.commands].count("STOR"), 2)
+        self.assertEqual(self.server.logins, 2)
+        self.assertEqual(self.remote(), self.DATA)
+
+    def test_give_up_after_retries(self):
+        transport = self.transport(drop_after=300000, drops=4)
+        with mock.patch("sys.stdout", new_callable=io.StringIO):
+            with self.assertRaises(ftplib.all_errors):
+                transport.upload(self.absfilename, "backups",
+                                 os.path.basename(self.absfilename))
+        # 第一次加上3次重试
+        self.assertEqual([cmd for cmd, _ in self.server.commands].count("STOR"), 4)
+
+if __name__ == "__main__":
+    unittest.main()